@@ -46,7 +46,7 @@ app = Flask(__name__)
 
 # Configure persistent job store using SQLite
 jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite') # Store jobs in jobs.sqlite file
+    'default': SQLAlchemyJobStore(engine=engine) # Store jobs in the task store database (DATABASE_URL)
 }
 scheduler = BackgroundScheduler(jobstores=jobstores, daemon=True) # Use the configured job store
 replication_tasks = {} # Store details about ongoing replications {source_host_id: ReplicationTask object}
@@ -54,8 +54,6 @@ replication_tasks = {} # Store details about ongoing replications {source_host_i
 # Initialize Faker
 fake = Faker()
 
-# --- Global Configuration for Item Skipping ---
-SKIP_KEY_PREFIXES = ['MTR'] # Keys starting with these prefixes will be skipped
 from flask import Flask, render_template, request, jsonify
 import logging
 import re # Import the re module for regular expressions
@@ -76,14 +74,29 @@ import os
 # load_dotenv(os.path.join(os.path.dirname(__file__), '.env')) # Loaded in common.py
 
 import json
-
-from jobs import replay_job # Import the replay job function
+import uuid
+
+from jobs import replay_tick, REPLAY_ENGINE_JOB_ID, REPLAY_ACTIVE_STATUSES # Import the replay engine job
+from async_replay import replay_tick_async # Optional asyncio replay engine
+from history_fetch import HistoryStream, fetch_history # Parallel, chunked source history fetch
+from history_store import bump_history_generation
+from history_topup import history_topup_tick, HISTORY_TOPUP_JOB_ID # Rolling history top-up job
+from leader import LeaderElector, SCHEDULER_LEASE # Runs the scheduler in one gunicorn worker only
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, REPLICATION_STEP_SECONDS, REPLICATIONS, StageTimer, render_metrics # Prometheus metrics
+from problem_simulation import set_task_item_mapping # Problem classification stored with the item mapping
+from provisioning import HostProvisioningPlan, bulk_create # Batched Zabbix object creation
+from replication_queue import ReplicationQueue, QUEUED_STATUS # Bulk replication worker pool
+from zabbix_cache import ENTITY_KINDS, dest_metadata_cache, merge_source_items, source_config_cache # Shared Zabbix metadata caches
 
 # Import trigger utility functions
-from trigger_utils import perform_mapping_rebuild,create_icmp_trigger, create_icmp_loss_trigger, create_icmp_response_trigger, create_interface_link_down_trigger, create_interface_speed_change_trigger,create_cpu_utilization_trigger,create_temperature_critical_trigger
+from trigger_utils import (
+    perform_mapping_rebuild, icmp_trigger_spec, icmp_loss_trigger_spec, icmp_response_trigger_spec, interface_link_down_trigger_spec,
+    interface_speed_change_trigger_spec, cpu_utilization_trigger_spec, temperature_critical_trigger_spec
+)
 
 # Import SQLAlchemy components and config from common.py
-from common import ReplicationTask, Base, engine, SessionLocal, config
+from common import ReplicationTask, ReplicationBatch, Base, engine, SessionLocal, config
+from sqlalchemy.orm import load_only
 
 # Basic logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -92,7 +105,7 @@ app = Flask(__name__)
 
 # Configure persistent job store using SQLite
 jobstores = {
-    'default': SQLAlchemyJobStore(url='sqlite:///jobs.sqlite') # Store jobs in jobs.sqlite file
+    'default': SQLAlchemyJobStore(engine=engine) # Store jobs in the task store database (DATABASE_URL)
 }
 scheduler = BackgroundScheduler(jobstores=jobstores, daemon=True) # Use the configured job store
 replication_tasks = {} # Store details about ongoing replications {source_host_id: ReplicationTask object}
@@ -100,24 +113,8 @@ replication_tasks = {} # Store details about ongoing replications {source_host_i
 # Initialize Faker
 fake = Faker()
 
-# --- Global Configuration for Item Skipping ---
-SKIP_KEY_PREFIXES = ['MTR'] # Keys starting with these prefixes will be skipped
-
-def should_skip_item(item_name, item_key):
-    """
-    Determines if an item should be skipped based on predefined rules.
-    """
-    # Rule 1: Skip items with '<' in their name (dynamic interfaces)
-    if '<' in item_name and '>' in item_name:
-        logging.info(f"Skipping item '{item_name}' (key: {item_key}) due to dynamic interface pattern '<...>' in name.")
-        return True
-
-    # Rule 2: Skip items whose key starts with any of the defined prefixes
-    for prefix in SKIP_KEY_PREFIXES:
-        if item_key.startswith(prefix):
-            logging.info(f"Skipping item '{item_name}' (key: {item_key}) as its key starts with '{prefix}'.")
-            return True
-    return False
+# Item skipping rules and source API options are shared with the history fetcher
+from common import SKIP_KEY_PREFIXES, should_skip_item, source_api_options
 
 # --- Obfuscation Functions ---
 def generate_fake_hostname():
@@ -130,10 +127,14 @@ def generate_fake_ip_address():
 
 # --- Helper Functions ---
 
-def map_entities_by_name(source_entities, dest_entities_func, entity_name_key='name', entity_id_key='groupid', entity_type='group', zapi=None):
-    """Maps source entities (like groups or templates) to destination IDs by name. Creates missing entities if needed."""
-    dest_entities = dest_entities_func()
-    dest_map = {entity[entity_name_key]: entity[entity_id_key] for entity in dest_entities}
+def map_entities_by_name(source_entities, dest_zapi, entity_type='group', create_missing=False):
+    """
+    Maps source entities (like groups or templates) to destination IDs by name, using the
+    cached destination metadata. Creates missing entities if create_missing is set.
+    """
+    entity_name_key = 'name'
+    entity_id_key = ENTITY_KINDS[entity_type][2]
+    dest_map = dest_metadata_cache.get_map(dest_zapi, entity_type)
     mapped_ids = []
     missing = []
 
@@ -144,21 +145,29 @@ def map_entities_by_name(source_entities, dest_entities_func, entity_name_key='n
         if dest_id:
             mapped_ids.append({entity_id_key: dest_id})
         else:
-            # Try to create missing entity if we have API access
-            if zapi:
+            # Try to create missing entity if allowed
+            if create_missing:
                 try:
                     if entity_type == 'group':
-                        new_entity = zapi.hostgroup.create({"name": source_name})
+                        new_entity = dest_zapi.hostgroup.create({"name": source_name})
                     elif entity_type == 'template':
-                        new_entity = zapi.template.create({"host": source_name, "groups": {"groupid": "1"}})
+                        new_entity = dest_zapi.template.create({"host": source_name, "groups": {"groupid": "1"}})
                     else:
                         raise ValueError(f"Unsupported entity type: {entity_type}")
 
                     new_id = new_entity[f"{entity_type}ids"][0]
+                    dest_metadata_cache.register(dest_zapi, entity_type, source_name, new_id)
                     mapped_ids.append({entity_id_key: new_id})
                     #logging.info(f"Created missing {entity_type}: {source_name} with ID {new_id}")
                     continue
                 except Exception as e:
+                    if "already exists" in str(e):
+                        # Created since the cached snapshot was taken (e.g. by another worker)
+                        dest_metadata_cache.invalidate(dest_zapi, entity_type)
+                        dest_id = dest_metadata_cache.lookup(dest_zapi, entity_type, source_name)
+                        if dest_id:
+                            mapped_ids.append({entity_id_key: dest_id})
+                            continue
                     logging.error(f"Failed to create {entity_type} '{source_name}': {e}")
 
             missing.append(source_name)
@@ -168,6 +177,28 @@ def map_entities_by_name(source_entities, dest_entities_func, entity_name_key='n
         logging.warning(f"Could not find/create the following destination {entity_type}s: {', '.join(missing)}")
     return mapped_ids
 
+def ensure_dest_group(dest_zapi, group_name):
+    """Returns the ID of a destination host group, creating the group if it doesn't exist."""
+    group_id = dest_metadata_cache.lookup(dest_zapi, 'group', group_name)
+    if group_id:
+        logging.debug(f"Found existing group '{group_name}' with ID: {group_id}")
+        return group_id
+    try:
+        new_group = dest_zapi.hostgroup.create({"name": group_name})
+    except Exception as e:
+        if "already exists" not in str(e):
+            raise
+        # Created since the cached snapshot was taken (e.g. by another worker)
+        dest_metadata_cache.invalidate(dest_zapi, 'group')
+        group_id = dest_metadata_cache.lookup(dest_zapi, 'group', group_name)
+        if not group_id:
+            raise
+        return group_id
+    group_id = new_group['groupids'][0]
+    dest_metadata_cache.register(dest_zapi, 'group', group_name, group_id)
+    logging.info(f"Created missing group '{group_name}' with ID: {group_id}")
+    return group_id
+
 def modify_items_to_trapper(source_items):
     """Modifies a list of item configurations to be Zabbix Trapper type."""
     modified_items = []
@@ -219,11 +250,10 @@ def check_and_map_existing_host(host_name, all_source_items, dest_zapi):
     source_items_map_by_key = {item['key_']: item['itemid'] for item in all_source_items}
     logging.debug(f"Built source_items_map_by_key with {len(source_items_map_by_key)} entries from all_source_items.")
 
-    existing_hosts = dest_zapi.host.get(filter={"host": [host_name]}, output=['hostid'])
-    if not existing_hosts:
+    existing_host_id = dest_metadata_cache.lookup(dest_zapi, 'host', host_name)
+    if not existing_host_id:
         return None, {} # Host does not exist
 
-    existing_host_id = existing_hosts[0]['hostid']
     logging.info(f"Host '{host_name}' already exists on destination with ID {existing_host_id}. Building item mapping including inherited items.")
 
     existing_dest_items = dest_zapi.item.get(hostids=existing_host_id, output=['itemid', 'key_'])
@@ -242,50 +272,33 @@ def check_and_map_existing_host(host_name, all_source_items, dest_zapi):
     logging.info(f"Generated item mapping for EXISTING host: {len(item_mapping)} entries.")
     return existing_host_id, item_mapping
 
-def replicate_macros(host_id, source_macros, dest_zapi):
-    """Replicates macros for a given host."""
+def replicate_macros(plan, source_macros):
+    """Adds a host's source macros to its provisioning plan. Existing macros are left as is."""
     if not source_macros:
-        logging.info(f"No macros defined on source host to replicate for host ID {host_id}.")
+        logging.info(f"No macros defined on source host to replicate for host ID {plan.host_id}.")
         return
 
-    logging.info(f"Attempting to replicate {len(source_macros)} macros for host ID {host_id}...")
-    macros_created = 0
-    macros_failed = 0
-
+    logging.info(f"Planning replication of {len(source_macros)} macros for host ID {plan.host_id}...")
     for macro in source_macros:
-        macro_data = {
-            "macro": macro['macro'],
-            "value": macro['value'],
-            "type": macro.get('type', '0'),
-            "description": macro.get('description', ''),
-            "hostid": host_id
-        }
+        plan.add_macro(
+            macro['macro'],
+            macro['value'],
+            update_existing=False,
+            type=macro.get('type', '0'),
+            description=macro.get('description', '')
+        )
 
-        try:
-            macro_result = dest_zapi.usermacro.create(macro_data)
-            logging.debug(f"Successfully created macro '{macro['macro']}' for host ID {host_id}: {macro_result}")
-            macros_created += 1
-        except Exception as macro_e:
-            if "already exists" in str(macro_e):
-                logging.warning(f"Macro '{macro['macro']}' already exists for host ID {host_id}. Skipping.")
-            else:
-                logging.error(f"Failed to create macro '{macro['macro']}' for host ID {host_id}: {macro_e}", exc_info=True)
-                macros_failed += 1
-
-    logging.info(f"Macro replication completed for host ID {host_id}: {macros_created} created, {macros_failed} failed.")
-    if macros_failed > 0:
-        logging.warning(f"Some macros failed to replicate for host ID {host_id}. Check logs for details.")
-
-def create_standard_icmp_triggers(dest_zapi, host_id, host_name):
-    """Creates standard ICMP triggers for a host."""
-    logging.info(f"Attempting to create standard ICMP triggers for host '{host_name}' (ID: {host_id})...")
-    create_icmp_trigger(dest_zapi, host_id, host_name)
-    create_icmp_loss_trigger(dest_zapi, host_id, host_name)
-    create_icmp_response_trigger(dest_zapi, host_id, host_name)
-
-def create_interface_triggers(dest_zapi, host_id, host_name, all_source_items):
-    """Creates interface-related triggers (link down, speed change) for a host."""
-    logging.info(f"Attempting to create Interface Link Down and Speed Change triggers for host '{host_name}' (ID: {host_id})...")
+def add_standard_icmp_triggers(plan, host_name):
+    """Adds the standard ICMP triggers to a host's provisioning plan."""
+    plan.add_triggers([
+        icmp_trigger_spec(host_name),
+        icmp_loss_trigger_spec(host_name),
+        icmp_response_trigger_spec(host_name)
+    ])
+
+def add_interface_triggers(plan, host_name, all_source_items):
+    """Adds interface-related triggers (link down, speed change) to a host's provisioning plan."""
+    items_by_key = {item.get('key_'): item for item in all_source_items}
     link_down_trigger_count = 0
     for item in all_source_items:
         item_key = item.get('key_', '')
@@ -293,69 +306,60 @@ def create_interface_triggers(dest_zapi, host_id, host_name, all_source_items):
         match = re.search(r'net\.if\.status\[ifOperStatus\.("?([^"]+)"?|\d+)\]', item_key)
         if match:
             identifier_part = match.group(1)
-            interface_identifier = identifier_part.strip('"')
             interface_name = item_name.split(':')[0].strip() if ':' in item_name else item_name
             interface_name = interface_name.replace("Interface ", "", 1).strip()
 
-            logging.info(f"Found ifOperStatus item for host: Key='{item_key}', Identifier='{interface_name}'")
-            create_interface_link_down_trigger(
-                dest_zapi,
-                host_id,
-                host_name,
-                interface_name,
-                item_key
-            )
+            logging.debug(f"Found ifOperStatus item for host: Key='{item_key}', Identifier='{interface_name}'")
+            plan.add_trigger(interface_link_down_trigger_spec(host_name, interface_name, item_key))
+            link_down_trigger_count += 1
 
-            speed_item_key = None
-            type_item_key = None
             expected_speed_key_ifSpeed = f'net.if.speed[ifSpeed.{identifier_part}]'
             expected_speed_key_ifHighSpeed = f'net.if.speed[ifHighSpeed.{identifier_part}]'
             expected_type_key = f'net.if.type[ifType.{identifier_part}]'
-
-            for source_item in all_source_items:
-                if source_item.get('key_') == expected_speed_key_ifSpeed:
-                    speed_item_key = source_item.get('key_')
-                elif source_item.get('key_') == expected_type_key:
-                    type_item_key = source_item.get('key_')
-                elif source_item.get('key_') == expected_speed_key_ifHighSpeed:
-                    speed_item_key = source_item.get('key_')
+            speed_item_key = next((key for key in (expected_speed_key_ifHighSpeed, expected_speed_key_ifSpeed) if key in items_by_key), None)
+            type_item_key = expected_type_key if expected_type_key in items_by_key else None
 
             if speed_item_key and type_item_key:
-                create_interface_speed_change_trigger(
-                    dest_zapi,
-                    host_id,
-                    host_name,
-                    interface_name,
-                    speed_item_key,
-                    item_key,
-                    type_item_key
-                )
-                link_down_trigger_count += 1
+                plan.add_trigger(interface_speed_change_trigger_spec(host_name, interface_name, speed_item_key, item_key, type_item_key))
             else:
                 logging.warning(f"Could not find corresponding speed ({expected_speed_key_ifSpeed} or {expected_speed_key_ifHighSpeed}) or type ({expected_type_key}) item for interface '{interface_name}'. Skipping speed change trigger creation.")
 
-    logging.info(f"Attempted creation of {link_down_trigger_count} Interface Link Down triggers based on found ifOperStatus items.")
+    logging.info(f"Planned {link_down_trigger_count} Interface Link Down triggers for host '{host_name}' based on found ifOperStatus items.")
 
-def create_cpu_utilization_trigger_for_host(dest_zapi, host_id, host_name, all_source_items):
-    """Creates CPU utilization trigger for a host if a relevant item exists."""
-    logging.info(f"Attempting to create CPU utilization trigger for host '{host_name}' (ID: {host_id})...")
+def add_cpu_utilization_triggers(plan, host_name, all_source_items):
+    """Adds a CPU utilization trigger per CPU item to a host's provisioning plan."""
     for item in all_source_items:
         item_key = item.get('key_', '')
-        match = re.search(r'system\.cpu\.util\[(.*?)\]', item_key)
-        if match:
-            create_cpu_utilization_trigger(dest_zapi, host_id, host_name)
-            return # Assuming one CPU trigger is sufficient
+        if re.search(r'system\.cpu\.util\[(.*?)\]', item_key):
+            plan.add_trigger(cpu_utilization_trigger_spec(host_name, item_key))
 
-def create_temperature_critical_trigger_for_host(dest_zapi, host_id, host_name, all_source_items):
-    """Creates temperature critical trigger for a host if a relevant item exists."""
-    logging.info(f"Attempting to create temperature critical trigger for host '{host_name}' (ID: {host_id})...")
+def add_temperature_critical_trigger(plan, host_name, all_source_items):
+    """Adds the temperature critical trigger to a host's provisioning plan if a relevant item exists."""
     for item in all_source_items:
         item_key = item.get('key_', '')
-        match = re.search(r'sensor\.temp\.value\[(.*?)\]', item_key)
-        if match:
-            create_temperature_critical_trigger(dest_zapi, host_id, host_name, item_key)
+        if re.search(r'sensor\.temp\.value\[(.*?)\]', item_key):
+            plan.add_trigger(temperature_critical_trigger_spec(host_name, item_key))
             return # Assuming one temperature trigger is sufficient
 
+def provision_host_macros_and_triggers(dest_zapi, host_id, host_name, source_macros, all_source_items):
+    """
+    Replicates macros and creates the standard triggers for a destination host.
+
+    Everything is collected into one HostProvisioningPlan and applied with bulk API calls,
+    so the number of calls does not grow with the host's interfaces, CPUs or macros.
+    """
+    logging.info(f"Provisioning macros and triggers for host '{host_name}' (ID: {host_id})...")
+    plan = HostProvisioningPlan(dest_zapi, host_id, host_name, config.get('item_create_batch_size', 200))
+    replicate_macros(plan, source_macros)
+    add_standard_icmp_triggers(plan, host_name)
+    add_interface_triggers(plan, host_name, all_source_items)
+    add_cpu_utilization_triggers(plan, host_name, all_source_items)
+    add_temperature_critical_trigger(plan, host_name, all_source_items)
+    summary = plan.apply()
+    if summary['failed'] > 0:
+        logging.warning(f"Some macros or triggers failed to provision for host ID {host_id}. Check logs for details.")
+    return summary
+
 def create_direct_host_items_as_trappers(dest_zapi, dest_host_id, modified_items, source_items_map_by_key):
     """Creates direct host items as trappers on the destination and builds item mapping."""
     item_mapping = {}
@@ -366,22 +370,24 @@ def create_direct_host_items_as_trappers(dest_zapi, dest_host_id, modified_items
     logging.info(f"Attempting to create/update {len(modified_items)} direct host items (as trappers) for new host ID {dest_host_id}...")
     successfully_created_keys = set()
     for item_to_create in modified_items:
+        item_to_create['hostid'] = dest_host_id
+
+    # Items are created in batches with the array form of item.create; failed batches are
+    # bisected so only the items that caused the error are reported
+    started = time.time()
+    create_results = bulk_create(dest_zapi.item.create, modified_items, 'itemids', config.get('item_create_batch_size', 200), label="item")
+    for item_to_create, result in zip(modified_items, create_results):
         item_key = item_to_create.get('key_')
         item_name = item_to_create.get('name')
-        try:
-            item_to_create['hostid'] = dest_host_id
-            create_result = dest_zapi.item.create(item_to_create)
-            if create_result and 'itemids' in create_result and create_result['itemids']:
-                logging.debug(f"Successfully created item '{item_name}' (Key: {item_key})")
-                successfully_created_keys.add(item_key)
-            else:
-                 logging.error(f"Failed to create item '{item_name}' (Key: {item_key}): API response missing itemids. Response: {create_result}")
-        except Exception as e:
-            if "already exists" in str(e):
-                 logging.warning(f"Item '{item_name}' (Key: {item_key}) already exists on host {dest_host_id}. Assuming it's usable.")
-                 successfully_created_keys.add(item_key)
-            else:
-                 logging.error(f"Failed to create item '{item_name}' (Key: {item_key}): {e}")
+        if not isinstance(result, Exception):
+            logging.debug(f"Successfully created item '{item_name}' (Key: {item_key})")
+            successfully_created_keys.add(item_key)
+        elif "already exists" in str(result):
+            logging.warning(f"Item '{item_name}' (Key: {item_key}) already exists on host {dest_host_id}. Assuming it's usable.")
+            successfully_created_keys.add(item_key)
+        else:
+            logging.error(f"Failed to create item '{item_name}' (Key: {item_key}): {result}")
+    logging.info(f"Created {len(successfully_created_keys)}/{len(modified_items)} items in {time.time() - started:.1f}s.")
 
     logging.info(f"Building item mapping based on {len(successfully_created_keys)} successfully created/found items.")
     for dest_key in successfully_created_keys:
@@ -411,11 +417,7 @@ def create_destination_host(source_host_config, all_source_items, dest_group_ids
 
     if existing_host_id:
         # Host exists, replicate macros and create triggers
-        replicate_macros(existing_host_id, source_host_config.get('macros', []), dest_zapi)
-        create_standard_icmp_triggers(dest_zapi, existing_host_id, obfuscated_host_name)
-        create_interface_triggers(dest_zapi, existing_host_id, obfuscated_host_name, all_source_items)
-        create_cpu_utilization_trigger_for_host(dest_zapi, existing_host_id, obfuscated_host_name, all_source_items)
-        create_temperature_critical_trigger_for_host(dest_zapi, existing_host_id, obfuscated_host_name, all_source_items)
+        provision_host_macros_and_triggers(dest_zapi, existing_host_id, obfuscated_host_name, source_host_config.get('macros', []), all_source_items)
         return existing_host_id, item_mapping
 
     # Host does NOT exist, proceed with creation
@@ -490,6 +492,7 @@ def create_destination_host(source_host_config, all_source_items, dest_group_ids
              raise ValueError(f"API response error during host creation: {result.get('error', 'Unknown error')}")
 
         dest_host_id = result['hostids'][0]
+        dest_metadata_cache.register(dest_zapi, 'host', obfuscated_host_name, dest_host_id)
         logging.info(f"Successfully created host '{obfuscated_host_name}' on destination with ID: {dest_host_id}")
 
         # Create items and build mapping
@@ -499,11 +502,7 @@ def create_destination_host(source_host_config, all_source_items, dest_group_ids
         # Add the {$SOURCE_HOST_ID} macro to the list of macros to be replicated
         macros_to_replicate = source_host_config.get('macros', [])
         macros_to_replicate.append({"macro": "{$SOURCE_HOST_ID}", "value": source_host_config['hostid']})
-        replicate_macros(dest_host_id, macros_to_replicate, dest_zapi)
-        create_standard_icmp_triggers(dest_zapi, dest_host_id, obfuscated_host_name)
-        create_interface_triggers(dest_zapi, dest_host_id, obfuscated_host_name, all_source_items)
-        create_cpu_utilization_trigger_for_host(dest_zapi, dest_host_id, obfuscated_host_name, all_source_items)
-        create_temperature_critical_trigger_for_host(dest_zapi, dest_host_id, obfuscated_host_name, all_source_items)
+        provision_host_macros_and_triggers(dest_zapi, dest_host_id, obfuscated_host_name, macros_to_replicate, all_source_items)
 
         return dest_host_id, item_mapping, obfuscated_host_name
 
@@ -511,17 +510,14 @@ def create_destination_host(source_host_config, all_source_items, dest_group_ids
         logging.error(f"Failed to create host '{obfuscated_host_name}' on destination: {e}", exc_info=True)
         if "already exists" in str(e):
             logging.warning(f"Host '{obfuscated_host_name}' reported as existing during creation attempt. Attempting to find its ID and existing items.")
+            dest_metadata_cache.invalidate(dest_zapi, 'host') # The cached host list is out of date
             existing_host_id, item_mapping = check_and_map_existing_host(obfuscated_host_name, all_source_items, dest_zapi)
             if existing_host_id:
                 logging.info(f"Found existing host '{obfuscated_host_name}' with ID: {existing_host_id} after creation failure.")
                 # Replicate macros and create triggers for the found existing host
-                replicate_macros(existing_host_id, source_host_config.get('macros', []), dest_zapi)
                 # Also ensure the SOURCE_HOST_ID macro is set for existing hosts
-                replicate_macros(existing_host_id, [{"macro": "{$SOURCE_HOST_ID}", "value": source_host_config['hostid']}], dest_zapi)
-                create_standard_icmp_triggers(dest_zapi, existing_host_id, obfuscated_host_name)
-                create_interface_triggers(dest_zapi, existing_host_id, obfuscated_host_name, all_source_items)
-                create_cpu_utilization_trigger_for_host(dest_zapi, existing_host_id, obfuscated_host_name, all_source_items)
-                create_temperature_critical_trigger_for_host(dest_zapi, existing_host_id, obfuscated_host_name, all_source_items)
+                macros_to_replicate = source_host_config.get('macros', []) + [{"macro": "{$SOURCE_HOST_ID}", "value": source_host_config['hostid']}]
+                provision_host_macros_and_triggers(dest_zapi, existing_host_id, obfuscated_host_name, macros_to_replicate, all_source_items)
                 return existing_host_id, item_mapping
             else:
                 logging.error(f"Host '{obfuscated_host_name}' reported as existing, but could not retrieve its ID after creation failure.")
@@ -533,82 +529,6 @@ def create_destination_host(source_host_config, all_source_items, dest_group_ids
             raise # Re-raise other Zabbix API errors
 
 
-def get_history_value_type(item_value_type):
-    """Maps Zabbix item value_type to history table type for history.get."""
-    # Zabbix value types: 0 = numeric float, 1 = character, 2 = log, 3 = numeric unsigned, 4 = text
-    mapping = {
-        '0': 0, # Numeric float -> history
-        '3': 3, # Numeric unsigned -> history_uint
-        '1': 1, # Character -> history_str
-        '4': 4, # Text -> history_text
-        '2': 2, # Log -> history_log
-    }
-    return mapping.get(str(item_value_type)) # Ensure input is string for lookup
-
-def fetch_history(source_items, source_zapi, time_from=None):
-    """Fetches history for the given source items within a specified time range."""
-    history_data = {} # Store as {source_itemid: [{clock: ts, value: val}, ...]}
-    item_ids_by_type = {} # Group item IDs by history value type
-
-    for item in source_items:
-        item_id = item['itemid']
-        item_name = item.get('name', '')
-        item_key = item.get('key_', '')
-
-        # Check if item should be skipped based on predefined rules
-        if should_skip_item(item_name, item_key):
-            continue
-
-        value_type = item['value_type']
-        history_type = get_history_value_type(value_type)
-
-        if history_type is None:
-            logging.warning(f"Item '{item_name}' (ID: {item_id}, Key: {item_key}) has value type {value_type} which cannot be fetched via history.get. Skipping history fetch.")
-            continue
-
-        if history_type not in item_ids_by_type:
-            item_ids_by_type[history_type] = []
-        item_ids_by_type[history_type].append(item_id)
-        history_data[item_id] = [] # Initialize list for this item's history
-
-    time_till = int(time.time())
-    if time_from is None:
-        # Default to last 2 hours if no time_from is provided (for initial fetch)
-        time_from = time_till - (12 * 60 * 60)
-
-    # Fetch history for each type
-    for history_type, item_ids in item_ids_by_type.items():
-        try:
-            history_result = source_zapi.history.get(
-                output="extend",
-                history=history_type,
-                itemids=item_ids,
-                time_from=time_from,
-                time_till=time_till,
-                sortfield="clock",
-                sortorder="ASC"
-            )
-
-            # Organize history by itemid
-            for record in history_result:
-                item_id = record['itemid']
-                if item_id in history_data:
-                     # Store only clock and value, convert clock to int
-                    history_data[item_id].append({
-                        "clock": int(record['clock']),
-                        "value": record['value']
-                    })
-
-        except Exception as e:
-            logging.error(f"Error fetching history for item IDs {item_ids}: {e}", exc_info=True)
-            # Handle specific Zabbix API errors if needed
-            # For now, just log and continue
-            continue
-
-    total_records = sum(len(v) for v in history_data.values())
-    return history_data
-
-
 # --- Flask Routes ---
 
 @app.route('/')
@@ -676,7 +596,7 @@ def get_source_hosts():
     try:
         #logging.info(f"Connecting to source Zabbix API at {config['source_url']}")
         # Use url keyword and login with token
-        zapi = ZabbixAPI(url=config["source_url"], skip_version_check=True)
+        zapi = ZabbixAPI(url=config["source_url"], skip_version_check=True, **source_api_options())
         zapi.login(token=config["source_token"])
 
         # Fetch hosts - only need hostid and name for the dropdown
@@ -696,394 +616,570 @@ def get_source_hosts():
         return jsonify({"error": f"Failed to fetch source hosts: {e}"}), 500
 
 
-@app.route('/api/replicate', methods=['POST'])
-def replicate_host():
-    """Initiates the replication process for a selected host."""
-    # Use a database session
-    db = SessionLocal()
-    try:
-        # Check for full configuration including tokens
-        if not all(config.get(k) for k in ["source_url", "source_token", "dest_url", "dest_token"]):
-            return jsonify({"error": "Zabbix source or destination is not fully configured (URL/Token)."}), 400
-
-        data = request.get_json()
-        source_host_id = data.get('hostid')
-        if not source_host_id:
-            return jsonify({"error": "Missing 'hostid' in request."}), 400
+def parse_replay_options(data):
+    """
+    Validates the optional per-task replay settings of a replication request.
 
-        # Check if a task for this host already exists in the database and is not failed
-        existing_task = db.query(ReplicationTask).filter(ReplicationTask.source_host_id == source_host_id).first()
-        if existing_task and existing_task.status != 'failed':
-             return jsonify({"message": f"Replication for host ID {source_host_id} is already in progress or completed."}), 202 # Accepted
+    Returns:
+        tuple: ({replay_mode, replay_speed, rate_limit}, None) or (None, error message)
+    """
+    replay_mode = data.get('replay_mode') # Optional per-task override of REPLAY_MODE
+    if replay_mode not in (None, 'tick', 'timed'):
+        return None, "Invalid 'replay_mode', expected 'tick' or 'timed'."
+    replay_speed = data.get('replay_speed') # Optional per-task override of REPLAY_SPEED (timed mode)
+    if replay_speed is not None:
+        try:
+            replay_speed = float(replay_speed)
+        except (TypeError, ValueError):
+            replay_speed = 0
+        if replay_speed <= 0:
+            return None, "Invalid 'replay_speed', expected a positive number."
+    rate_limit = data.get('rate_limit') # Optional values/s quota for this task
+    if rate_limit is not None:
+        try:
+            rate_limit = float(rate_limit)
+        except (TypeError, ValueError):
+            rate_limit = 0
+        if rate_limit <= 0:
+            return None, "Invalid 'rate_limit', expected a positive number of values per second."
+    return {"replay_mode": replay_mode, "replay_speed": replay_speed, "rate_limit": rate_limit}, None
+
+def prepare_replication_task(db, source_host_id, options, status="starting", message="Initiating replication...", batch_id=None):
+    """
+    Creates the task for a host, or resets a failed one, with the current Zabbix API config.
 
-        # Create or update the task in the database
-        if existing_task:
-            task = existing_task
-            task.status = "starting"
-            task.message = "Initiating replication..."
-            task.start_time = time.time()
-            task.cycle_offset = 0 # Reset offset on restart/re-initiation
-            task.last_sent_index = {} # Reset index on restart/re-initiation
-            task.progress = 0.0 # Reset progress
+    Returns:
+        ReplicationTask: The task, or None if a replication for the host is already in progress or completed
+    """
+    # Check if a task for this host already exists in the database and is not failed
+    existing_task = db.query(ReplicationTask).filter(ReplicationTask.source_host_id == source_host_id).first()
+    if existing_task and existing_task.status != 'failed':
+        return None
+
+    # Create or update the task in the database
+    if existing_task:
+        task = existing_task
+        task.status = status
+        task.message = message
+        task.start_time = time.time()
+        task.cycle_offset = 0 # Reset replay cursor on restart/re-initiation
+        task.cycle_item_offset = 0
+        task.replayed_until = None
+        task.replayed_itemid = None
+        task.replayed_seq = None
+        task.cycle_started_at = None
+        bump_history_generation(task)
+        task.replay_mode = options['replay_mode']
+        task.replay_speed = options['replay_speed']
+        task.rate_limit = options['rate_limit']
+        task.batch_id = batch_id
+        task.setup_attempts = 0
+        task.progress = 0.0 # Reset progress
+        # Store current Zabbix API config in the task
+        task.source_url = config["source_url"]
+        task.source_token = config["source_token"]
+        task.dest_url = config["dest_url"]
+        task.dest_token = config["dest_token"]
+    else:
+        task = ReplicationTask(
+            source_host_id=source_host_id,
+            status=status,
+            message=message,
+            start_time=time.time(),
+            cycle_offset=0,
+            cycle_item_offset=0,
+            replay_mode=options['replay_mode'],
+            replay_speed=options['replay_speed'],
+            rate_limit=options['rate_limit'],
+            batch_id=batch_id,
+            setup_attempts=0,
+            progress=0.0,
             # Store current Zabbix API config in the task
-            task.source_url = config["source_url"]
-            task.source_token = config["source_token"]
-            task.dest_url = config["dest_url"]
-            task.dest_token = config["dest_token"]
-        else:
-            task = ReplicationTask(
-                source_host_id=source_host_id,
-                status="starting",
-                message="Initiating replication...",
-                start_time=time.time(),
-                cycle_offset=0,
-                last_sent_index={},
-                progress=0.0,
-                # Store current Zabbix API config in the task
-                source_url=config["source_url"],
-                source_token=config["source_token"],
-                dest_url=config["dest_url"],
-                dest_token=config["dest_token"]
-            )
-            db.add(task)
+            source_url=config["source_url"],
+            source_token=config["source_token"],
+            dest_url=config["dest_url"],
+            dest_token=config["dest_token"]
+        )
+        db.add(task)
+    return task
+
+def run_replication(db, task):
+    """
+    Runs the replication pipeline for a task: destination host setup, history fetch and
+    hand-over to the replay engine. Progress is committed to the task as it goes.
+
+    Raises:
+        Exception: Whatever stopped the replication; the task is marked failed first
+    """
+    source_host_id = task.source_host_id
+    steps = StageTimer(REPLICATION_STEP_SECONDS, label='step')
+    try:
+        steps.start('connect')
+        # Connect to Source Zabbix using task-specific config
+        source_zapi = ZabbixAPI(url=task.source_url, skip_version_check=True, **source_api_options())
+        source_zapi.login(token=task.source_token)
+
+        # Connect to Destination Zabbix using task-specific config
+        dest_zapi = ZabbixAPI(url=task.dest_url, skip_version_check=True)
+        dest_zapi.login(token=task.dest_token)
+
+        # --- 1. Get Source Host Configuration ---
+        steps.start('fetch_source_config')
+        task.status = 'fetching_source_config'
+        task.message = 'Fetching source host configuration...'
         db.commit()
-        db.refresh(task) # Refresh to get the latest state from the database
+        # Cached source configuration, only refetched if the host's items or templates changed
+        source_config = source_config_cache.get(source_zapi, source_host_id)
+        source_host_config = source_config.host
+        host_items = source_host_config.get('items', [])
+        source_host_macros = source_host_config.get('macros', []) # Get host macros
+        logging.info(f"Successfully fetched config for source host: {source_host_config['name']} ({len(host_items)} direct items, {len(source_host_macros)} host macros)")
 
-        try:
-            # Connect to Source Zabbix using task-specific config
-            source_zapi = ZabbixAPI(url=task.source_url, skip_version_check=True)
-            source_zapi.login(token=task.source_token)
+        # --- Template Items and Macros ---
+        source_template_macros = source_config.template_macros # Macros from templates
 
-            # Connect to Destination Zabbix using task-specific config
-            dest_zapi = ZabbixAPI(url=task.dest_url, skip_version_check=True)
-            dest_zapi.login(token=task.dest_token)
+        # Combine host and template items, ensuring uniqueness by itemid
+        all_source_items = merge_source_items(source_config)
+        logging.info(f"Total unique source items (host + template): {len(all_source_items)}")
 
-            # --- 1. Get Source Host Configuration ---
-            task.status = 'fetching_source_config'
-            task.message = 'Fetching source host configuration...'
-            db.commit()
-            #logging.info(f"Fetching full configuration for source host ID: {source_host_id}")
-            source_hosts = source_zapi.host.get(
-                hostids=source_host_id,
-                selectGroups=['groupid', 'name'],
-                selectParentTemplates=['templateid', 'name'],
-                selectInterfaces=['type', 'main', 'useip', 'ip', 'dns', 'port'],
-                selectItems=['itemid', 'name', 'key_', 'type', 'value_type', 'delay', 'history', 'trends', 'units', 'description', 'status', 'flags'], # Add more fields as needed
-                selectMacros='extend', # Fetch host macros
-                # selectDiscoveryRule=True, # Maybe later
-                # selectHostPrototypes=True # Maybe later
-            )
+        # Combine host and template macros, prioritizing host macros in case of duplicates
+        all_source_macros_dict = {macro['macro']: macro for macro in source_template_macros}
+        for macro in source_host_macros:
+             all_source_macros_dict[macro['macro']] = macro # Host macros overwrite template macros
+        all_source_macros = list(all_source_macros_dict.values())
+        logging.info(f"Total unique source macros (host + template): {len(all_source_macros)}")
 
-            if not source_hosts:
-                raise ValueError(f"Source host with ID {source_host_id} not found.")
-            source_host_config = source_hosts[0]
-            host_items = source_host_config.get('items', [])
-            source_host_macros = source_host_config.get('macros', []) # Get host macros
-            logging.info(f"Successfully fetched config for source host: {source_host_config['name']} ({len(host_items)} direct items, {len(source_host_macros)} host macros)")
-
-            # --- Fetch Template Items and Macros ---
-            template_items = []
-            source_template_macros = [] # To store macros from templates
-            template_ids = [t['templateid'] for t in source_host_config.get('parentTemplates', [])]
-            if template_ids:
-                logging.info(f"Fetching items and macros from {len(template_ids)} source templates...")
-                try:
-                    # Fetch items belonging to these templates directly
-                    template_data = source_zapi.template.get(
-                        templateids=template_ids,
-                        output=['templateid', 'name'],
-                        selectItems=['itemid', 'name', 'key_', 'type', 'value_type', 'delay', 'history', 'trends', 'units', 'description', 'status', 'flags'],
-                        selectMacros='extend' # Fetch template macros
-                    )
-                    for template in template_data:
-                        template_items.extend(template.get('items', []))
-                        source_template_macros.extend(template.get('macros', []))
-                    logging.info(f"Fetched {len(template_items)} items and {len(source_template_macros)} macros from templates.")
-                except Exception as e:
-                    logging.warning(f"Could not fetch items or macros from source templates: {e}")
-
-            # Combine host and template items, ensuring uniqueness by itemid
-            all_source_items_dict = {item['itemid']: item for item in host_items}
-            for item in template_items:
-                if item['itemid'] not in all_source_items_dict:
-                    all_source_items_dict[item['itemid']] = item
-            all_source_items = list(all_source_items_dict.values())
-            logging.info(f"Total unique source items (host + template): {len(all_source_items)}")
-
-            # Combine host and template macros, prioritizing host macros in case of duplicates
-            all_source_macros_dict = {macro['macro']: macro for macro in source_template_macros}
-            for macro in source_host_macros:
-                 all_source_macros_dict[macro['macro']] = macro # Host macros overwrite template macros
-            all_source_macros = list(all_source_macros_dict.values())
-            logging.info(f"Total unique source macros (host + template): {len(all_source_macros)}")
-
-
-            # --- 3. Map Group/Template IDs from Source Names to Destination IDs ---
-            task.status = 'mapping_ids'
-            task.message = 'Mapping source groups/templates to destination...'
-            db.commit()
-            #logging.info(f"Mapping groups for host {source_host_config['name']}...")
-            dest_group_ids = map_entities_by_name(
-                source_entities=source_host_config.get('groups', []),
-                dest_entities_func=lambda: dest_zapi.hostgroup.get(output=['groupid', 'name']),
-                entity_name_key='name',
-                entity_id_key='groupid',
-                entity_type='group',
-                zapi=dest_zapi # Pass dest_zapi to allow creation in map_entities_by_name
-            )
 
-            # Ensure 'clonedfordemo' group exists and add it to the list
-            cloned_group_name = 'clonedfordemo'
-            cloned_group = dest_zapi.hostgroup.get(filter={"name": cloned_group_name}, output=['groupid'])
-            cloned_group_id = None
+        # --- 3. Map Group/Template IDs from Source Names to Destination IDs ---
+        steps.start('map_ids')
+        task.status = 'mapping_ids'
+        task.message = 'Mapping source groups/templates to destination...'
+        db.commit()
+        #logging.info(f"Mapping groups for host {source_host_config['name']}...")
+        dest_group_ids = map_entities_by_name(
+            source_entities=source_host_config.get('groups', []),
+            dest_zapi=dest_zapi,
+            entity_type='group',
+            create_missing=True # Create missing groups on the destination
+        )
 
-            if cloned_group:
-                cloned_group_id = cloned_group[0]['groupid']
-                logging.info(f"Found existing group '{cloned_group_name}' with ID: {cloned_group_id}")
+        # Ensure 'clonedfordemo' group exists and add it to the list
+        cloned_group_name = CLONED_GROUP_NAME
+        cloned_group_id = None
+        try:
+            cloned_group_id = ensure_dest_group(dest_zapi, cloned_group_name)
+        except Exception as e:
+            logging.error(f"Failed to create group '{cloned_group_name}': {e}")
+            # Decide how to handle this failure - for now, just log and continue without this group
+
+        # Add the 'clonedfordemo' group ID to the list if it exists or was created
+        if cloned_group_id:
+            # Check if the group is already in the list (from source mapping)
+            if not any(g['groupid'] == cloned_group_id for g in dest_group_ids):
+                dest_group_ids.append({"groupid": cloned_group_id})
+                logging.info(f"Added group '{cloned_group_name}' (ID: {cloned_group_id}) to destination groups.")
             else:
-                try:
-                    new_group = dest_zapi.hostgroup.create({"name": cloned_group_name})
-                    cloned_group_id = new_group['groupids'][0]
-                    logging.info(f"Created missing group '{cloned_group_name}' with ID: {cloned_group_id}")
-                except Exception as e:
-                    logging.error(f"Failed to create group '{cloned_group_name}': {e}")
-                    # Decide how to handle this failure - for now, just log and continue without this group
-
-            # Add the 'clonedfordemo' group ID to the list if it exists or was created
-            if cloned_group_id:
-                # Check if the group is already in the list (from source mapping)
-                if not any(g['groupid'] == cloned_group_id for g in dest_group_ids):
-                    dest_group_ids.append({"groupid": cloned_group_id})
-                    logging.info(f"Added group '{cloned_group_name}' (ID: {cloned_group_id}) to destination groups.")
-                else:
-                    logging.info(f"Group '{cloned_group_name}' (ID: {cloned_group_id}) was already in the list from source mapping.")
+                logging.info(f"Group '{cloned_group_name}' (ID: {cloned_group_id}) was already in the list from source mapping.")
 
 
-            if not dest_group_ids:
-                # Fallback: Add to default 'Zabbix servers' group if no source groups were mapped
-                default_groups = dest_zapi.hostgroup.get(filter={"name": "Zabbix servers"}, output=['groupid'])
-                if not default_groups:
-                    # Create default group if it doesn't exist
-                    default_group = dest_zapi.hostgroup.create({"name": "Zabbix servers"})
-                    dest_group_ids = [{"groupid": default_group['groupids'][0]}]
-                else:
-                    dest_group_ids = [{"groupid": default_groups[0]['groupid']}]
-                logging.warning(f"Using fallback group 'Zabbix servers' for host {source_host_config['name']}")
-
-            dest_template_ids = map_entities_by_name(
-                source_entities=source_host_config.get('parentTemplates', []),
-                dest_entities_func=lambda: dest_zapi.template.get(output=['templateid', 'name']),
-                entity_name_key='name',
-                entity_id_key='templateid',
-                entity_type='template'
-            )
+        if not dest_group_ids:
+            # Fallback: Add to default 'Zabbix servers' group if no source groups were mapped
+            # Create default group if it doesn't exist
+            dest_group_ids = [{"groupid": ensure_dest_group(dest_zapi, "Zabbix servers")}]
+            logging.warning(f"Using fallback group 'Zabbix servers' for host {source_host_config['name']}")
 
-            # --- 4. Modify DIRECT HOST Items to Trapper Type ---
-            # We only modify direct host items, not template items.
-            task.status = 'modifying_items'
-            task.message = 'Modifying direct host items to trapper type...'
-            db.commit()
-            logging.info(f"Modifying {len(host_items)} direct host items for {source_host_config['name']} to trapper type...")
-            modified_items = modify_items_to_trapper(host_items) # Use host_items here
-            if not modified_items:
-                logging.warning(f"No suitable direct host items found or modified for host {source_host_config['name']}. Only template items might exist on destination.")
-
-            # --- 5. Create Host on Destination ---
-            task.status = 'creating_dest_host'
-            task.message = 'Creating host on destination Zabbix...'
-            db.commit()
-            #logging.info(f"Creating host on destination Zabbix: Parameters: {source_host_config}, Groups: {dest_group_ids}, Templates: {dest_template_ids,}, Items: {modified_items}")
-
-            dest_host_id = None
-            item_mapping = {}
+        dest_template_ids = map_entities_by_name(
+            source_entities=source_host_config.get('parentTemplates', []),
+            dest_zapi=dest_zapi,
+            entity_type='template'
+        )
 
-            try:
-                # Pass the combined list 'all_source_items' to create_destination_host for mapping purposes
-                dest_host_id, item_mapping, actual_dest_host_name = create_destination_host(
-                    source_host_config,
-                    all_source_items, # Pass the combined list here
-                    dest_group_ids,
-                    dest_template_ids,
-                    modified_items, # Still pass only modified direct items for creation
-                    dest_zapi
-                )
-                if not dest_host_id:
-                    logging.error("create_destination_host returned no host ID.")
-                    task.status = 'failed'
-                    task.message = "Host creation failed: No host ID returned."
-                    db.commit()
-                    # Do not raise exception here, allow comparison to run
-                else:
-                    # Store the actual destination host ID and item mapping in the task object
-                    task.dest_host_id = dest_host_id
-                    task.dest_host_name = actual_dest_host_name # Store the obfuscated name for sender
-                    task.item_mapping = item_mapping # Store the initial item mapping
-                    db.commit()
-                    logging.info(f"Successfully created host with ID: {dest_host_id} and stored initial item mapping ({len(item_mapping)} items).")
-
-                    # --- Automatically Rebuild Mapping ---
-                    logging.info(f"Automatically rebuilding item mapping for new host {source_host_id}...")
-                    rebuild_success, rebuild_message = perform_mapping_rebuild(source_host_id, dest_host_id, source_zapi, dest_zapi, db)
-                    if rebuild_success:
-                        logging.info(f"Automatic mapping rebuild successful: {rebuild_message}")
-                        # The perform_mapping_rebuild function commits the changes to the DB
-                    else:
-                        logging.error(f"Automatic mapping rebuild failed: {rebuild_message}")
-                        # Decide how to handle failure here - maybe set task status to warning?
-                        # For now, just log the error. The task status remains 'creating_dest_host' or moves on.
-                        # If the initial creation succeeded, we don't want to mark the whole task as failed just for rebuild failure.
+        # --- 4. Modify DIRECT HOST Items to Trapper Type ---
+        # We only modify direct host items, not template items.
+        steps.start('modify_items')
+        task.status = 'modifying_items'
+        task.message = 'Modifying direct host items to trapper type...'
+        db.commit()
+        logging.info(f"Modifying {len(host_items)} direct host items for {source_host_config['name']} to trapper type...")
+        modified_items = modify_items_to_trapper(host_items) # Use host_items here
+        if not modified_items:
+            logging.warning(f"No suitable direct host items found or modified for host {source_host_config['name']}. Only template items might exist on destination.")
+
+        # --- 5. Create Host on Destination ---
+        steps.start('create_dest_host') # Host, trapper items, macros and triggers
+        task.status = 'creating_dest_host'
+        task.message = 'Creating host on destination Zabbix...'
+        db.commit()
+        #logging.info(f"Creating host on destination Zabbix: Parameters: {source_host_config}, Groups: {dest_group_ids}, Templates: {dest_template_ids,}, Items: {modified_items}")
 
+        dest_host_id = None
+        item_mapping = {}
 
-            except Exception as e:
+        try:
+            # Pass the combined list 'all_source_items' to create_destination_host for mapping purposes
+            dest_host_id, item_mapping, actual_dest_host_name = create_destination_host(
+                source_host_config,
+                all_source_items, # Pass the combined list here
+                dest_group_ids,
+                dest_template_ids,
+                modified_items, # Still pass only modified direct items for creation
+                dest_zapi
+            )
+            if not dest_host_id:
+                logging.error("create_destination_host returned no host ID.")
                 task.status = 'failed'
-                task.message = f"Host creation failed: {e}"
+                task.message = "Host creation failed: No host ID returned."
                 db.commit()
-                logging.error(f"Failed during destination host creation/mapping: {e}", exc_info=True)
-                # Set status to failed and do not attempt further mapping here,
-                # as create_destination_host already handles existing hosts.
-                dest_host_id = None
-                item_mapping = {}
-                # Ensure the potentially incorrect mapping isn't stored
-                task.item_mapping = {}
+                # Do not raise exception here, allow comparison to run
+            else:
+                # Store the actual destination host ID and item mapping in the task object
+                task.dest_host_id = dest_host_id
+                task.dest_host_name = actual_dest_host_name # Store the obfuscated name for sender
+                set_task_item_mapping(task, item_mapping) # Store the initial item mapping and its problem classification
                 db.commit()
+                logging.info(f"Successfully created host with ID: {dest_host_id} and stored initial item mapping ({len(item_mapping)} items).")
+
+                # --- Automatically Rebuild Mapping ---
+                logging.info(f"Automatically rebuilding item mapping for new host {source_host_id}...")
+                rebuild_success, rebuild_message = perform_mapping_rebuild(source_host_id, dest_host_id, source_zapi, dest_zapi, db,
+                                                                           source_items=source_config.host_items)
+                if rebuild_success:
+                    logging.info(f"Automatic mapping rebuild successful: {rebuild_message}")
+                    # The perform_mapping_rebuild function commits the changes to the DB
+                else:
+                    logging.error(f"Automatic mapping rebuild failed: {rebuild_message}")
+                    # Decide how to handle failure here - maybe set task status to warning?
+                    # For now, just log the error. The task status remains 'creating_dest_host' or moves on.
+                    # If the initial creation succeeded, we don't want to mark the whole task as failed just for rebuild failure.
 
 
-            # --- Diagnostic section removed ---
-
-            # --- 6. Fetch Source History (Last 24 hours) ---
-            # or if host creation failed.
-            task.status = 'comparing_items'
-            task.message = 'Comparing source and destination items...'
+        except Exception as e:
+            task.status = 'failed'
+            task.message = f"Host creation failed: {e}"
+            db.commit()
+            logging.error(f"Failed during destination host creation/mapping: {e}", exc_info=True)
+            # Set status to failed and do not attempt further mapping here,
+            # as create_destination_host already handles existing hosts.
+            dest_host_id = None
+            item_mapping = {}
+            # Ensure the potentially incorrect mapping isn't stored
+            set_task_item_mapping(task, {})
             db.commit()
 
-            if dest_host_id: # Only compare if destination host ID was obtained
-                source_items_full = source_zapi.item.get(hostids=source_host_id, output=['itemid', 'name', 'key_'])
-                source_items_map_by_key = {item['key_']: item['itemid'] for item in source_items_full}
-                source_items_map_by_id = {item['itemid']: item for item in source_items_full}
 
-                dest_items_full = dest_zapi.item.get(hostids=dest_host_id, output=['itemid', 'name', 'key_'])
-                dest_items_map_by_key = {item['key_']: item for item in dest_items_full}
+        # --- Diagnostic section removed ---
+
+        # --- 6. Fetch Source History (Last 24 hours) ---
+        # or if host creation failed.
+        steps.start('compare_items')
+        task.status = 'comparing_items'
+        task.message = 'Comparing source and destination items...'
+        db.commit()
 
-                missing_on_destination = []
-                key_mismatches = []
+        if dest_host_id: # Only compare if destination host ID was obtained
+            source_items_full = source_config.host_items
+            source_items_map_by_key = {item['key_']: item['itemid'] for item in source_items_full}
+            source_items_map_by_id = {item['itemid']: item for item in source_items_full}
 
-                for source_item in source_items_full:
-                    source_item_id = source_item['itemid']
-                    source_item_key = source_item['key_']
-                    source_item_name = source_item['name']
+            dest_items_full = dest_zapi.item.get(hostids=dest_host_id, output=['itemid', 'name', 'key_'])
+            dest_items_map_by_key = {item['key_']: item for item in dest_items_full}
 
-                    if source_item_key not in dest_items_map_by_key:
-                        missing_on_destination.append(f"Source ID: {source_item_id}, Key: {source_item_key}, Name: {source_item_name}")
-                    else:
-                        # Optional: Check for name mismatch if keys match
-                        dest_item = dest_items_map_by_key[source_item_key]
-                        if dest_item['name'] != source_item_name:
-                             key_mismatches.append(f"Source ID: {source_item_id}, Key: {source_item_key}, Source Name: {source_item_name}, Dest Name: {dest_item['name']}")
+            missing_on_destination = []
+            key_mismatches = []
 
+            for source_item in source_items_full:
+                source_item_id = source_item['itemid']
+                source_item_key = source_item['key_']
+                source_item_name = source_item['name']
 
-                logging.info("--- Item Comparison Results ---")
-                if missing_on_destination:
-                    logging.warning(f"The following {len(missing_on_destination)} source items were not found on the destination by key:")
-                    for item_info in missing_on_destination:
-                        logging.warning(f"- {item_info}")
+                if source_item_key not in dest_items_map_by_key:
+                    missing_on_destination.append(f"Source ID: {source_item_id}, Key: {source_item_key}, Name: {source_item_name}")
                 else:
-                    logging.info("All source items found on destination by key.")
+                    # Optional: Check for name mismatch if keys match
+                    dest_item = dest_items_map_by_key[source_item_key]
+                    if dest_item['name'] != source_item_name:
+                         key_mismatches.append(f"Source ID: {source_item_id}, Key: {source_item_key}, Source Name: {source_item_name}, Dest Name: {dest_item['name']}")
 
-                if key_mismatches:
-                    logging.warning(f"The following {len(key_mismatches)} items have matching keys but different names:")
-                    for item_info in key_mismatches:
-                        logging.warning(f"- {item_info}")
 
+            logging.info("--- Item Comparison Results ---")
+            if missing_on_destination:
+                logging.warning(f"The following {len(missing_on_destination)} source items were not found on the destination by key:")
+                for item_info in missing_on_destination:
+                    logging.warning(f"- {item_info}")
             else:
-                logging.warning("Skipping item comparison as destination host ID was not obtained.")
-            # --- End Diagnostic ---
+                logging.info("All source items found on destination by key.")
 
+            if key_mismatches:
+                logging.warning(f"The following {len(key_mismatches)} items have matching keys but different names:")
+                for item_info in key_mismatches:
+                    logging.warning(f"- {item_info}")
 
-            # --- 6. Fetch Source History (Last 24 hours) ---
-            task.status = 'fetching_history'
-            task.message = 'Fetching source item history (last 24h)...'
-            db.commit()
-            logging.info(f"Fetching history for {len(all_source_items)} total items (host + template) of host {source_host_config['name']}...")
-            # Pass the combined list 'all_source_items' to fetch history for all relevant items
-            history_data = fetch_history(all_source_items, source_zapi)
+        else:
+            logging.warning("Skipping item comparison as destination host ID was not obtained.")
+        # --- End Diagnostic ---
+
+
+        # --- 6. Fetch Source History (Last 24 hours) ---
+        steps.start('fetch_history')
+        task.status = 'fetching_history'
+        task.message = 'Fetching source item history (last 24h)...'
+        db.commit()
+        logging.info(f"Fetching history for {len(all_source_items)} total items (host + template) of host {source_host_config['name']}...")
+        # Pass the combined list 'all_source_items' to fetch history for all relevant items
+        # History is written to the history store as it is fetched
+        fetch_started = int(time.time())
+        history_count, first_ts = fetch_history(all_source_items, source_zapi, db, source_host_id,
+                                                stream=HistoryStream.from_config(task.source_url, task.source_token))
+        task.history_fetched_until = fetch_started # Rolling history top-ups continue from here
+        bump_history_generation(task) # Replay caches of earlier history are dropped
+
+        # --- 7. Store History ---
+        steps.start('store_history')
+        task.status = 'storing_data'
+        task.message = f'Stored {history_count} history records.'
+        task.history = None # Drop any legacy JSON history blob
+        db.commit()
 
-            # --- 7. Store History ---
-            task.status = 'storing_data'
-            task.message = 'Storing history data...'
+        # --- 9. Start Background Replay Task ---
+        # Only schedule replay if host creation and mapping were successful
+        if dest_host_id and item_mapping:
+            steps.start('schedule_replay')
+            task.status = 'scheduling_replay'
+            task.message = 'Scheduling data replay task...'
             db.commit()
-            task.history = history_data # Store history in the task object
+            # The earliest timestamp in the history sets the relative start
+            task.first_history_timestamp = first_ts or int(time.time()) # Fallback if no history
             db.commit()
 
-            # --- 9. Start Background Replay Task ---
-            # Only schedule replay if host creation and mapping were successful
-            if dest_host_id and item_mapping:
-                task.status = 'scheduling_replay'
-                task.message = 'Scheduling data replay task...'
-                db.commit()
-                # Find the earliest timestamp in the history to set the relative start
-                first_ts = None
-                for item_id, points in history_data.items():
-                    if points:
-                        ts = points[0]['clock']
-                        if first_ts is None or ts < first_ts:
-                            first_ts = ts
-                task.first_history_timestamp = first_ts or int(time.time()) # Fallback if no history
-                db.commit()
+            # The replay engine job picks up every task in an active replay status
+            task.status = 'replicating'
+            task.message = 'Replication setup complete. Replay task scheduled.'
+            db.commit()
+            logging.info(f"Replication setup complete for source host ID: {source_host_id}")
+            REPLICATIONS.inc(result='succeeded')
+        else:
+            # If host creation or mapping failed, the task status is already set to 'failed'
+            logging.warning(f"Skipping replay job scheduling for source host {source_host_id} due to previous failure.")
+            REPLICATIONS.inc(result='failed')
+        steps.stop()
 
-                try:
-                    # Schedule job to run e.g., every 60 seconds
-                    scheduler.add_job(
-                        replay_job,
-                        trigger='interval',
-                        seconds=60, # Adjust interval as needed
-                        id=f"replay_{source_host_id}", # Explicitly set the job ID
-                        args=[source_host_id], # Pass source_host_id to job
-                        replace_existing=True # Replace if somehow already exists
-                    )
-                    logging.info(f"Successfully scheduled replay job with ID: replay_{source_host_id}")
-                except Exception as sched_e:
-                     logging.error(f"Failed to schedule replay job for {source_host_id}: {sched_e}", exc_info=True)
-                     # This is a critical failure, update task status
-                     task.status = 'failed'
-                     task.message = f"Failed to schedule replay job: {sched_e}"
-                     db.commit()
-                     # Do not raise here, let the function return the current status
-
-                if task.status != 'failed':
-                    task.status = 'replicating'
-                    task.message = 'Replication setup complete. Replay task scheduled.'
-                    db.commit()
-                    logging.info(f"Replication setup complete for source host ID: {source_host_id}")
-            else:
-                # If host creation or mapping failed, the task status is already set to 'failed'
-                logging.warning(f"Skipping replay job scheduling for source host {source_host_id} due to previous failure.")
+        # No logout needed for token auth
 
+    # Catch generic Exception, check message for Zabbix specifics if needed
+    except Exception as e:
+        logging.error(f"Error during replication for host {source_host_id}: {e}", exc_info=True)
+        task.status = 'failed'
+        # Try to provide a slightly more specific message if possible
+        task.message = f"Replication Error: {e}"
+        db.commit()
+        steps.stop()
+        REPLICATIONS.inc(result='failed')
+        raise
+
+@app.route('/api/replicate', methods=['POST'])
+def replicate_host():
+    """Initiates the replication process for a selected host."""
+    # Use a database session
+    db = SessionLocal()
+    try:
+        # Check for full configuration including tokens
+        if not all(config.get(k) for k in ["source_url", "source_token", "dest_url", "dest_token"]):
+            return jsonify({"error": "Zabbix source or destination is not fully configured (URL/Token)."}), 400
 
-            # No logout needed for token auth
+        data = request.get_json()
+        source_host_id = data.get('hostid')
+        if not source_host_id:
+            return jsonify({"error": "Missing 'hostid' in request."}), 400
+        options, error = parse_replay_options(data)
+        if error:
+            return jsonify({"error": error}), 400
 
-            # Return the current status, which might be 'replicating' or 'failed'
-            return jsonify({
-                "message": f"Replication process initiated for host ID {source_host_id}.",
-                "destination_host_id": task.dest_host_id,
-                "status": task.status,
-                "details": task.message
-            })
+        task = prepare_replication_task(db, source_host_id, options)
+        if task is None:
+             return jsonify({"message": f"Replication for host ID {source_host_id} is already in progress or completed."}), 202 # Accepted
+        replication_queue.hold(task) # Marked failed if this process dies during the setup
+        db.commit()
+        db.refresh(task) # Refresh to get the latest state from the database
 
-        # Catch generic Exception, check message for Zabbix specifics if needed
+        try:
+            run_replication(db, task)
         except Exception as e:
-            logging.error(f"Error during replication for host {source_host_id}: {e}", exc_info=True)
-            task.status = 'failed'
-            # Try to provide a slightly more specific message if possible
-            task.message = f"Replication Error: {e}"
-            db.commit()
-            # No logout needed for token auth
             return jsonify({"error": f"Replication failed: {e}"}), 500
+        finally:
+            replication_queue.release(source_host_id)
+
+        # Return the current status, which might be 'replicating' or 'failed'
+        return jsonify({
+            "message": f"Replication process initiated for host ID {source_host_id}.",
+            "destination_host_id": task.dest_host_id,
+            "status": task.status,
+            "details": task.message
+        })
     finally:
         db.close() # Ensure the session is closed
 
+def run_queued_replication(source_host_id):
+    """Runs the replication pipeline for a task claimed from the bulk replication queue."""
+    db = SessionLocal()
+    try:
+        task = db.query(ReplicationTask).filter(ReplicationTask.source_host_id == source_host_id).first()
+        if task is None:
+            logging.warning(f"Queued task for source host {source_host_id} disappeared before it could run.")
+            return
+        run_replication(db, task)
+    finally:
+        db.close()
+
+@app.route('/api/replicate/bulk', methods=['POST'])
+def replicate_hosts_bulk():
+    """
+    Queues the replication of several hosts and returns right away with a batch ID.
+
+    The request names the hosts with 'hostids' and/or source host groups with 'groupids'
+    and may carry the same replay options as /api/replicate. The hosts are set up on the
+    replication worker pool (REPLICATION_WORKERS per process); poll
+    /api/replicate/bulk/<batch_id> for per-host progress.
+    """
+    db = SessionLocal()
+    try:
+        # Check for full configuration including tokens
+        if not all(config.get(k) for k in ["source_url", "source_token", "dest_url", "dest_token"]):
+            return jsonify({"error": "Zabbix source or destination is not fully configured (URL/Token)."}), 400
+
+        data = request.get_json() or {}
+        host_ids = [str(host_id) for host_id in data.get('hostids') or []]
+        group_ids = data.get('groupids') or ([data['groupid']] if data.get('groupid') else [])
+        if not host_ids and not group_ids:
+            return jsonify({"error": "Missing 'hostids' or 'groupids' in request."}), 400
+        options, error = parse_replay_options(data)
+        if error:
+            return jsonify({"error": error}), 400
+
+        if group_ids:
+            try:
+                source_zapi = ZabbixAPI(url=config["source_url"], skip_version_check=True, **source_api_options())
+                source_zapi.login(token=config["source_token"])
+                group_hosts = source_zapi.host.get(groupids=group_ids, output=["hostid"])
+            except Exception as e:
+                logging.error(f"Error while fetching hosts of source groups {group_ids}: {e}", exc_info=True)
+                return jsonify({"error": f"Failed to fetch hosts of source groups: {e}"}), 500
+            host_ids.extend(host['hostid'] for host in group_hosts)
+        host_ids = list(dict.fromkeys(host_ids)) # Drop duplicates, keep request order
+        if not host_ids:
+            return jsonify({"error": "The requested groups contain no hosts."}), 400
+
+        batch = ReplicationBatch(batch_id=uuid.uuid4().hex, created_at=time.time(), source_host_ids=host_ids, skipped={})
+        skipped = {}
+        for source_host_id in host_ids:
+            task = prepare_replication_task(db, source_host_id, options, status=QUEUED_STATUS,
+                                            message=f"Queued in bulk replication batch {batch.batch_id}.", batch_id=batch.batch_id)
+            if task is None:
+                skipped[source_host_id] = "Replication is already in progress or completed."
+        batch.skipped = skipped
+        db.add(batch)
+        db.commit()
+        replication_queue.notify()
+
+        queued = len(host_ids) - len(skipped)
+        logging.info(f"Queued bulk replication batch {batch.batch_id}: {queued} hosts queued, {len(skipped)} skipped.")
+        return jsonify({
+            "message": f"Queued {queued} hosts for replication.",
+            "batch_id": batch.batch_id,
+            "queued": queued,
+            "skipped": skipped,
+            "status_url": f"/api/replicate/bulk/{batch.batch_id}"
+        }), 202
+    finally:
+        db.close()
+
+@app.route('/api/replicate/bulk/<batch_id>', methods=['GET'])
+def get_bulk_replication_status(batch_id):
+    """Returns the per-host progress of a bulk replication batch."""
+    db = SessionLocal()
+    try:
+        batch = db.query(ReplicationBatch).filter(ReplicationBatch.batch_id == batch_id).first()
+        if batch is None:
+            return jsonify({"error": f"No bulk replication batch found with ID {batch_id}"}), 404
+
+        tasks = db.query(ReplicationTask).options(load_only(*STATUS_COLUMNS)) \
+            .filter(ReplicationTask.batch_id == batch_id).all()
+        hosts = {task.source_host_id: task_status_summary(task) for task in tasks}
+        counts = {"queued": 0, "in_progress": 0, "replicating": 0, "failed": 0, "skipped": len(batch.skipped or {})}
+        for task in tasks:
+            if task.status == QUEUED_STATUS:
+                counts["queued"] += 1
+            elif task.status == 'failed':
+                counts["failed"] += 1
+            elif task.status in REPLAY_ACTIVE_STATUSES:
+                counts["replicating"] += 1
+            else:
+                counts["in_progress"] += 1
+        return jsonify({
+            "batch_id": batch.batch_id,
+            "created_at": batch.created_at,
+            "total": len(batch.source_host_ids or []),
+            "done": counts["queued"] == 0 and counts["in_progress"] == 0,
+            "counts": counts,
+            "hosts": hosts,
+            "skipped": batch.skipped or {}
+        })
+    finally:
+        db.close()
+
+# Columns needed for the status listing; the deferred JSON columns are never loaded for it
+STATUS_COLUMNS = (
+    ReplicationTask.source_host_id,
+    ReplicationTask.dest_host_id,
+    ReplicationTask.dest_host_name,
+    ReplicationTask.status,
+    ReplicationTask.message,
+    ReplicationTask.start_time,
+    ReplicationTask.first_history_timestamp,
+    ReplicationTask.cycle_offset,
+    ReplicationTask.cycle_item_offset,
+    ReplicationTask.replay_mode,
+    ReplicationTask.replayed_until,
+    ReplicationTask.replay_speed,
+    ReplicationTask.rate_limit,
+    ReplicationTask.batch_id,
+    ReplicationTask.progress,
+)
+
+def task_status_summary(task):
+    """Builds the lightweight status dictionary for a task (no mapping or history data)."""
+    return {
+        "dest_host_id": task.dest_host_id,
+        "dest_host_name": task.dest_host_name,
+        "status": task.status,
+        "message": task.message,
+        "start_time": task.start_time,
+        "first_history_timestamp": task.first_history_timestamp,
+        "cycle_offset": task.cycle_offset,
+        "cycle_item_offset": task.cycle_item_offset,
+        "replay_mode": task.replay_mode or config.get('replay_mode'),
+        "replayed_until": task.replayed_until,
+        "replay_speed": task.replay_speed or config.get('replay_speed'),
+        "rate_limit": task.rate_limit or config.get('replay_rate_limit_per_task') or None,
+        "batch_id": task.batch_id,
+        "progress": task.progress
+    }
+
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    """
+    Prometheus metrics of this process: replay tick stages, replication steps, points
+    sent/failed per task and Zabbix API calls. Each gunicorn worker keeps its own metrics.
+    """
+    return render_metrics(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
 @app.route('/api/replay/status', methods=['GET'])
 def get_replay_status():
-    """Returns the status of ongoing replication tasks."""
+    """
+    Returns the status of ongoing replication tasks.
+
+    The listing of all tasks only contains summary fields, including the replay cursor.
+    The item mapping is included when a single task is requested via ?hostid=.
+    """
     db = SessionLocal()
     try:
         # Can optionally filter by hostid if provided as a query parameter
@@ -1093,41 +1189,16 @@ def get_replay_status():
             task = db.query(ReplicationTask).filter(ReplicationTask.source_host_id == host_id_filter).first()
             if task:
                 # Return task details as a dictionary
-                return jsonify({
-                    task.source_host_id: {
-                        "dest_host_id": task.dest_host_id,
-                        "dest_host_name": task.dest_host_name,
-                        "status": task.status,
-                        "message": task.message,
-                        "start_time": task.start_time,
-                        "first_history_timestamp": task.first_history_timestamp,
-                        "item_mapping": task.item_mapping,
-                        "last_sent_index": task.last_sent_index,
-                        "cycle_offset": task.cycle_offset,
-                        "progress": task.progress
-                        # Do NOT return the full history data here, it can be very large
-                    }
-                })
+                task_details = task_status_summary(task)
+                task_details["item_mapping"] = task.item_mapping
+                # Do NOT return the full history data here, it can be very large
+                return jsonify({task.source_host_id: task_details})
             else:
                 return jsonify({"error": f"No replication task found for host ID {host_id_filter}"}), 404
         else:
-            # Return status for all known tasks from the database
-            tasks = db.query(ReplicationTask).all()
-            status_dict = {}
-            for task in tasks:
-                 status_dict[task.source_host_id] = {
-                    "dest_host_id": task.dest_host_id,
-                    "dest_host_name": task.dest_host_name,
-                    "status": task.status,
-                    "message": task.message,
-                    "start_time": task.start_time,
-                    "first_history_timestamp": task.first_history_timestamp,
-                    "item_mapping": task.item_mapping,
-                    "last_sent_index": task.last_sent_index,
-                    "cycle_offset": task.cycle_offset,
-                    "progress": task.progress
-                    # Do NOT return the full history data here
-                 }
+            # Return status for all known tasks, loading only the summary columns
+            tasks = db.query(ReplicationTask).options(load_only(*STATUS_COLUMNS)).all()
+            status_dict = {task.source_host_id: task_status_summary(task) for task in tasks}
             return jsonify(status_dict)
     finally:
         db.close() # Ensure the session is closed
@@ -1150,14 +1221,98 @@ def load_replication_tasks_from_db():
 # Load tasks from the database when the application starts
 load_replication_tasks_from_db()
 
-# Start the scheduler
-scheduler.start()
-logging.info("APScheduler started. Current jobs:")
-scheduler.print_jobs() # Log the jobs known to the scheduler instance
+def schedule_replay_engine():
+    """
+    Registers the single replay engine job and removes per-host replay jobs left in the
+    job store by earlier versions (the engine now serves those tasks).
 
-# Ensure scheduler shuts down gracefully
+    REPLAY_ENGINE=async runs each tick as an asyncio pipeline instead of the threaded engine.
+    With REPLAY_IN_WEB=false the engine job is removed and replay_worker.py processes replay instead.
+    """
+    for job in scheduler.get_jobs():
+        if job.id.startswith('replay_') and job.id != REPLAY_ENGINE_JOB_ID:
+            scheduler.remove_job(job.id)
+            logging.info(f"Removed legacy per-host replay job {job.id}.")
+    if not config.get('replay_in_web'):
+        if scheduler.get_job(REPLAY_ENGINE_JOB_ID):
+            scheduler.remove_job(REPLAY_ENGINE_JOB_ID)
+        logging.info("Replay engine disabled in the web app (REPLAY_IN_WEB=false), replay runs in replay_worker.py processes.")
+        return
+    engine_func = replay_tick_async if config.get('replay_engine') == 'async' else replay_tick
+    scheduler.add_job(
+        engine_func,
+        trigger='interval',
+        seconds=config.get('replay_interval_seconds', REPLAY_INTERVAL_SECONDS),
+        id=REPLAY_ENGINE_JOB_ID,
+        kwargs={'scheduler_holder': scheduler_elector.holder}, # A tick only commits while this process leads
+        max_instances=1, # A slow tick delays the next one instead of overlapping it
+        coalesce=True,
+        replace_existing=True
+    )
+    logging.info(f"Replay engine scheduled ({config.get('replay_engine')}) every {config.get('replay_interval_seconds')} seconds.")
+
+def schedule_history_topup():
+    """
+    Registers the rolling history top-up job when HISTORY_ROLLING is enabled (and removes
+    it otherwise). It runs in the scheduler leader whether or not the web app replays.
+    """
+    if not config.get('history_rolling'):
+        if scheduler.get_job(HISTORY_TOPUP_JOB_ID):
+            scheduler.remove_job(HISTORY_TOPUP_JOB_ID)
+        return
+    scheduler.add_job(
+        history_topup_tick,
+        trigger='interval',
+        seconds=config.get('history_topup_interval_seconds', 300),
+        id=HISTORY_TOPUP_JOB_ID,
+        max_instances=1,
+        coalesce=True,
+        replace_existing=True
+    )
+    logging.info(f"Rolling history top-up scheduled every {config.get('history_topup_interval_seconds')} seconds.")
+
+def on_scheduler_elected():
+    """Runs scheduled jobs in this process once it holds the scheduler lease."""
+    schedule_replay_engine()
+    schedule_history_topup()
+    scheduler.resume()
+    logging.info("APScheduler resumed in the leader process. Current jobs:")
+    scheduler.print_jobs() # Log the jobs known to the scheduler instance
+
+def on_scheduler_lost():
+    """
+    Stops running scheduled jobs when another process took over the scheduler lease.
+
+    A replay tick that is already running is not stopped, but it can no longer commit:
+    the engine checks the scheduler lease in its commit's transaction.
+    """
+    scheduler.pause()
+    logging.info("APScheduler paused, another process holds the scheduler lease.")
+
+# Start the scheduler paused. Every gunicorn worker imports this module, but only the worker
+# holding the scheduler lease runs jobs; the others take over if it stops renewing the lease.
+scheduler.start(paused=True)
+scheduler_elector = LeaderElector(
+    SCHEDULER_LEASE,
+    lease_seconds=config.get('scheduler_lease_seconds', 30),
+    on_elected=on_scheduler_elected,
+    on_lost=on_scheduler_lost
+)
+scheduler_elector.start()
+logging.info("APScheduler started, waiting for the scheduler lease.")
+
+# Every process works through the bulk replication queue; claiming a queued host is atomic
+replication_queue = ReplicationQueue(
+    run_queued_replication,
+    workers=config.get('replication_workers', 4),
+    poll_seconds=config.get('replication_queue_poll_seconds', 5),
+    lease_seconds=config.get('replication_lease_seconds', 120)
+)
+replication_queue.start()
+
+# Ensure scheduler shuts down gracefully and hands the lease over
 import atexit
-atexit.register(lambda: scheduler.shutdown())
+atexit.register(lambda: (replication_queue.stop(), scheduler_elector.stop(), scheduler.shutdown()))
 
 
 
@@ -1185,14 +1340,15 @@ def rebuild_mapping_endpoint():
 
         try:
             # Connect to Source Zabbix using task-specific config
-            source_zapi = ZabbixAPI(url=task.source_url, skip_version_check=True)
+            source_zapi = ZabbixAPI(url=task.source_url, skip_version_check=True, **source_api_options())
             source_zapi.login(token=task.source_token)
 
             # Connect to Destination Zabbix using task-specific config
             dest_zapi = ZabbixAPI(url=task.dest_url, skip_version_check=True)
             dest_zapi.login(token=task.dest_token)
 
-            success, message = perform_mapping_rebuild(source_host_id, task.dest_host_id, source_zapi, dest_zapi, db)
+            success, message = perform_mapping_rebuild(source_host_id, task.dest_host_id, source_zapi, dest_zapi, db,
+                                                       source_items=source_config_cache.get(source_zapi, source_host_id).host_items)
 
             if success:
                 return jsonify({"message": message})
@@ -1221,10 +1377,9 @@ def get_orphaned_hosts():
         dest_zapi.login(token=config["dest_token"])
 
         # 1. Find 'clonedfordemo' group ID
-        cloned_group = dest_zapi.hostgroup.get(filter={"name": CLONED_GROUP_NAME}, output=['groupid'])
-        if not cloned_group:
+        cloned_group_id = dest_metadata_cache.lookup(dest_zapi, 'group', CLONED_GROUP_NAME)
+        if not cloned_group_id:
             return jsonify({"message": f"No '{CLONED_GROUP_NAME}' group found on destination Zabbix."}), 200
-        cloned_group_id = cloned_group[0]['groupid']
 
         # 2. List all hosts in 'clonedfordemo' group
         cloned_dest_hosts = dest_zapi.host.get(
@@ -1284,6 +1439,7 @@ def relink_host():
     by linking it to a provided source host ID.
     """
     db = SessionLocal()
+    source_host_id = None
     try:
         data = request.get_json()
         dest_host_id = data.get('dest_host_id')
@@ -1297,7 +1453,7 @@ def relink_host():
             return jsonify({"error": "Zabbix source or destination is not fully configured (URL/Token) in global config."}), 400
 
         # Connect to Zabbix APIs using global config for initial verification
-        source_zapi = ZabbixAPI(url=config["source_url"], skip_version_check=True)
+        source_zapi = ZabbixAPI(url=config["source_url"], skip_version_check=True, **source_api_options())
         source_zapi.login(token=config["source_token"])
         dest_zapi = ZabbixAPI(url=config["dest_url"], skip_version_check=True)
         dest_zapi.login(token=config["dest_token"])
@@ -1331,7 +1487,7 @@ def relink_host():
             message=f"Re-linking to source host {source_host_name}...",
             start_time=time.time(),
             cycle_offset=0,
-            last_sent_index={},
+            cycle_item_offset=0,
             progress=0.0,
             # Store current Zabbix API config in the task
             source_url=config["source_url"],
@@ -1340,40 +1496,22 @@ def relink_host():
             dest_token=config["dest_token"]
         )
         db.add(task)
+        replication_queue.hold(task) # Marked failed if this process dies during the re-linking
         db.commit()
         db.refresh(task)
         logging.info(f"Created new ReplicationTask for source {source_host_id} -> dest {dest_host_id}.")
 
-        # 5. Fetch all source items (direct and template-inherited)
-        source_host_config = source_zapi.host.get(
-            hostids=source_host_id,
-            selectItems=['itemid', 'name', 'key_', 'type', 'value_type', 'delay', 'history', 'trends', 'units', 'description', 'status', 'flags'],
-            selectParentTemplates=['templateid']
-        )[0]
-        host_items = source_host_config.get('items', [])
-        template_items = []
-        template_ids = [t['templateid'] for t in source_host_config.get('parentTemplates', [])]
-        if template_ids:
-            template_data = source_zapi.template.get(
-                templateids=template_ids,
-                output=['templateid'],
-                selectItems=['itemid', 'name', 'key_', 'type', 'value_type', 'delay', 'history', 'trends', 'units', 'description', 'status', 'flags']
-            )
-            for template in template_data:
-                template_items.extend(template.get('items', []))
-
-        all_source_items_dict = {item['itemid']: item for item in host_items}
-        for item in template_items:
-            if item['itemid'] not in all_source_items_dict:
-                all_source_items_dict[item['itemid']] = item
-        all_source_items = list(all_source_items_dict.values())
+        # 5. Fetch all source items (direct and template-inherited), cached unless they changed
+        source_config = source_config_cache.get(source_zapi, source_host_id)
+        all_source_items = merge_source_items(source_config)
         logging.info(f"Fetched {len(all_source_items)} total source items for re-linking.")
 
         # 6. Rebuild item mapping
         task.status = 'rebuilding_mapping'
         task.message = 'Rebuilding item mapping...'
         db.commit()
-        rebuild_success, rebuild_message = perform_mapping_rebuild(source_host_id, dest_host_id, source_zapi, dest_zapi, db)
+        rebuild_success, rebuild_message = perform_mapping_rebuild(source_host_id, dest_host_id, source_zapi, dest_zapi, db,
+                                                                   source_items=source_config.host_items)
         if not rebuild_success:
             task.status = 'failed'
             task.message = f"Re-linking failed during mapping rebuild: {rebuild_message}"
@@ -1386,27 +1524,24 @@ def relink_host():
         task.message = 'Fetching recent history...'
         db.commit()
         replay_duration_hours = config.get("replay_duration_hours", 24)
-        time_from = int(time.time()) - (replay_duration_hours * 3600)
-        history_data = fetch_history(all_source_items, source_zapi, time_from=time_from)
-        task.history = history_data
+        fetch_started = int(time.time())
+        time_from = fetch_started - (replay_duration_hours * 3600)
+        history_count, _ = fetch_history(all_source_items, source_zapi, db, source_host_id, time_from=time_from,
+                                         stream=HistoryStream.from_config(task.source_url, task.source_token))
+        task.history_fetched_until = fetch_started # Rolling history top-ups continue from here
+        bump_history_generation(task) # Replay caches of earlier history are dropped
+        task.history = None # History lives in the history store
         task.first_history_timestamp = time_from # Set start of history fetch as first timestamp
         db.commit()
-        logging.info(f"Fetched {sum(len(v) for v in history_data.values())} history records for re-linking.")
+        logging.info(f"Fetched {history_count} history records for re-linking.")
 
         # 8. Schedule replay job
         task.status = 'scheduling_replay'
         task.message = 'Scheduling data replay task...'
         db.commit()
-        scheduler.add_job(
-            replay_job,
-            trigger='interval',
-            seconds=60,
-            id=f"replay_{source_host_id}",
-            args=[source_host_id],
-            replace_existing=True
-        )
-        logging.info(f"Successfully scheduled replay job for source host ID: {source_host_id}")
+        logging.info(f"Replay for source host ID {source_host_id} will be picked up by the replay engine.")
 
+        # The replay engine job picks up every task in an active replay status
         task.status = 'replicating'
         task.message = 'Re-linking complete. Replay task scheduled.'
         db.commit()
@@ -1425,6 +1560,8 @@ def relink_host():
             db.commit()
         return jsonify({"error": f"Re-linking failed: {e}"}), 500
     finally:
+        if source_host_id:
+            replication_queue.release(source_host_id)
         db.close()
 
 
@@ -0,0 +1,157 @@
+import asyncio
+import itertools
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_utils import AsyncSender
+
+from common import SessionLocal, config
+from jobs import (commit_with_retry, fence_replay_leases, fence_scheduler_lease, finalize_task_batch, iter_task_batches,
+                  load_active_tasks)
+from metrics import REPLAY_TICK_SECONDS, REPLAY_TICK_STAGE_SECONDS, StageTimer
+from rate_limit import get_rate_controller, rate_limit_status
+from sender_pool import chunk_items, parse_trapper_endpoints
+
+_senders = None
+_senders_settings = None
+_senders_lock = threading.Lock()
+
+
+def get_async_senders():
+    """
+    Returns the process's [((host, port), AsyncSender), ...], rebuilt if the trapper
+    configuration changed.
+
+    AsyncSender opens a connection per send and holds no event loop state, so the same
+    senders serve every tick. They use TRAPPER_CHUNK_SIZE like the threaded sender pool,
+    so both engines send packets of the same size.
+    """
+    global _senders, _senders_settings
+    settings = (
+        tuple(parse_trapper_endpoints(config.get('dest_trapper_endpoints'), config.get('dest_trapper_host'), config.get('dest_trapper_port'))),
+        config.get('trapper_chunk_size', 1000),
+        config.get('trapper_timeout', 10),
+    )
+    with _senders_lock:
+        if _senders is None or settings != _senders_settings:
+            endpoints, chunk_size, timeout = settings
+            _senders = [((host, port), AsyncSender(server=host, port=port, timeout=timeout, chunk_size=chunk_size)) for host, port in endpoints]
+            _senders_settings = settings
+        return _senders
+
+
+async def send_batch_async(batch, senders, endpoint_index, semaphore):
+    """
+    Sends one task's packet with the async sender, one chunk at a time.
+
+    Failures, response times and per-endpoint counts are recorded on the batch so
+    finalize_task_batch and the rate controller can use them, like in the threaded engine.
+    """
+    chunks = chunk_items(batch.packet, config.get('trapper_chunk_size', 1000), config.get('trapper_max_packet_bytes', 1048576))
+    for chunk in chunks:
+        async with semaphore:
+            # Try each endpoint once, starting with the one assigned to this task
+            last_error = None
+            started = time.monotonic()
+            for attempt in range(len(senders)):
+                endpoint, sender = senders[(endpoint_index + attempt) % len(senders)]
+                try:
+                    response = await sender.send(chunk)
+                    batch.failed += response.failed
+                    batch.endpoint_points[endpoint] = batch.endpoint_points.get(endpoint, 0) + len(chunk)
+                    last_error = None
+                    break
+                except Exception as e:
+                    last_error = e
+                    logging.warning(f"[Replay Job {batch.task.source_host_id}] Async trapper send failed: {e}")
+            batch.send_seconds = max(batch.send_seconds, time.monotonic() - started)
+            if last_error is not None:
+                batch.send_error = last_error
+                return batch
+    return batch
+
+
+async def run_replay_tick_async(source_host_ids=None, lease_owner=None, lease_seconds=None, scheduler_holder=None):
+    """
+    One replay tick as an asyncio pipeline.
+
+    Batches are prepared one task at a time on a dedicated database thread. Each batch
+    starts sending as soon as it is ready, while the next task is prepared. At most
+    replay_async_concurrency chunks are in flight. A task's progress is recorded as soon
+    as its send completes, so a slow trapper response only delays that task. All progress
+    is committed in one transaction at the end of the tick, after checking the scheduler
+    lease or the tasks' replay leases when they are given (see jobs.replay_tick).
+    """
+    loop = asyncio.get_running_loop()
+    db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='replay-db') # SQLAlchemy session stays on one thread
+    db = await loop.run_in_executor(db_executor, SessionLocal)
+    stages = StageTimer(REPLAY_TICK_STAGE_SECONDS, engine='async')
+    started = time.time()
+    try:
+        stages.start('load_tasks')
+        tasks = await loop.run_in_executor(db_executor, load_active_tasks, db, source_host_ids)
+        if not tasks:
+            return
+
+        senders = get_async_senders()
+        semaphore = asyncio.Semaphore(config.get('replay_async_concurrency', 16))
+        endpoint_indexes = itertools.cycle(range(len(senders)))
+
+        # Stage 1: prepare batches on the DB thread, handing each to stage 2 as soon as it is ready
+        stages.start('build_packets') # Overlaps with the first sends
+        batch_iter = iter_task_batches(db, tasks, time.time())
+        sends = []
+        while True:
+            batch = await loop.run_in_executor(db_executor, next, batch_iter, None)
+            if batch is None:
+                break
+            if batch.packet:
+                # Stage 2: send concurrently with other tasks
+                sends.append(asyncio.ensure_future(send_batch_async(batch, senders, next(endpoint_indexes), semaphore)))
+            else:
+                await loop.run_in_executor(db_executor, finalize_task_batch, batch)
+
+        # Stage 3: record each task's progress as its send completes
+        stages.start('send') # Remaining sends and finalizing
+        total_points = failed = errors = 0
+        latency = 0.0
+        endpoint_points = {}
+        for send in asyncio.as_completed(sends):
+            batch = await send
+            total_points += len(batch.packet)
+            failed += batch.failed
+            errors += 1 if batch.send_error is not None else 0
+            latency = max(latency, batch.send_seconds)
+            for endpoint, count in batch.endpoint_points.items():
+                endpoint_points[endpoint] = endpoint_points.get(endpoint, 0) + count
+            await loop.run_in_executor(db_executor, finalize_task_batch, batch)
+
+        # Charge the tick against the rate limits and let failures and slow responses drive the backoff
+        get_rate_controller().record_tick(total_points, failed, errors, latency, endpoint_points)
+
+        stages.start('commit')
+        if scheduler_holder is not None and not await loop.run_in_executor(db_executor, fence_scheduler_lease, db, scheduler_holder):
+            return
+        if lease_owner is not None:
+            await loop.run_in_executor(db_executor, fence_replay_leases, db, tasks, lease_owner, lease_seconds)
+        if not await loop.run_in_executor(db_executor, commit_with_retry, db):
+            logging.error("[Replay Engine] Failed to commit replay progress")
+            await loop.run_in_executor(db_executor, db.rollback)
+            return
+        stages.stop()
+        REPLAY_TICK_SECONDS.observe(time.time() - started, engine='async')
+        logging.info(f"[Replay Engine] Async tick complete: {total_points} points for {len(sends)} tasks{rate_limit_status()}.")
+    except Exception as e:
+        logging.error(f"[Replay Engine] Unexpected error in async tick: {e}", exc_info=True)
+        await loop.run_in_executor(db_executor, db.rollback)
+    finally:
+        stages.stop()
+        await loop.run_in_executor(db_executor, db.close)
+        db_executor.shutdown(wait=False)
+
+
+def replay_tick_async(source_host_ids=None, lease_owner=None, lease_seconds=None, scheduler_holder=None):
+    """Scheduler entry point for the asyncio replay engine (REPLAY_ENGINE=async)."""
+    asyncio.run(run_replay_tick_async(source_host_ids, lease_owner, lease_seconds, scheduler_holder))
@@ -0,0 +1,379 @@
+"""
+Local stand-ins for a Zabbix server, used by the benchmark harness.
+
+FakeZabbixServer answers Zabbix JSON-RPC API requests over HTTP from an in-memory object
+store, so zabbix_utils.ZabbixAPI (and the streamed history.get path) work against it
+unchanged. A source server is filled with synthetic hosts, items and history at a
+configurable scale; a destination server starts empty and records what ReplayZ creates.
+FakeTrapper accepts Zabbix sender protocol packets and acknowledges every value.
+"""
+import itertools
+import json
+import math
+import socketserver
+import struct
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+API_VERSION = '7.0.0'
+
+# API object -> (ID field, ID list in create/update responses)
+OBJECT_IDS = {
+    'hostgroup': ('groupid', 'groupids'),
+    'template': ('templateid', 'templateids'),
+    'host': ('hostid', 'hostids'),
+    'item': ('itemid', 'itemids'),
+    'usermacro': ('hostmacroid', 'hostmacroids'),
+    'trigger': ('triggerid', 'triggerids'),
+}
+
+# Keys every synthetic host has, so trigger and problem simulation paths are exercised. The
+# first ones match the key patterns app.add_*_triggers look for: ICMP, per-core CPU, SNMP
+# interface status/speed/type (same ifIndex) and temperature. The default problem profile
+# matches item keys exactly, so its remaining keys are added as they are.
+STANDARD_ITEMS = [
+    ('ICMP ping', 'icmpping', '3'),
+    ('ICMP loss', 'icmppingloss', '0'),
+    ('ICMP response time', 'icmppingsec', '0'),
+    ('CPU 0 utilization', 'system.cpu.util[0]', '0'),
+    ('Interface eth0: Operational status', 'net.if.status[ifOperStatus.1]', '3'),
+    ('Interface eth0: Speed', 'net.if.speed[ifHighSpeed.1]', '3'),
+    ('Interface eth0: Interface type', 'net.if.type[ifType.1]', '3'),
+    ('Interface eth0: Bits received', 'net.if.in[ifHCInOctets.1]', '3'),
+    ('CPU temperature', 'sensor.temp.value[cpu]', '0'),
+    ('System name', 'system.name', '1'),
+    ('CPU utilization', 'cpu.util', '0'),
+    ('Temperature', 'sensor.temp', '0'),
+    ('Operational status', 'ifOperStatus', '3'),
+    ('Speed', 'ifSpeed', '3'),
+]
+
+
+class ApiError(Exception):
+    """A JSON-RPC error returned to the client."""
+
+    def __init__(self, data, code=-32602, message="Invalid params."):
+        super().__init__(data)
+        self.code = code
+        self.message = message
+        self.data = data
+
+
+class FakeZabbixServer:
+    """
+    In-memory Zabbix API served on 127.0.0.1.
+
+    Supports the get/create/update/delete calls ReplayZ makes for host groups, templates,
+    hosts, items, user macros and triggers, plus history.get. History is synthetic: every
+    numeric and character item of a source host has a value each history_interval seconds
+    over the last history_hours, computed on request from the item ID and clock.
+    """
+
+    def __init__(self, name='source'):
+        self.name = name
+        self.objects = {kind: {} for kind in OBJECT_IDS} # {kind: {id: object}}
+        self.history_items = {} # {itemid: (value_type, interval seconds, first clock)}
+        self.calls = Counter() # {method: calls}
+        self._ids = itertools.count(10000)
+        self._lock = threading.Lock()
+        self._server = None
+        self.url = None
+
+    # --- Synthetic data ---
+
+    def populate(self, hosts, items_per_host, history_hours=24, history_interval=60, host_id_base=10001):
+        """
+        Adds synthetic source hosts.
+
+        Each host has the STANDARD_ITEMS plus generic numeric items up to items_per_host,
+        two host macros, one group and one linked template with an item and a macro.
+        """
+        group = self._add('hostgroup', {'name': 'Bench hosts'})
+        template = self._add('template', {'host': 'Template Bench', 'name': 'Template Bench'})
+        self._add('item', {'hostid': template['templateid'], 'name': 'Bench template agent ping', 'key_': 'agent.ping',
+                           'type': '0', 'value_type': '3', 'delay': '1m', 'history': '7d', 'trends': '365d',
+                           'units': '', 'description': '', 'status': '0', 'flags': '0'})
+        self._add('usermacro', {'hostid': template['templateid'], 'macro': '{$BENCH.TEMPLATE}', 'value': '1'})
+
+        now = int(time.time())
+        first_clock = now - history_hours * 3600
+        for index in range(hosts):
+            host_id = str(host_id_base + index)
+            host = {
+                'hostid': host_id, 'host': f"bench-host-{host_id}", 'name': f"Bench host {host_id}", 'description': '',
+                'groupids': [group['groupid']], 'templateids': [template['templateid']],
+                'interfaces': [{'interfaceid': host_id, 'type': '1', 'main': '1', 'useip': '1', 'ip': '192.0.2.1', 'dns': '', 'port': '10050'}],
+            }
+            self.objects['host'][host_id] = host
+            specs = list(STANDARD_ITEMS)
+            specs += [(f"Bench metric {n}", f"bench.metric[{n}]", '0' if n % 5 else '3') for n in range(max(0, items_per_host - len(specs)))]
+            for name, key, value_type in specs[:items_per_host]:
+                item = self._add('item', {'hostid': host_id, 'name': name, 'key_': key, 'type': '0', 'value_type': value_type,
+                                          'delay': f"{history_interval}s", 'history': '7d', 'trends': '365d', 'units': '',
+                                          'description': '', 'status': '0', 'flags': '0'})
+                self.history_items[item['itemid']] = (value_type, history_interval, first_clock)
+            self._add('usermacro', {'hostid': host_id, 'macro': '{$BENCH.HOST}', 'value': host_id})
+            self._add('usermacro', {'hostid': host_id, 'macro': '{$ICMP_LOSS_WARN}', 'value': '20'})
+        return [str(host_id_base + index) for index in range(hosts)]
+
+    def history_points(self, itemids, time_from, time_till):
+        """Returns the synthetic history records of the items in [time_from, time_till], in clock order."""
+        records = []
+        for itemid in itemids:
+            spec = self.history_items.get(str(itemid))
+            if spec is None:
+                continue
+            value_type, interval, first_clock = spec
+            start = max(time_from, first_clock)
+            clock = start + (-(start - first_clock)) % interval
+            seed = int(itemid)
+            while clock <= time_till:
+                step = (clock - first_clock) // interval
+                if value_type == '0':
+                    value = f"{50 + 40 * math.sin((step + seed) / 10):.4f}"
+                elif value_type == '3':
+                    value = str((step + seed) % 1000)
+                else:
+                    value = f"state-{(step // 60) % 3}"
+                records.append({'itemid': str(itemid), 'clock': str(clock), 'value': value})
+                clock += interval
+        records.sort(key=lambda record: int(record['clock']))
+        return records
+
+    # --- Object store ---
+
+    def _add(self, kind, obj):
+        id_field = OBJECT_IDS[kind][0]
+        obj = dict(obj)
+        obj[id_field] = str(next(self._ids))
+        self.objects[kind][obj[id_field]] = obj
+        return obj
+
+    @staticmethod
+    def _as_list(value):
+        if value is None:
+            return None
+        return [str(v) for v in (value if isinstance(value, (list, tuple)) else [value])]
+
+    def _owner_ids(self, obj):
+        return [obj['hostid']] if 'hostid' in obj else []
+
+    def _select(self, kind, params):
+        results = list(self.objects[kind].values())
+        id_field = OBJECT_IDS[kind][0]
+        own_ids = self._as_list(params.get(id_field + 's'))
+        if own_ids is not None:
+            results = [obj for obj in results if obj[id_field] in own_ids]
+        host_ids = self._as_list(params.get('hostids'))
+        if host_ids is not None:
+            if kind == 'host':
+                results = [obj for obj in results if obj['hostid'] in host_ids]
+            elif kind == 'trigger':
+                results = [obj for obj in results if set(obj.get('hostids', [])) & set(host_ids)]
+            else:
+                results = [obj for obj in results if obj.get('hostid') in host_ids]
+        template_ids = self._as_list(params.get('templateids'))
+        if template_ids is not None and kind == 'template':
+            results = [obj for obj in results if obj['templateid'] in template_ids]
+        group_ids = self._as_list(params.get('groupids'))
+        if group_ids is not None:
+            results = [obj for obj in results if set(obj.get('groupids', [])) & set(group_ids)]
+        for field, value in (params.get('filter') or {}).items():
+            values = self._as_list(value)
+            results = [obj for obj in results if str(obj.get(field)) in values]
+        for field, value in (params.get('search') or {}).items():
+            pattern = str(value).replace('*', '')
+            results = [obj for obj in results if pattern in str(obj.get(field, ''))]
+        return results
+
+    def _output(self, kind, obj, params):
+        output = params.get('output', 'extend')
+        internal = ('groupids', 'templateids', 'interfaces', 'hostids')
+        if output == 'extend' or not isinstance(output, list):
+            result = {k: v for k, v in obj.items() if k not in internal}
+        else:
+            result = {k: obj[k] for k in output if k in obj}
+        if kind in ('host', 'template'):
+            owner_id = obj[OBJECT_IDS[kind][0]]
+            if params.get('selectItems') == 'count':
+                result['items'] = str(sum(1 for item in self.objects['item'].values() if item['hostid'] == owner_id))
+            elif params.get('selectItems'):
+                result['items'] = [self._output('item', item, {'output': params['selectItems']})
+                                   for item in self.objects['item'].values() if item['hostid'] == owner_id]
+            if params.get('selectMacros'):
+                result['macros'] = [self._output('usermacro', macro, {'output': params['selectMacros']})
+                                    for macro in self.objects['usermacro'].values() if macro['hostid'] == owner_id]
+            if params.get('selectGroups'):
+                result['groups'] = [{'groupid': gid, 'name': self.objects['hostgroup'][gid]['name']} for gid in obj.get('groupids', [])]
+            if params.get('selectParentTemplates'):
+                result['parentTemplates'] = [{'templateid': tid, 'name': self.objects['template'][tid]['name']} for tid in obj.get('templateids', [])]
+            if params.get('selectInterfaces'):
+                result['interfaces'] = [dict(interface) for interface in obj.get('interfaces', [])]
+        if kind == 'trigger' and params.get('selectTags'):
+            result['tags'] = [dict(tag) for tag in obj.get('tags', [])]
+        return result
+
+    def _create(self, kind, params):
+        objects = params if isinstance(params, list) else [params]
+        # Validate the whole batch first; like Zabbix, a failing batch creates nothing
+        pending_keys = set()
+        for obj in objects:
+            if kind == 'item':
+                unique = (obj.get('hostid'), obj.get('key_'))
+                existing = any((item['hostid'], item['key_']) == unique for item in self.objects['item'].values())
+                if existing or unique in pending_keys:
+                    raise ApiError(f"Item with key \"{obj.get('key_')}\" already exists on host.")
+                pending_keys.add(unique)
+            elif kind in ('host', 'template', 'hostgroup'):
+                name_field = 'name' if kind == 'hostgroup' else 'host'
+                if any(o.get(name_field) == obj.get(name_field) for o in self.objects[kind].values()):
+                    raise ApiError(f"{kind} \"{obj.get(name_field)}\" already exists.")
+            elif kind == 'usermacro':
+                if any(m['hostid'] == str(obj.get('hostid')) and m['macro'] == obj.get('macro') for m in self.objects['usermacro'].values()):
+                    raise ApiError(f"Macro \"{obj.get('macro')}\" already exists on host.")
+            elif kind == 'trigger':
+                # Like Zabbix, a description must be unique per host, not globally
+                names = {(host_id, obj.get('description')) for host_id in self._trigger_host_ids(obj)}
+                existing = any((host_id, t['description']) in names for t in self.objects['trigger'].values() for host_id in t.get('hostids', []))
+                if existing or names & pending_keys:
+                    raise ApiError(f"Trigger \"{obj.get('description')}\" already exists on host.")
+                pending_keys |= names
+
+        ids = []
+        for obj in objects:
+            obj = dict(obj)
+            if kind == 'host':
+                obj['groupids'] = [str(g['groupid']) for g in obj.pop('groups', [])]
+                obj['templateids'] = [str(t['templateid']) for t in obj.pop('templates', [])]
+            elif kind == 'trigger':
+                obj['hostids'] = self._trigger_host_ids(obj)
+            if 'hostid' in obj:
+                obj['hostid'] = str(obj['hostid'])
+            ids.append(self._add(kind, obj)[OBJECT_IDS[kind][0]])
+        return {OBJECT_IDS[kind][1]: ids}
+
+    def _trigger_host_ids(self, trigger):
+        """Returns the IDs of the hosts a trigger expression references (/host/key)."""
+        return [host['hostid'] for host in self.objects['host'].values() if f"/{host['host']}/" in trigger.get('expression', '')]
+
+    def _update(self, kind, params):
+        id_field, ids_field = OBJECT_IDS[kind]
+        ids = []
+        for obj in (params if isinstance(params, list) else [params]):
+            stored = self.objects[kind].get(str(obj.get(id_field)))
+            if stored is None:
+                raise ApiError(f"No permissions to referred object or it does not exist!")
+            stored.update({k: v for k, v in obj.items() if k != id_field})
+            ids.append(stored[id_field])
+        return {ids_field: ids}
+
+    def handle(self, method, params):
+        """Runs one API method and returns its result (raises ApiError)."""
+        self.calls[method] += 1
+        if method == 'apiinfo.version':
+            return API_VERSION
+        if method == 'user.checkAuthentication':
+            return {'userid': '1'}
+        kind, _, action = method.partition('.')
+        with self._lock:
+            if method == 'history.get':
+                return self.history_points(params.get('itemids', []), int(params.get('time_from', 0)), int(params.get('time_till', time.time())))
+            if kind not in OBJECT_IDS:
+                raise ApiError(f"Incorrect API \"{kind}\".", code=-32602)
+            if action == 'get':
+                return [self._output(kind, obj, params) for obj in self._select(kind, params)]
+            if action == 'create':
+                return self._create(kind, params)
+            if action == 'update':
+                return self._update(kind, params)
+            if action == 'delete':
+                ids = [str(i) for i in (params if isinstance(params, list) else [params])]
+                for object_id in ids:
+                    self.objects[kind].pop(object_id, None)
+                return {OBJECT_IDS[kind][1]: ids}
+        raise ApiError(f"Incorrect method \"{method}\".", code=-32601, message="Method not found.")
+
+    # --- HTTP ---
+
+    def start(self):
+        """Starts serving on a free local port; the API URL is in self.url."""
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                response = {'jsonrpc': '2.0', 'id': request.get('id')}
+                try:
+                    response['result'] = server.handle(request['method'], request.get('params') or {})
+                except ApiError as e:
+                    response['error'] = {'code': e.code, 'message': e.message, 'data': e.data}
+                body = json.dumps(response).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name=f'fake-zabbix-{self.name}', daemon=True).start()
+        self.url = f"http://127.0.0.1:{self._server.server_address[1]}/api_jsonrpc.php"
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+
+
+class FakeTrapper:
+    """Zabbix trapper listener that acknowledges every value it receives."""
+
+    def __init__(self):
+        self.values = 0
+        self.packets = 0
+        self._lock = threading.Lock()
+        self._server = None
+        self.port = None
+
+    def start(self):
+        trapper = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def _read(self, size):
+                data = b''
+                while len(data) < size:
+                    chunk = self.request.recv(size - len(data))
+                    if not chunk:
+                        raise ConnectionError("Connection closed")
+                    data += chunk
+                return data
+
+            def handle(self):
+                header = self._read(13) # "ZBXD", flags, data length, reserved
+                payload = json.loads(self._read(struct.unpack('<I', header[5:9])[0]))
+                count = len(payload.get('data', []))
+                with trapper._lock:
+                    trapper.values += count
+                    trapper.packets += 1
+                body = json.dumps({'response': 'success', 'info': f"processed: {count}; failed: 0; total: {count}; seconds spent: 0.000050"}).encode('utf-8')
+                self.request.sendall(b'ZBXD\x01' + struct.pack('<II', len(body), 0) + body)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self._server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name='fake-trapper', daemon=True).start()
+        self.port = self._server.server_address[1]
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
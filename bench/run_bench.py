@@ -0,0 +1,278 @@
+"""
+Reproducible ReplayZ benchmark.
+
+Runs host replication, history fetch and replay against local fake Zabbix API servers
+and a fake trapper (see fake_zabbix.py) for each combination of host and item counts,
+and writes a JSON report. Nothing outside this machine is contacted.
+
+Usage:
+    python bench/run_bench.py --hosts 1,10 --items 50,200 --output bench-report.json
+    python bench/run_bench.py --baseline bench-report.json --tolerance 0.2
+
+With --baseline, throughput that drops (or setup time that grows) by more than the
+tolerance compared with the baseline report is listed and the exit code is 1.
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from fake_zabbix import FakeTrapper, FakeZabbixServer
+
+# Report metrics compared with a baseline: (path, True if higher is better)
+COMPARED_METRICS = [
+    (('setup', 'seconds_per_host'), False),
+    (('fetch_history', 'records_per_second'), True),
+    (('replay', 'points_per_second'), True),
+]
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size.strip()]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def load_replayz(db_path):
+    """Imports the app with a throwaway database and the schedulers' replay and top-up jobs disabled."""
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    os.environ['REPLAY_IN_WEB'] = 'false' # Replay ticks are driven by the benchmark
+    os.environ['HISTORY_ROLLING'] = 'false'
+    import app
+    return app
+
+
+def reset_state(app, common):
+    """Empties the task and history tables and the API caches between runs."""
+    db = common.SessionLocal()
+    try:
+        for model in (common.HistoryPoint, common.ReplicationTask, common.ReplicationBatch):
+            db.query(model).delete()
+        db.commit()
+    finally:
+        db.close()
+    app.dest_metadata_cache.invalidate()
+    app.source_config_cache.invalidate()
+
+
+def run_scale(app, hosts, items, args, host_id_base):
+    """
+    Replicates `hosts` source hosts with `items` items each, then runs the replay ticks.
+
+    Returns:
+        dict: Setup, history fetch and replay measurements of this scale
+    """
+    import common
+    import metrics
+
+    source = FakeZabbixServer('source').start()
+    dest = FakeZabbixServer('dest').start()
+    trapper = FakeTrapper().start()
+    try:
+        reset_state(app, common)
+        host_ids = source.populate(hosts, items, history_hours=args.history_hours, history_interval=args.interval, host_id_base=host_id_base)
+        common.config.update({
+            'source_url': source.url, 'source_token': 'bench',
+            'dest_url': dest.url, 'dest_token': 'bench',
+            'dest_trapper_host': '127.0.0.1', 'dest_trapper_port': trapper.port,
+            'dest_trapper_endpoints': '',
+            'replay_mode': args.replay_mode, 'replay_engine': args.replay_engine,
+            'replay_speed': args.replay_speed,
+        })
+
+        # --- Host replication (includes the history fetch) ---
+        steps_before = metrics.REPLICATION_STEP_SECONDS.totals()
+        fetched_before = metrics.HISTORY_RECORDS_FETCHED.value()
+        options, _ = app.parse_replay_options({})
+        db = common.SessionLocal()
+        setup_started = time.perf_counter()
+        failed = 0
+        try:
+            for host_id in host_ids:
+                task = app.prepare_replication_task(db, host_id, options)
+                db.commit()
+                try:
+                    app.run_replication(db, task)
+                except Exception:
+                    failed += 1
+        finally:
+            db.close()
+        setup_seconds = time.perf_counter() - setup_started
+        steps_after = metrics.REPLICATION_STEP_SECONDS.totals()
+        step_seconds = {key[0]: round(total - steps_before.get(key, (0, 0))[0], 4) for key, (total, _) in steps_after.items()
+                        if total - steps_before.get(key, (0, 0))[0] > 0}
+        fetch_seconds = step_seconds.get('fetch_history', 0)
+        fetched = metrics.HISTORY_RECORDS_FETCHED.value() - fetched_before
+
+        # --- Replay ---
+        from async_replay import replay_tick_async
+        from jobs import replay_tick
+        tick = replay_tick_async if args.replay_engine == 'async' else replay_tick
+        values_before = trapper.values
+        packets_before = trapper.packets
+        replay_started = time.perf_counter()
+        tick_seconds = []
+        for _ in range(args.replay_ticks):
+            started = time.perf_counter()
+            tick()
+            tick_seconds.append(time.perf_counter() - started)
+            if args.replay_mode == 'timed':
+                time.sleep(args.tick_sleep) # Timed replay only sends points as replay time elapses
+        replay_seconds = time.perf_counter() - replay_started
+        points = trapper.values - values_before
+        packets = trapper.packets - packets_before
+        busy_seconds = sum(tick_seconds)
+
+        # One more tick under tracemalloc for its peak allocations (tracing slows it down too much to time it)
+        tracemalloc.start()
+        tick()
+        _, tick_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        return {
+            'hosts': hosts,
+            'items_per_host': items,
+            'setup': {
+                'seconds': round(setup_seconds, 4),
+                'seconds_per_host': round(setup_seconds / hosts, 4),
+                'failed_hosts': failed,
+                'step_seconds': step_seconds,
+                'source_api_calls': dict(source.calls),
+                'dest_api_calls': dict(dest.calls),
+                'dest_items_created': len(dest.objects['item']),
+                'dest_triggers_created': len(dest.objects['trigger']),
+            },
+            'fetch_history': {
+                'records': fetched,
+                'seconds': round(fetch_seconds, 4),
+                'records_per_second': round(fetched / fetch_seconds, 1) if fetch_seconds else None,
+            },
+            'replay': {
+                'engine': args.replay_engine,
+                'mode': args.replay_mode,
+                'ticks': args.replay_ticks,
+                'points': points,
+                'packets': packets,
+                'seconds': round(replay_seconds, 4),
+                'tick_seconds_max': round(max(tick_seconds), 4) if tick_seconds else None,
+                'points_per_second': round(points / busy_seconds, 1) if busy_seconds else None,
+                'tick_peak_traced_bytes': tick_peak,
+            },
+            'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+    finally:
+        trapper.stop()
+        dest.stop()
+        source.stop()
+
+
+def compare_reports(report, baseline, tolerance):
+    """
+    Compares the results of the scales present in both reports.
+
+    Returns:
+        list: Regression descriptions (empty if none)
+    """
+    baseline_results = {(r['hosts'], r['items_per_host']): r for r in baseline.get('results', [])}
+    regressions = []
+    for result in report['results']:
+        previous = baseline_results.get((result['hosts'], result['items_per_host']))
+        if previous is None:
+            continue
+        for path, higher_is_better in COMPARED_METRICS:
+            current_value, previous_value = result, previous
+            for key in path:
+                current_value = (current_value or {}).get(key)
+                previous_value = (previous_value or {}).get(key)
+            if not current_value or not previous_value:
+                continue
+            change = (current_value - previous_value) / previous_value
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                regressions.append(f"{result['hosts']} hosts x {result['items_per_host']} items: {'.'.join(path)} "
+                                   f"{previous_value} -> {current_value} ({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ReplayZ against a local fake Zabbix API and trapper.")
+    parser.add_argument('--hosts', type=parse_sizes, default=[1, 5], help="Comma separated host counts (default: 1,5)")
+    parser.add_argument('--items', type=parse_sizes, default=[50, 200], help="Comma separated items per host (default: 50,200)")
+    parser.add_argument('--history-hours', type=int, default=24, help="Hours of synthetic source history (default: 24)")
+    parser.add_argument('--interval', type=int, default=60, help="Seconds between synthetic history values (default: 60)")
+    parser.add_argument('--replay-ticks', type=int, default=10, help="Replay ticks run per scale (default: 10)")
+    parser.add_argument('--replay-mode', choices=['tick', 'timed'], default='tick')
+    parser.add_argument('--replay-engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--replay-speed', type=float, default=3600.0, help="Timed replay speed (default: 3600, an hour per second)")
+    parser.add_argument('--tick-sleep', type=float, default=0.5, help="Seconds between timed replay ticks (default: 0.5)")
+    parser.add_argument('--output', help="Write the JSON report to this file (default: stdout)")
+    parser.add_argument('--baseline', help="Earlier JSON report to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed relative regression against the baseline (default: 0.2)")
+    parser.add_argument('--verbose', action='store_true', help="Show ReplayZ's log output")
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp(prefix='replayz-bench-')
+    # The app prints to stdout (e.g. the scheduler's job list); keep it out of the JSON report
+    with contextlib.redirect_stdout(sys.stderr):
+        try:
+            app = load_replayz(os.path.join(work_dir, 'bench.sqlite'))
+            logging.getLogger().setLevel(logging.INFO if args.verbose else logging.ERROR) # Failed replications are still shown
+
+            results = []
+            host_id_base = 10001
+            for hosts in args.hosts:
+                for items in args.items:
+                    print(f"Benchmarking {hosts} hosts x {items} items...", file=sys.stderr)
+                    results.append(run_scale(app, hosts, items, args, host_id_base))
+                    host_id_base += hosts + 1000 # Fresh host IDs, so no per-host state carries over between scales
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    report = {
+        'created_at': int(time.time()),
+        'git_commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': {
+            'hosts': args.hosts, 'items': args.items, 'history_hours': args.history_hours, 'interval': args.interval,
+            'replay_ticks': args.replay_ticks, 'replay_mode': args.replay_mode, 'replay_engine': args.replay_engine,
+            'replay_speed': args.replay_speed,
+        },
+        'results': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare_reports(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}", file=sys.stderr)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    os._exit(1 if regressions else 0) # Skips the app's atexit handlers (scheduler and queue threads)
+
+
+if __name__ == '__main__':
+    main()
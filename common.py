@@ -1,15 +1,57 @@
 import os
+import logging
 from dotenv import load_dotenv
-from sqlalchemy import create_engine, Column, Integer, String, Text, Float, JSON
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import create_engine, event, inspect, text, Column, Index, Integer, String, Text, Float, JSON
+from sqlalchemy.orm import sessionmaker, deferred
 from sqlalchemy.ext.declarative import declarative_base
 
 # Load environment variables
 load_dotenv(os.path.join(os.path.dirname(__file__), '.env'))
 
-# Configure SQLAlchemy for replication task storage
-DATABASE_URL = 'sqlite:///jobs.sqlite'
-engine = create_engine(DATABASE_URL)
+# Configure SQLAlchemy for replication task storage. The scheduler's job store shares this engine.
+# DATABASE_URL can point to a server database (e.g. postgresql://...) when several workers share the task store.
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///jobs.sqlite')
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv('SQLITE_BUSY_TIMEOUT_MS', "5000")) # How long SQLite waits for a lock before failing
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', "NORMAL") # NORMAL is durable enough with WAL and much cheaper than FULL
+
+def build_engine(database_url):
+    """
+    Creates the task store engine.
+
+    SQLite connections are opened in WAL mode so readers (status requests) don't block the
+    replay engine's writes, and wait up to SQLITE_BUSY_TIMEOUT_MS for locks instead of failing
+    right away. Connections are shared between scheduler and request threads through the pool.
+    """
+    pool_size = int(os.getenv('DB_POOL_SIZE', "10"))
+    max_overflow = int(os.getenv('DB_MAX_OVERFLOW', "20"))
+    if not database_url.startswith('sqlite'):
+        return create_engine(
+            database_url,
+            pool_size=pool_size,
+            max_overflow=max_overflow,
+            pool_pre_ping=True, # Drop connections closed by the server between replay ticks
+            pool_recycle=int(os.getenv('DB_POOL_RECYCLE_SECONDS', "1800"))
+        )
+
+    sqlite_engine = create_engine(
+        database_url,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        connect_args={'check_same_thread': False, 'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}
+    )
+
+    @event.listens_for(sqlite_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+        cursor.close()
+
+    return sqlite_engine
+
+engine = build_engine(DATABASE_URL)
 Base = declarative_base()
 
 # Define the ReplicationTask model
@@ -28,15 +70,122 @@ class ReplicationTask(Base):
     source_token = Column(String)
     dest_url = Column(String)
     dest_token = Column(String)
-    # Store history and item_mapping as JSON
-    history = Column(JSON)
-    item_mapping = Column(JSON)
-    last_sent_index = Column(JSON)
+    # Store item_mapping as JSON. The history and last_sent_index columns are legacy: replay
+    # history now lives in the replay_history table and progress in the cycle cursor below;
+    # old values are migrated on the first replay run.
+    # JSON columns are deferred so status queries don't load and decode them; the replay_state
+    # group is loaded together the first time one of its columns is accessed.
+    history = deferred(Column(JSON))
+    item_mapping = deferred(Column(JSON), group='replay_state')
+    last_sent_index = deferred(Column(JSON), group='replay_state')
+    # Problem simulation: {source_itemid: scenario rule name} classified when the mapping is built,
+    # and {source_itemid: remaining problem points} of the problems currently simulated
+    problem_items = deferred(Column(JSON), group='replay_state')
+    problem_state = deferred(Column(JSON), group='replay_state')
+    problem_profile = Column(String) # Digest of the scenario profile problem_items was classified with
+    problem_packets = Column(Integer) # Packets simulated so far, seeds the task's RNG with a seeded profile
+    # Replay cursor: every item has sent its first cycle_offset points, and the first
+    # cycle_item_offset items (in item ID order) have also sent point number cycle_offset.
     cycle_offset = Column(Integer, default=0)
+    cycle_item_offset = Column(Integer, default=0)
+    # Replay mode of this task ("tick" or "timed"); None uses the REPLAY_MODE setting
+    replay_mode = Column(String)
+    # Timed replay cursor: every point with an original clock up to replayed_until has been sent
+    # in the cycle that started at cycle_started_at (Unix time)
+    replayed_until = Column(Integer)
+    cycle_started_at = Column(Float)
+    # A clock with more points than one tick sends is split between ticks: the points at clock
+    # replayed_until + 1 up to (replayed_itemid, replayed_seq) have been sent as well
+    replayed_itemid = Column(String)
+    replayed_seq = Column(Integer)
+    # Timed replay speed multiplier of this task; None uses the REPLAY_SPEED setting
+    replay_speed = Column(Float)
+    # Values per second this task may send; None uses the REPLAY_RATE_LIMIT_PER_TASK setting
+    rate_limit = Column(Float)
+    # Bulk replication batch the task was queued by (None for single host replications)
+    batch_id = Column(String)
+    # Rolling history: source history has been fetched completely up to this clock
+    history_fetched_until = Column(Integer)
+    # Standalone replay workers: worker holding the task's replay lease, and when the lease expires
+    replay_owner = Column(String)
+    replay_lease_expires_at = Column(Float)
+    # Setup (replication pipeline or re-linking): process holding the task's setup lease, when the lease
+    # expires, and how often the task was claimed from the bulk replication queue
+    setup_owner = Column(String)
+    setup_lease_expires_at = Column(Float)
+    setup_attempts = Column(Integer)
+    # Incremented whenever the stored history is replaced, so replay caches of the old history are dropped
+    history_generation = Column(Integer)
     progress = Column(Float, default=0.0)
 
-# Create the table if it doesn't exist
+# Replay history, one row per point. Rows are keyed by (source_host_id, itemid, seq) so the
+# replay job can read just the next point of each item instead of a whole day of history.
+class HistoryPoint(Base):
+    __tablename__ = 'replay_history'
+    __table_args__ = (
+        Index('ix_replay_history_clock', 'source_host_id', 'clock'), # Timed replay reads points by clock range
+        {'sqlite_with_rowid': False} # Clustered on the primary key, no extra rowid index
+    )
+
+    source_host_id = Column(String, primary_key=True)
+    itemid = Column(String, primary_key=True)
+    seq = Column(Integer, primary_key=True) # Position of the point within the item's history (clock order)
+    clock = Column(Integer, nullable=False)
+    value = Column(Text)
+    value_type = Column(Integer) # Zabbix value type of the item; values of rows without one are never converted
+
+# Leases used to elect a single process for work that must not run in every gunicorn worker
+# (e.g. the replay scheduler). A lease is held while its holder keeps renewing it.
+class Lease(Base):
+    __tablename__ = 'leases'
+
+    name = Column(String, primary_key=True)
+    holder = Column(String) # hostname:pid:random suffix of the owning process
+    expires_at = Column(Float) # Unix time after which another process may take over
+
+# Standalone replay worker processes (replay_worker.py). Each live worker owns a consistent-hash
+# shard of the replication tasks; workers that stop heartbeating drop out of the ring.
+class ReplayWorker(Base):
+    __tablename__ = 'replay_workers'
+
+    worker_id = Column(String, primary_key=True) # hostname:pid:random suffix
+    hostname = Column(String)
+    pid = Column(Integer)
+    started_at = Column(Float)
+    last_heartbeat = Column(Float)
+
+# Bulk replication requests. The hosts of a batch are ReplicationTask rows queued with its
+# batch_id; replication workers claim and set them up one by one.
+class ReplicationBatch(Base):
+    __tablename__ = 'replication_batches'
+
+    batch_id = Column(String, primary_key=True)
+    created_at = Column(Float)
+    source_host_ids = Column(JSON) # Hosts requested in the batch, in request order
+    skipped = Column(JSON) # {source_host_id: reason} for hosts that were not queued
+
+def add_missing_columns(engine, model):
+    """
+    Adds columns defined on the model but missing from an existing table.
+
+    create_all only creates missing tables, so databases created by earlier versions
+    get new columns here. Only nullable columns without server defaults are supported.
+    """
+    table = model.__table__
+    existing = {column['name'] for column in inspect(engine).get_columns(table.name)}
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name not in existing:
+                column_type = column.type.compile(dialect=engine.dialect)
+                connection.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+                logging.info(f"Added column {table.name}.{column.name} to the database.")
+
+# Create the tables if they don't exist
 Base.metadata.create_all(engine)
+add_missing_columns(engine, ReplicationTask)
+add_missing_columns(engine, HistoryPoint)
+for index in HistoryPoint.__table__.indexes:
+    index.create(engine, checkfirst=True) # Indexes added to existing tables
 
 # Create a session factory
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
@@ -45,9 +194,104 @@ SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 config = {
     "source_url": os.getenv('SOURCE_ZABBIX_URL', ""),
     "source_token": os.getenv('SOURCE_ZABBIX_TOKEN', ""),
+    # Source API TLS certificate check, request timeout and optional HTTP basic auth (web server in front of the API)
+    "source_validate_certs": os.getenv('SOURCE_ZABBIX_VALIDATE_CERTS', "true").lower() in ('1', 'true', 'yes'),
+    "source_timeout": int(os.getenv('SOURCE_ZABBIX_TIMEOUT', "30")),
+    "source_http_user": os.getenv('SOURCE_ZABBIX_HTTP_USER', ""),
+    "source_http_password": os.getenv('SOURCE_ZABBIX_HTTP_PASSWORD', ""),
     "dest_url": os.getenv('DEST_ZABBIX_URL', ""),
     "dest_token": os.getenv('DEST_ZABBIX_TOKEN', ""),
     "dest_trapper_host": os.getenv('DEST_TRAPPER_HOST', ""),
     "dest_trapper_port": int(os.getenv('DEST_TRAPPER_PORT', "10051")),
-    "replay_duration_hours": int(os.getenv('REPLAY_DURATION_HOURS', "24")) # New config for replay duration
+    "replay_duration_hours": int(os.getenv('REPLAY_DURATION_HOURS', "24")), # New config for replay duration
+    # Replay engine: one scheduler job replays every active task each interval.
+    # REPLAY_ENGINE selects the threaded engine ("threaded") or the asyncio pipeline ("async").
+    "replay_engine": os.getenv('REPLAY_ENGINE', "threaded"),
+    "replay_async_concurrency": int(os.getenv('REPLAY_ASYNC_CONCURRENCY', "16")), # Trapper sends in flight (async engine)
+    "replay_interval_seconds": float(os.getenv('REPLAY_INTERVAL_SECONDS', "60")), # May be fractional for finer scheduling
+    # REPLAY_MODE "tick" sends one point per item per tick; "timed" sends points as their original spacing elapses
+    "replay_mode": os.getenv('REPLAY_MODE', "tick"),
+    # Timed replay speed: 24.0 replays 24h of history in 1h. Tasks may override it (replay_speed).
+    "replay_speed": float(os.getenv('REPLAY_SPEED', "1.0")),
+    # Replay rate limit in values per second (0 = unlimited), optionally ramped up from REPLAY_RATE_RAMP_START.
+    # It and the per-endpoint limit cover all replay workers: each live worker gets an equal share.
+    "replay_rate_limit": float(os.getenv('REPLAY_RATE_LIMIT', "0")),
+    "replay_rate_ramp_start": float(os.getenv('REPLAY_RATE_RAMP_START', "0")),
+    "replay_rate_ramp_seconds": int(os.getenv('REPLAY_RATE_RAMP_SECONDS', "0")),
+    "replay_rate_limit_per_endpoint": float(os.getenv('REPLAY_RATE_LIMIT_PER_ENDPOINT', "0")), # Per trapper endpoint
+    "replay_rate_limit_per_task": float(os.getenv('REPLAY_RATE_LIMIT_PER_TASK', "0")), # Tasks may override it (rate_limit)
+    # Backpressure: back off when a tick sees more failed values or slower trapper responses than this
+    "replay_backoff_failed_ratio": float(os.getenv('REPLAY_BACKOFF_FAILED_RATIO', "0.01")),
+    "replay_backoff_latency_seconds": float(os.getenv('REPLAY_BACKOFF_LATENCY_SECONDS', "5")),
+    "replay_backoff_decrease": float(os.getenv('REPLAY_BACKOFF_DECREASE', "0.5")), # Budget multiplier on congestion
+    "replay_backoff_increase": int(os.getenv('REPLAY_BACKOFF_INCREASE', "500")), # Points per tick added back per healthy tick
+    "replay_backoff_min_points": int(os.getenv('REPLAY_BACKOFF_MIN_POINTS', "100")),
+    "replay_max_points_per_tick": int(os.getenv('REPLAY_MAX_POINTS_PER_TICK', "100000")), # Budget shared by all tasks
+    "replay_max_points_per_task": int(os.getenv('REPLAY_MAX_POINTS_PER_TASK', "5000")),
+    # Problem simulation: scenario profile file (JSON/YAML, "off" disables, empty = built-in) and optional RNG seed
+    "problem_scenario": os.getenv('PROBLEM_SCENARIO', ""),
+    "problem_seed": os.getenv('PROBLEM_SEED', ""),
+    "trapper_chunk_size": int(os.getenv('TRAPPER_CHUNK_SIZE', "1000")), # Values per trapper packet
+    # Trapper sender pool: optional comma separated host[:port] list to spread replay load over
+    "dest_trapper_endpoints": os.getenv('DEST_TRAPPER_ENDPOINTS', ""),
+    "trapper_max_connections": int(os.getenv('TRAPPER_MAX_CONNECTIONS', "4")), # Concurrent sends per endpoint
+    "trapper_timeout": int(os.getenv('TRAPPER_TIMEOUT', "10")),
+    "trapper_max_packet_bytes": int(os.getenv('TRAPPER_MAX_PACKET_BYTES', "1048576")),
+    # Source history fetch: history.get calls are split by item chunks and time windows
+    "history_fetch_workers": int(os.getenv('HISTORY_FETCH_WORKERS', "4")),
+    "history_fetch_item_chunk": int(os.getenv('HISTORY_FETCH_ITEM_CHUNK', "100")), # Items per history.get call
+    "history_fetch_window_hours": int(os.getenv('HISTORY_FETCH_WINDOW_HOURS', "2")), # Time span per history.get call
+    "history_fetch_retries": int(os.getenv('HISTORY_FETCH_RETRIES', "3")),
+    # Rolling history: top up replayed hosts with new source history and drop points older than the replay window
+    "history_rolling": os.getenv('HISTORY_ROLLING', "false").lower() in ('1', 'true', 'yes'),
+    "history_topup_interval_seconds": int(os.getenv('HISTORY_TOPUP_INTERVAL_SECONDS', "300")),
+    "history_topup_lag_seconds": int(os.getenv('HISTORY_TOPUP_LAG_SECONDS', "60")), # Newest seconds left for the next top-up (late data)
+    "history_topup_overlap_seconds": int(os.getenv('HISTORY_TOPUP_OVERLAP_SECONDS', "300")), # Re-read before the last top-up's end
+    # Destination setup: objects per array-form *.create call
+    "item_create_batch_size": int(os.getenv('ITEM_CREATE_BATCH_SIZE', "200")),
+    # Destination host group/template/host lists are cached this long and shared by all replications
+    "dest_metadata_cache_seconds": int(os.getenv('DEST_METADATA_CACHE_SECONDS', "300")),
+    # Source host configuration is reused while its items and templates are unchanged, up to this age
+    "source_config_cache_seconds": int(os.getenv('SOURCE_CONFIG_CACHE_SECONDS', "600")),
+    # Bulk replication: hosts set up concurrently per web app process, and how often queued hosts are polled
+    "replication_workers": int(os.getenv('REPLICATION_WORKERS', "4")),
+    "replication_queue_poll_seconds": float(os.getenv('REPLICATION_QUEUE_POLL_SECONDS', "5")),
+    # How long a process's claim on a task it sets up lasts without renewal; abandoned setups are re-queued after it
+    "replication_lease_seconds": float(os.getenv('REPLICATION_LEASE_SECONDS', "120")),
+    # Scheduler leader election: only the process holding the lease runs scheduled jobs
+    "scheduler_lease_seconds": int(os.getenv('SCHEDULER_LEASE_SECONDS', "30")),
+    # Replay workers: set REPLAY_IN_WEB=false when replay runs in replay_worker.py processes instead of the web app
+    "replay_in_web": os.getenv('REPLAY_IN_WEB', "true").lower() in ('1', 'true', 'yes'),
+    "replay_worker_heartbeat_seconds": int(os.getenv('REPLAY_WORKER_HEARTBEAT_SECONDS', "10")),
+    "replay_worker_timeout_seconds": int(os.getenv('REPLAY_WORKER_TIMEOUT_SECONDS', "30")), # Missed heartbeats before a worker's shard moves
+    # How long a worker's claim on a task lasts without renewal (0 = worker timeout + two replay intervals)
+    "replay_task_lease_seconds": float(os.getenv('REPLAY_TASK_LEASE_SECONDS', "0"))
 }
+
+# --- Global Configuration for Item Skipping ---
+SKIP_KEY_PREFIXES = ['MTR'] # Keys starting with these prefixes will be skipped
+
+def source_api_options():
+    """Returns the ZabbixAPI keyword arguments for connecting to the source (TLS, timeout, basic auth)."""
+    return {
+        "validate_certs": config.get("source_validate_certs", True),
+        "timeout": config.get("source_timeout", 30),
+        "http_user": config.get("source_http_user") or None,
+        "http_password": config.get("source_http_password") or None,
+    }
+
+def should_skip_item(item_name, item_key):
+    """
+    Determines if an item should be skipped based on predefined rules.
+    """
+    # Rule 1: Skip items with '<' in their name (dynamic interfaces)
+    if '<' in item_name and '>' in item_name:
+        logging.info(f"Skipping item '{item_name}' (key: {item_key}) due to dynamic interface pattern '<...>' in name.")
+        return True
+
+    # Rule 2: Skip items whose key starts with any of the defined prefixes
+    for prefix in SKIP_KEY_PREFIXES:
+        if item_key.startswith(prefix):
+            logging.info(f"Skipping item '{item_name}' (key: {item_key}) as its key starts with '{prefix}'.")
+            return True
+    return False
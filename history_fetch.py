@@ -0,0 +1,468 @@
+import base64
+import codecs
+import json
+import logging
+import random
+import re
+import ssl
+import time
+import urllib.request
+import uuid
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from common import config, should_skip_item, source_api_options
+from history_store import (HistoryWriter, clear_history, get_item_watermarks, load_values_at_clocks,
+                           replace_with_staged_history, staging_host_id)
+from metrics import HISTORY_RECORDS_FETCHED, observe_api_call
+from series import ReplaySeries, StringTable, series_kind_for_value_type
+
+# Only these fields are requested from history.get
+HISTORY_FIELDS = ['itemid', 'clock', 'value']
+# Bytes read from the API response per iteration when streaming
+STREAM_READ_SIZE = 65536
+_RESULT_ARRAY_START = re.compile(r'"result"\s*:\s*\[')
+
+
+def get_history_value_type(item_value_type):
+    """Maps Zabbix item value_type to history table type for history.get."""
+    # Zabbix value types: 0 = numeric float, 1 = character, 2 = log, 3 = numeric unsigned, 4 = text
+    mapping = {
+        '0': 0, # Numeric float -> history
+        '3': 3, # Numeric unsigned -> history_uint
+        '1': 1, # Character -> history_str
+        '4': 4, # Text -> history_text
+        '2': 2, # Log -> history_log
+    }
+    return mapping.get(str(item_value_type)) # Ensure input is string for lookup
+
+
+def group_items_by_history_type(source_items):
+    """
+    Groups fetchable source item IDs by history value type, skipping filtered items.
+
+    Returns:
+        dict: {history_type: [itemid, ...]}
+    """
+    item_ids_by_type = {}
+    for item in source_items:
+        item_id = item['itemid']
+        item_name = item.get('name', '')
+        item_key = item.get('key_', '')
+
+        # Check if item should be skipped based on predefined rules
+        if should_skip_item(item_name, item_key):
+            continue
+
+        value_type = item['value_type']
+        history_type = get_history_value_type(value_type)
+
+        if history_type is None:
+            logging.warning(f"Item '{item_name}' (ID: {item_id}, Key: {item_key}) has value type {value_type} which cannot be fetched via history.get. Skipping history fetch.")
+            continue
+
+        item_ids_by_type.setdefault(history_type, []).append(item_id)
+    return item_ids_by_type
+
+
+def plan_history_chunks(item_ids_by_type, time_from, time_till, item_chunk_size, window_seconds):
+    """
+    Splits a history fetch into (item chunk x time window) requests.
+
+    Windows don't overlap (history.get bounds are inclusive), so every point is fetched once.
+
+    Returns:
+        list: [(group_index, window_index, history_type, item_ids, window_from, window_till), ...]
+        in group/window order.
+    """
+    windows = []
+    window_from = time_from
+    while window_from <= time_till:
+        window_till = min(window_from + window_seconds - 1, time_till)
+        windows.append((window_from, window_till))
+        window_from = window_till + 1
+
+    chunks = []
+    group_index = 0
+    for history_type, item_ids in item_ids_by_type.items():
+        for i in range(0, len(item_ids), item_chunk_size):
+            group_item_ids = item_ids[i:i + item_chunk_size]
+            for window_index, (window_from, window_till) in enumerate(windows):
+                chunks.append((group_index, window_index, history_type, group_item_ids, window_from, window_till))
+            group_index += 1
+    return chunks
+
+
+def iter_json_array(response, key_pattern=_RESULT_ARRAY_START, read_size=STREAM_READ_SIZE):
+    """
+    Incrementally decodes the objects of a JSON-RPC response's "result" array.
+
+    Only the unparsed tail of the response is kept in memory. If the response has no
+    result array (a JSON-RPC error), the whole body is decoded and the error raised.
+
+    Args:
+        response: File-like object returning bytes
+    """
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    buf = ''
+    pos = None # Position after the last consumed array element, None until the array starts
+    eof = False
+
+    while True:
+        if not eof:
+            data = response.read(read_size)
+            eof = not data
+            buf += text_decoder.decode(data, final=eof)
+
+        if pos is None:
+            match = key_pattern.search(buf)
+            if not match:
+                if eof:
+                    body = json.loads(buf)
+                    raise RuntimeError(f"Zabbix API error: {body.get('error', body)}")
+                continue
+            pos = match.end()
+
+        while True:
+            # Skip separators between elements
+            while pos < len(buf) and buf[pos] in ' \t\r\n,':
+                pos += 1
+            if pos >= len(buf):
+                break
+            if buf[pos] == ']':
+                return
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+                break # Element is incomplete, read more
+            yield obj
+            pos = end
+
+        # Drop the consumed part of the buffer
+        buf = buf[pos:]
+        pos = 0
+        if eof:
+            raise ValueError("Unexpected end of history.get response")
+
+
+class HistoryStream:
+    """
+    Sends source API requests itself and decodes their result arrays as they stream in.
+
+    The URL and token come from the task, TLS, timeout and HTTP basic auth from the
+    SOURCE_ZABBIX_* settings (see common.source_api_options), so nothing is read out of
+    a zabbix_utils ZabbixAPI object. The API version, which decides how the token is
+    sent, is looked up with apiinfo.version on first use.
+    """
+
+    def __init__(self, url, token, validate_certs=True, timeout=30, http_user=None, http_password=None, api_version=None):
+        url = url if url.endswith('api_jsonrpc.php') else url.rstrip('/') + '/api_jsonrpc.php'
+        self.url = url if url.startswith('http') else 'http://' + url
+        self.token = token
+        self.timeout = timeout
+        self.basic_auth = base64.b64encode(f"{http_user}:{http_password}".encode('utf-8')).decode('ascii') \
+            if http_user and http_password else None
+        self.ssl_context = None
+        if not validate_certs:
+            self.ssl_context = ssl.create_default_context()
+            self.ssl_context.check_hostname = False
+            self.ssl_context.verify_mode = ssl.CERT_NONE
+        self.api_version = api_version
+
+    @classmethod
+    def from_config(cls, url, token):
+        """Returns a stream for the given source URL and token with the configured connection options."""
+        return cls(url, token, **source_api_options())
+
+    def _open(self, request_json, headers):
+        headers = dict(headers, **{'Accept': 'application/json', 'Content-Type': 'application/json-rpc'})
+        if self.basic_auth is not None:
+            headers['Authorization'] = f"Basic {self.basic_auth}"
+        req = urllib.request.Request(self.url, data=json.dumps(request_json).encode('utf-8'), headers=headers, method='POST')
+        return urllib.request.urlopen(req, context=self.ssl_context, timeout=self.timeout)
+
+    def version(self):
+        """Returns the source API version as a float (e.g. 6.4), looked up once."""
+        if self.api_version is None:
+            request_json = {'jsonrpc': '2.0', 'method': 'apiinfo.version', 'params': {}, 'id': str(uuid.uuid4())}
+            with self._open(request_json, {}) as response:
+                body = json.load(response)
+            if 'result' not in body:
+                raise RuntimeError(f"Zabbix API error: {body.get('error', body)}")
+            self.api_version = float('.'.join(body['result'].split('.')[:2]))
+        return self.api_version
+
+    def request(self, method, params):
+        """Sends an API request and yields the elements of its result array as they are parsed."""
+        request_json = {
+            'jsonrpc': '2.0',
+            'method': method,
+            'params': params,
+            'id': str(uuid.uuid4()),
+        }
+        headers = {}
+        version = self.version()
+        # Same rules as zabbix_utils: the token goes in the body before 6.4, and up to 7.0
+        # when basic auth takes the Authorization header
+        if version < 6.4 or (self.basic_auth is not None and version <= 7.0):
+            request_json['auth'] = self.token
+        else:
+            headers['Authorization'] = f"Bearer {self.token}"
+
+        started = time.perf_counter()
+        ok = False
+        try:
+            with self._open(request_json, headers) as response:
+                yield from iter_json_array(response)
+            ok = True
+        finally:
+            # Bypasses ZabbixAPI.send_api_request, so it is recorded here (time includes decoding)
+            observe_api_call(method, time.perf_counter() - started, ok)
+
+
+def history_get_records(source_zapi, params, stream=None):
+    """
+    Returns an iterator over history.get records.
+
+    With a HistoryStream the response is streamed and decoded incrementally; otherwise
+    the API client makes a regular history.get call.
+    """
+    if stream is not None:
+        return stream.request('history.get', params)
+    return iter(source_zapi.history.get(**params))
+
+
+def fetch_history_chunk(source_zapi, chunk, max_retries=3, base_delay=0.5, strings=None, stream=None):
+    """
+    Fetches one (item chunk x time window) of history, retrying on errors.
+
+    Records are appended straight into per-item ReplaySeries as the response is parsed,
+    so no list of record dicts is built. Text values are interned in the shared
+    StringTable if one is given. With a HistoryStream the response is streamed.
+
+    Returns:
+        dict: {itemid: ReplaySeries} in clock order, or None if every attempt failed
+    """
+    _, _, history_type, item_ids, window_from, window_till = chunk
+    params = {
+        "output": HISTORY_FIELDS,
+        "history": history_type,
+        "itemids": item_ids,
+        "time_from": window_from,
+        "time_till": window_till,
+        "sortfield": "clock",
+        "sortorder": "ASC"
+    }
+    for attempt in range(max_retries):
+        try:
+            kind = series_kind_for_value_type(history_type)
+            buffers = {}
+            for record in history_get_records(source_zapi, params, stream):
+                series = buffers.get(record['itemid'])
+                if series is None:
+                    series = buffers[record['itemid']] = ReplaySeries(kind, strings)
+                series.append(record['clock'], record['value'])
+            return buffers
+        except Exception as e:
+            if attempt < max_retries - 1:
+                delay = base_delay * (2 ** attempt) + random.uniform(0, 0.1) # Exponential backoff with jitter
+                logging.warning(f"Error fetching history for {len(item_ids)} items ({window_from}-{window_till}), retrying in {delay:.2f} seconds (attempt {attempt + 1}/{max_retries}): {e}")
+                time.sleep(delay)
+            else:
+                logging.error(f"Error fetching history for item IDs {item_ids} ({window_from}-{window_till}) after {max_retries} attempts: {e}", exc_info=True)
+    return None
+
+
+def point_key(clock, value):
+    """Returns a comparable (clock, value) of a point, whether the value is a stored string or a decoded number."""
+    try:
+        return int(clock), float(value)
+    except (TypeError, ValueError):
+        return int(clock), value
+
+def write_history_chunks(chunks, source_zapi, writer, skip_until=None, stored=None, stream=None):
+    """
+    Fetches history chunks on a bounded thread pool and appends them to a HistoryWriter.
+
+    At most twice as many chunks as workers are in flight, which bounds peak memory
+    regardless of how much history is fetched. Completed windows are written per item
+    chunk in window order, so every item's points are appended in clock order.
+
+    Args:
+        skip_until: Optional {itemid: clock}; points of an item up to that clock are
+            already stored and skipped
+        stored: Optional {itemid: Counter of point_key()} of points already stored after
+            skip_until; fetched points matching one of them are skipped (once each)
+        stream: Optional HistoryStream the responses are streamed from
+
+    Returns:
+        int: Number of chunks that failed after retries
+    """
+    ready = {} # {group_index: {window_index: records}} completed out of order
+    group_types = {group_index: history_type for group_index, _, history_type, *_ in chunks} # Value type of each item chunk
+    next_window = {} # {group_index: next window index to write}
+    failed_chunks = 0
+
+    workers = config.get('history_fetch_workers', 4)
+    max_in_flight = workers * 2
+    pending_chunks = iter(chunks)
+    in_flight = {}
+    strings = StringTable() # Text values shared by all chunks of this fetch
+
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix='history-fetch') as executor:
+        while True:
+            # Keep a bounded number of chunks in flight, submitted in group/window order
+            for chunk in pending_chunks:
+                in_flight[executor.submit(fetch_history_chunk, source_zapi, chunk, config.get('history_fetch_retries', 3),
+                                          strings=strings, stream=stream)] = chunk
+                if len(in_flight) >= max_in_flight:
+                    break
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                group_index, window_index = in_flight.pop(future)[:2]
+                buffers = future.result()
+                if buffers is None:
+                    failed_chunks += 1
+                    buffers = {}
+                ready.setdefault(group_index, {})[window_index] = buffers
+
+                # Write this item chunk's windows that are now contiguous, in clock order
+                group_ready = ready[group_index]
+                window = next_window.get(group_index, 0)
+                while window in group_ready:
+                    for itemid, series in group_ready.pop(window).items():
+                        stored_until = skip_until.get(str(itemid)) if skip_until else None
+                        stored_points = stored.get(str(itemid)) if stored else None
+                        for clock, value in series:
+                            if stored_until is not None and clock <= stored_until:
+                                continue
+                            if stored_points:
+                                key = point_key(clock, value)
+                                if stored_points[key] > 0:
+                                    stored_points[key] -= 1 # Same point stored by the previous top-up
+                                    continue
+                            writer.append(itemid, clock, value, group_types[group_index])
+                    window += 1
+                next_window[group_index] = window
+                writer.flush()
+    return failed_chunks
+
+
+def fetch_history(source_items, source_zapi, db, source_host_id, time_from=None, stream=None):
+    """
+    Fetches history for the given source items and writes it to the history store.
+
+    The fetch is split into item chunks and time windows that run on a bounded thread
+    pool against the source API (see write_history_chunks). Responses are decoded as
+    they stream in. A failed chunk is retried on its own and, if it keeps failing, only
+    its window is lost.
+
+    The points are staged under a separate ID and committed window by window, so the
+    fetch doesn't hold the write lock that replay commits, leader leases and other
+    replications need. The host's existing history stays readable until one short
+    transaction at the end replaces it with the staged points.
+
+    Args:
+        stream: Optional HistoryStream for the source; without one history.get goes
+            through source_zapi and responses are not streamed
+
+    Returns:
+        tuple: (total_records, first_clock) - first_clock is None if no history was found
+    """
+    item_ids_by_type = group_items_by_history_type(source_items)
+
+    time_till = int(time.time())
+    if time_from is None:
+        # Default to last 12 hours if no time_from is provided (for initial fetch)
+        time_from = time_till - (12 * 60 * 60)
+
+    chunks = plan_history_chunks(
+        item_ids_by_type,
+        time_from,
+        time_till,
+        config.get('history_fetch_item_chunk', 100),
+        config.get('history_fetch_window_hours', 2) * 3600
+    )
+
+    staging_id = staging_host_id(source_host_id)
+    clear_history(db, staging_id) # Leftovers of an interrupted fetch
+    db.commit()
+    writer = HistoryWriter(db, staging_id, commit=True)
+    started = time.time()
+    failed_chunks = write_history_chunks(chunks, source_zapi, writer, stream=stream)
+
+    replace_with_staged_history(db, source_host_id)
+    db.commit()
+    HISTORY_RECORDS_FETCHED.inc(writer.total_points, mode='full')
+    elapsed = time.time() - started
+    rate = writer.total_points / elapsed if elapsed > 0 else 0
+    logging.info(f"Stored {writer.total_points} history records for {len(writer.next_seq)} items of source host {source_host_id} "
+                 f"in {elapsed:.1f}s ({rate:.0f} records/s, {len(chunks)} chunks, {failed_chunks} failed).")
+    return writer.total_points, writer.first_clock
+
+
+def top_up_history(source_items, source_zapi, db, source_host_id, fetched_until=None, default_time_from=None, stream=None):
+    """
+    Appends history recorded since the last fetch to the history store.
+
+    The fetch ends HISTORY_TOPUP_LAG_SECONDS before now, so values the source receives
+    late are picked up by the next top-up. Each item continues from its own watermark:
+    its last stored clock, or fetched_until minus HISTORY_TOPUP_OVERLAP_SECONDS if that is
+    later. One history.get window starts at the oldest watermark. Re-read points an item
+    already has are skipped by (itemid, clock, value), so points sharing the last stored
+    second are kept and a failed chunk is simply fetched again next time. Points older
+    than an item's last stored clock are not appended (seq order is clock order).
+    Stored points keep their seq numbers.
+
+    Args:
+        fetched_until: Clock up to which the previous fetch was complete, if known
+        default_time_from: Start for items without stored history when fetched_until is unknown
+        stream: Optional HistoryStream the responses are streamed from
+
+    Returns:
+        tuple: (new_records, time_till) - time_till is None if some chunks failed, i.e. the
+        fetch is not complete up to time_till and the watermark must not move
+    """
+    item_ids_by_type = group_items_by_history_type(source_items)
+    time_till = int(time.time()) - config.get('history_topup_lag_seconds', 60)
+    watermarks = get_item_watermarks(db, source_host_id) # {itemid: (last_seq, last_clock)}
+    if fetched_until is not None:
+        fallback = fetched_until - config.get('history_topup_overlap_seconds', 300)
+    else:
+        fallback = default_time_from
+    skip_until = {}
+    last_clocks = {}
+    for item_ids in item_ids_by_type.values():
+        for itemid in item_ids:
+            last_clock = watermarks.get(str(itemid), (None, None))[1]
+            if last_clock is not None and (fallback is None or last_clock > fallback):
+                # Re-read the item's last stored second, other points may share it
+                skip_until[str(itemid)] = last_clock - 1
+                last_clocks[str(itemid)] = last_clock
+            else:
+                skip_until[str(itemid)] = fallback if fallback is not None else time_till - 3600
+    if not skip_until:
+        return 0, time_till
+    stored = {itemid: Counter(point_key(last_clocks[itemid], value) for value in values)
+              for itemid, values in load_values_at_clocks(db, source_host_id, last_clocks).items()}
+
+    time_from = min(skip_until.values()) + 1
+    chunks = plan_history_chunks(
+        item_ids_by_type,
+        time_from,
+        time_till,
+        config.get('history_fetch_item_chunk', 100),
+        config.get('history_fetch_window_hours', 2) * 3600
+    )
+    writer = HistoryWriter(db, source_host_id, next_seq={itemid: last_seq + 1 for itemid, (last_seq, _) in watermarks.items()})
+    failed_chunks = write_history_chunks(chunks, source_zapi, writer, skip_until=skip_until, stored=stored, stream=stream)
+    HISTORY_RECORDS_FETCHED.inc(writer.total_points, mode='top_up')
+    logging.info(f"Topped up {writer.total_points} history records for source host {source_host_id} "
+                 f"({time_till - time_from}s since the oldest item watermark, {failed_chunks} failed chunks).")
+    return writer.total_points, (time_till if failed_chunks == 0 else None)
@@ -0,0 +1,285 @@
+import heapq
+import logging
+from itertools import islice
+
+from sqlalchemy import and_, func, insert, or_, tuple_
+
+from common import HistoryPoint
+from series import KIND_TEXT, ReplaySeries, series_kind_for_value_type
+
+# Rows buffered by HistoryWriter before they are flushed to the database
+WRITE_BATCH_SIZE = 5000
+# Max item IDs or (itemid, clock) pairs per lookup query, keeps us well below SQLite's bound-parameter limit
+READ_BATCH_SIZE = 400
+# Suffix of the source host ID a full history fetch is staged under until it replaces the stored history
+STAGING_SUFFIX = ':staging'
+
+
+class HistoryWriter:
+    """
+    Appends history points for one source host to the replay_history table.
+
+    Points must be appended in clock order per item; each item gets consecutive
+    seq numbers starting at 0, or after the item's last stored seq when next_seq is
+    given (to top up existing history). Rows are buffered and bulk inserted every
+    WRITE_BATCH_SIZE points so callers can stream history in without holding it all.
+    With commit=True every flush is committed, so a long fetch never holds the
+    database's write lock for more than one batch.
+    """
+
+    def __init__(self, db, source_host_id, batch_size=WRITE_BATCH_SIZE, next_seq=None, commit=False):
+        self.db = db
+        self.source_host_id = str(source_host_id)
+        self.batch_size = batch_size
+        self.commit = commit
+        self.next_seq = dict(next_seq or {}) # {itemid: next seq number}
+        self.pending = []
+        self.total_points = 0
+        self.first_clock = None
+
+    def append(self, itemid, clock, value, value_type=None):
+        """Queues a single point for the given item (value_type: the item's Zabbix value type, if known)."""
+        itemid = str(itemid)
+        clock = int(clock)
+        seq = self.next_seq.get(itemid, 0)
+        self.next_seq[itemid] = seq + 1
+        self.pending.append({
+            "source_host_id": self.source_host_id,
+            "itemid": itemid,
+            "seq": seq,
+            "clock": clock,
+            "value": value,
+            "value_type": value_type
+        })
+        self.total_points += 1
+        if self.first_clock is None or clock < self.first_clock:
+            self.first_clock = clock
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        """Writes buffered points to the database (within the caller's transaction, unless commit is set)."""
+        if not self.pending:
+            return
+        self.db.execute(insert(HistoryPoint.__table__), self.pending)
+        self.pending = []
+        if self.commit:
+            self.db.commit()
+
+
+def bump_history_generation(task):
+    """Marks a task's stored history as replaced, so replay caches of the old history are not reused."""
+    task.history_generation = (task.history_generation or 0) + 1
+
+
+def clear_history(db, source_host_id):
+    """Deletes all stored history points for a source host."""
+    return db.query(HistoryPoint).filter(HistoryPoint.source_host_id == str(source_host_id)).delete(synchronize_session=False)
+
+
+def staging_host_id(source_host_id):
+    """Returns the ID a full history fetch for a source host is staged under."""
+    return f"{source_host_id}{STAGING_SUFFIX}"
+
+
+def replace_with_staged_history(db, source_host_id):
+    """
+    Replaces a host's stored history with its staged history (within the caller's transaction).
+
+    Only this swap takes the write lock for the whole host; the staged rows were
+    written and committed batch by batch while the fetch ran.
+
+    Returns:
+        int: Number of points moved from the staging area
+    """
+    clear_history(db, source_host_id)
+    return db.query(HistoryPoint) \
+        .filter(HistoryPoint.source_host_id == staging_host_id(source_host_id)) \
+        .update({HistoryPoint.source_host_id: str(source_host_id)}, synchronize_session=False)
+
+
+def get_item_seq_bounds(db, source_host_id):
+    """
+    Returns the first stored seq and the number of points per item.
+
+    seq numbers are never reused: pruning old points leaves an item's history starting at
+    a later seq, so the n-th stored point of an item has seq first_seq + n.
+
+    Returns:
+        dict: {itemid: (first_seq, point_count)}
+    """
+    rows = db.query(HistoryPoint.itemid, func.min(HistoryPoint.seq), func.count(HistoryPoint.seq)) \
+        .filter(HistoryPoint.source_host_id == str(source_host_id)) \
+        .group_by(HistoryPoint.itemid) \
+        .all()
+    return {itemid: (first_seq, count) for itemid, first_seq, count in rows}
+
+
+def get_item_watermarks(db, source_host_id):
+    """
+    Returns the last stored seq and clock per item, where a history top-up continues.
+
+    Returns:
+        dict: {itemid: (last_seq, last_clock)}
+    """
+    rows = db.query(HistoryPoint.itemid, func.max(HistoryPoint.seq), func.max(HistoryPoint.clock)) \
+        .filter(HistoryPoint.source_host_id == str(source_host_id)) \
+        .group_by(HistoryPoint.itemid) \
+        .all()
+    return {itemid: (last_seq, last_clock) for itemid, last_seq, last_clock in rows}
+
+
+def load_values_at_clocks(db, source_host_id, clocks):
+    """
+    Loads the stored values of each item at one clock (a top-up dedupes against them).
+
+    Args:
+        clocks: {itemid: clock}
+
+    Returns:
+        dict: {itemid: [value, ...]} of the items that have points at their clock
+    """
+    values = {}
+    keys = [(str(itemid), clock) for itemid, clock in clocks.items()]
+    for i in range(0, len(keys), READ_BATCH_SIZE):
+        rows = db.query(HistoryPoint.itemid, HistoryPoint.value) \
+            .filter(HistoryPoint.source_host_id == str(source_host_id)) \
+            .filter(tuple_(HistoryPoint.itemid, HistoryPoint.clock).in_(keys[i:i + READ_BATCH_SIZE])) \
+            .all()
+        for itemid, value in rows:
+            values.setdefault(itemid, []).append(value)
+    return values
+
+
+def prune_history(db, source_host_id, before_clock):
+    """Deletes a host's stored points with a clock before before_clock. Returns the number deleted."""
+    return db.query(HistoryPoint) \
+        .filter(HistoryPoint.source_host_id == str(source_host_id)) \
+        .filter(HistoryPoint.clock < before_clock) \
+        .delete(synchronize_session=False)
+
+
+def get_first_clock(db, source_host_id):
+    """Returns the earliest stored clock for a source host, or None if it has no history."""
+    return db.query(func.min(HistoryPoint.clock)).filter(HistoryPoint.source_host_id == str(source_host_id)).scalar()
+
+
+def get_last_clock(db, source_host_id):
+    """Returns the latest stored clock for a source host, or None if it has no history."""
+    return db.query(func.max(HistoryPoint.clock)).filter(HistoryPoint.source_host_id == str(source_host_id)).scalar()
+
+
+def load_points_by_clock(db, source_host_id, after_clock, until_clock, limit=None, after_key=None, itemids=None):
+    """
+    Loads the points with after_clock < clock <= until_clock in (clock, itemid, seq) order.
+
+    Args:
+        after_key: Optional (itemid, seq); points at clock after_clock + 1 up to this key
+            are skipped, so a clock that was partly read can be resumed
+        itemids: Optional item IDs to restrict the points to. More than READ_BATCH_SIZE
+            items are queried in chunks and the ordered results merged.
+
+    Returns:
+        list: [(itemid, clock, value, seq), ...]
+    """
+    if itemids is None:
+        return _load_points_by_clock(db, source_host_id, after_clock, until_clock, limit, after_key)
+    itemids = sorted(str(itemid) for itemid in itemids)
+    results = [_load_points_by_clock(db, source_host_id, after_clock, until_clock, limit, after_key, itemids[i:i + READ_BATCH_SIZE])
+               for i in range(0, len(itemids), READ_BATCH_SIZE)]
+    if len(results) == 1:
+        return results[0]
+    merged = heapq.merge(*results, key=lambda row: (row[1], row[0], row[3]))
+    return list(merged if limit is None else islice(merged, limit))
+
+
+def _load_points_by_clock(db, source_host_id, after_clock, until_clock, limit, after_key, itemids=None):
+    query = db.query(HistoryPoint.itemid, HistoryPoint.clock, HistoryPoint.value, HistoryPoint.seq) \
+        .filter(HistoryPoint.source_host_id == str(source_host_id)) \
+        .filter(HistoryPoint.clock > after_clock, HistoryPoint.clock <= until_clock)
+    if itemids is not None:
+        query = query.filter(HistoryPoint.itemid.in_(itemids))
+    if after_key is not None:
+        itemid, seq = str(after_key[0]), after_key[1]
+        query = query.filter(or_(
+            HistoryPoint.clock > after_clock + 1,
+            HistoryPoint.itemid > itemid,
+            and_(HistoryPoint.itemid == itemid, HistoryPoint.seq > seq),
+        ))
+    query = query.order_by(HistoryPoint.clock, HistoryPoint.itemid, HistoryPoint.seq)
+    if limit is not None:
+        query = query.limit(limit)
+    return query.all()
+
+
+def load_point_ranges(db, source_host_id, ranges):
+    """
+    Loads consecutive points of several items into compact series.
+
+    Args:
+        db: SQLAlchemy session
+        source_host_id: ID of the source host
+        ranges: {itemid: (from_seq, count)}
+
+    Returns:
+        dict: {itemid: ReplaySeries} holding the points from from_seq on (may be shorter than count)
+    """
+    # Items replayed in step share the same range, so load each distinct range with one query
+    items_by_range = {}
+    for itemid, item_range in ranges.items():
+        items_by_range.setdefault(item_range, []).append(str(itemid))
+
+    rows_by_item = {str(itemid): [] for itemid in ranges}
+    for (from_seq, count), itemids in items_by_range.items():
+        for i in range(0, len(itemids), READ_BATCH_SIZE):
+            rows = db.query(HistoryPoint.itemid, HistoryPoint.clock, HistoryPoint.value, HistoryPoint.value_type) \
+                .filter(HistoryPoint.source_host_id == str(source_host_id)) \
+                .filter(HistoryPoint.itemid.in_(itemids[i:i + READ_BATCH_SIZE])) \
+                .filter(HistoryPoint.seq >= from_seq, HistoryPoint.seq < from_seq + count) \
+                .order_by(HistoryPoint.itemid, HistoryPoint.seq) \
+                .all()
+            for itemid, clock, value, value_type in rows:
+                rows_by_item[itemid].append((clock, value, value_type))
+
+    series = {}
+    for itemid, rows in rows_by_item.items():
+        # Values are only stored as numbers for numeric items; rows without a value type
+        # (legacy history) keep their text as is
+        value_type = rows[-1][2] if rows else None
+        kind = series_kind_for_value_type(value_type) if value_type is not None else KIND_TEXT
+        try:
+            series[itemid] = build_series(kind, rows)
+        except (TypeError, ValueError, OverflowError):
+            logging.warning(f"History of item {itemid} of source host {source_host_id} does not fit value type {value_type}, replaying it as text.")
+            series[itemid] = build_series(KIND_TEXT, rows)
+    return series
+
+
+def build_series(kind, rows):
+    """Builds a ReplaySeries of the given kind from (clock, value, ...) rows."""
+    item_series = ReplaySeries(kind)
+    for row in rows:
+        item_series.append(row[0], row[1])
+    return item_series
+
+
+def migrate_legacy_history(db, task):
+    """
+    Moves a task's legacy JSON history blob into the replay_history table.
+
+    Returns:
+        bool: True if history was migrated, False if there was nothing to migrate.
+    """
+    if not task.history:
+        return False
+
+    clear_history(db, task.source_host_id)
+    writer = HistoryWriter(db, task.source_host_id)
+    for itemid, history_points in task.history.items():
+        for point in history_points:
+            writer.append(itemid, point['clock'], point['value'])
+    writer.flush()
+    task.history = None
+    bump_history_generation(task)
+    logging.info(f"Migrated {writer.total_points} legacy history points for source host {task.source_host_id} into the history store.")
+    return True
@@ -0,0 +1,98 @@
+import logging
+import time
+
+from zabbix_utils import ZabbixAPI
+
+from common import ReplicationTask, SessionLocal, config, source_api_options
+from history_fetch import HistoryStream, top_up_history
+from history_store import prune_history
+from jobs import REPLAY_ACTIVE_STATUSES, commit_with_retry, task_replay_mode
+from zabbix_cache import merge_source_items, source_config_cache
+
+# ID of the scheduler job that keeps rolling history up to date
+HISTORY_TOPUP_JOB_ID = 'history_topup'
+
+
+def top_up_task(db, task, source_zapi, now, stream=None):
+    """
+    Appends new source history to a replayed task and prunes history that left the window.
+
+    Timed-mode tasks are pruned here, but never past the point the current cycle has
+    replayed. Tick-mode tasks are pruned by the replay engine when a cycle starts, since
+    their cursor is a position in each item's history.
+
+    Args:
+        stream: Optional HistoryStream the source's history.get responses are streamed from
+
+    Returns:
+        tuple: (new_records, pruned_records)
+    """
+    source_host_id = task.source_host_id
+    window_seconds = config.get('replay_duration_hours', 24) * 3600
+    source_items = merge_source_items(source_config_cache.get(source_zapi, source_host_id))
+
+    new_records, fetched_until = top_up_history(source_items, source_zapi, db, source_host_id,
+                                                fetched_until=task.history_fetched_until,
+                                                default_time_from=now - window_seconds, stream=stream)
+    if fetched_until is not None:
+        task.history_fetched_until = fetched_until # Only advanced when every chunk was fetched
+
+    pruned = 0
+    if task_replay_mode(task) == 'timed':
+        before_clock = now - window_seconds
+        if task.replayed_until is not None:
+            before_clock = min(before_clock, task.replayed_until + 1) # Keep what the current cycle hasn't sent
+        pruned = prune_history(db, source_host_id, before_clock)
+    return new_records, pruned
+
+
+def history_topup_tick():
+    """
+    Scheduled job that tops up the stored history of every actively replayed task.
+
+    With HISTORY_ROLLING enabled, replay keeps following the source instead of looping
+    over the snapshot taken at replication time: each run fetches only the history
+    recorded since the last run (see top_up_history) and drops points older than
+    REPLAY_DURATION_HOURS. Each task is committed on its own, so one unreachable source
+    doesn't hold back the others.
+    """
+    if not config.get('history_rolling'):
+        return
+    db = SessionLocal()
+    try:
+        tasks = db.query(ReplicationTask) \
+            .filter(ReplicationTask.status.in_(REPLAY_ACTIVE_STATUSES)) \
+            .order_by(ReplicationTask.source_host_id) \
+            .all()
+        source_apis = {} # {(source_url, token): (ZabbixAPI, HistoryStream)}, one login per source per run
+        started = time.time()
+        total_new = 0
+        total_pruned = 0
+        for task in tasks:
+            now = int(time.time())
+            try:
+                api_key = (task.source_url, task.source_token)
+                if api_key not in source_apis:
+                    source_zapi = ZabbixAPI(url=task.source_url, skip_version_check=True, **source_api_options())
+                    source_zapi.login(token=task.source_token)
+                    source_apis[api_key] = (source_zapi, HistoryStream.from_config(task.source_url, task.source_token))
+                source_zapi, stream = source_apis[api_key]
+
+                new_records, pruned = top_up_task(db, task, source_zapi, now, stream)
+                if not commit_with_retry(db):
+                    logging.error(f"[History Top-up {task.source_host_id}] Failed to commit topped up history.")
+                    db.rollback()
+                    continue
+                total_new += new_records
+                total_pruned += pruned
+            except Exception as e:
+                logging.error(f"[History Top-up {task.source_host_id}] Error topping up history: {e}", exc_info=True)
+                db.rollback()
+        if tasks:
+            logging.info(f"[History Top-up] Added {total_new} and pruned {total_pruned} history records for {len(tasks)} tasks "
+                         f"in {time.time() - started:.1f}s.")
+    except Exception as e:
+        logging.error(f"[History Top-up] Unexpected error: {e}", exc_info=True)
+        db.rollback()
+    finally:
+        db.close()
@@ -2,14 +2,21 @@ import logging
 import time
 import random
 from datetime import datetime, timedelta
-from zabbix_utils import Sender, ItemValue # Correct Sender/ItemValue import
+from math import ceil
+from zabbix_utils import ItemValue # Correct ItemValue import
 from apscheduler.schedulers.background import BackgroundScheduler
-from sqlalchemy.orm.attributes import flag_modified # Import flag_modified
+from sqlalchemy import update
 from sqlalchemy.exc import OperationalError
-from trigger_utils import simulate_random_problem
+from metrics import REPLAY_TICK_SECONDS, REPLAY_TICK_STAGE_SECONDS, StageTimer, record_task_points
+from problem_simulation import simulate_problems
+from history_store import get_first_clock, get_item_seq_bounds, get_last_clock, load_point_ranges, load_points_by_clock, migrate_legacy_history, prune_history
+from series import SeriesReadAhead
+from sender_pool import get_sender_pool, parse_trapper_endpoints
+from rate_limit import get_rate_controller, rate_limit_status
+from leader import SCHEDULER_LEASE, fence_lease
 
 # Import SQLAlchemy components and config from common.py
-from common import ReplicationTask, SessionLocal, config # Import necessary components from common.py
+from common import SKIP_KEY_PREFIXES, ReplicationTask, SessionLocal, config # Import necessary components from common.py
 
 # Basic logging setup
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -18,6 +25,9 @@ def commit_with_retry(db_session, max_retries=5, base_delay=0.1):
     """
     Commit database changes with retry logic to handle SQLite lock errors.
 
+    SQLite connections already wait up to SQLITE_BUSY_TIMEOUT_MS for a lock (see common.py),
+    so this only retries when a commit still times out, e.g. during a long history import.
+
     Args:
         db_session: SQLAlchemy session to commit
         max_retries: Maximum number of retry attempts
@@ -47,241 +57,534 @@ def commit_with_retry(db_session, max_retries=5, base_delay=0.1):
                 raise e
     return False
 
-def replay_job(source_host_id):
-    """Scheduled job to send historical data to the destination trapper.
+# Task statuses picked up by the replay engine. Sending errors are retried on the next tick.
+REPLAY_ACTIVE_STATUSES = ('replicating', 'replaying', 'failed_sending', 'failed_sending_setup')
+# ID of the single scheduler job that drives replay for every task
+REPLAY_ENGINE_JOB_ID = 'replay_engine'
+
+# Max source host IDs per SQL IN (...) list, well below SQLite's bound-parameter limit
+IN_CLAUSE_CHUNK_SIZE = 400
+
+# Rotates the task order between ticks so no task is always served first when the point budget runs out
+_tick_counter = 0
+# Upcoming replay points of each task, kept as compact series and refilled from the history store in blocks
+_read_ahead = SeriesReadAhead()
+
+class TaskBatch:
+    """Points collected for one replication task during a replay tick."""
+
+    def __init__(self, task, item_counts):
+        self.task = task
+        self.item_counts = item_counts # {itemid: point_count} of the replayed items
+        self.mode = task_replay_mode(task)
+        self.cycle_offset = task.cycle_offset or 0 # Cursor after this batch is sent (tick mode)
+        self.cycle_item_offset = task.cycle_item_offset or 0
+        self.replayed_until = task.replayed_until # Cursor after this batch is sent (timed mode)
+        self.replayed_key = (task.replayed_itemid, task.replayed_seq) if task.replayed_itemid is not None else None
+        self.cycle_started_at = task.cycle_started_at
+        self.first_clock = None # Clock range of the task's history (timed mode)
+        self.last_clock = None
+        self.packet = [] # ItemValue objects to send
+        self.failed = 0 # Points reported as failed by the trapper
+        self.send_error = None
+        self.send_seconds = 0.0 # Slowest trapper response for this batch (async engine)
+        self.endpoint_points = {} # {(host, port): points sent} (async engine)
+
+def task_replay_speed(task):
+    """Returns the task's timed replay speed multiplier (1.0 = original rate)."""
+    speed = task.replay_speed or config.get('replay_speed', 1.0)
+    return speed if speed > 0 else 1.0
+
+def task_replay_mode(task):
+    """Returns the task's replay mode: "tick" (one point per item per tick) or "timed"."""
+    return task.replay_mode or config.get('replay_mode', 'tick')
+
+def is_replayed_item(source_host_id, dest_key):
+    """Returns True if an item with this destination key is replayed."""
+    if not dest_key:
+        return False # Skip items without a mapping
+    # The filtering should primarily happen in app.py when fetching history and
+    # modifying items. This check is a fallback.
+    if '<' in dest_key and '>' in dest_key: # Assuming dynamic interfaces might have '<>' in key too
+        logging.debug(f"[Replay Job {source_host_id}] Skipping item with key '{dest_key}' due to dynamic interface pattern '<...>' in key.")
+        return False
+    for prefix in SKIP_KEY_PREFIXES:
+        if dest_key.startswith(prefix):
+            logging.debug(f"[Replay Job {source_host_id}] Skipping item with key '{dest_key}' as its key starts with '{prefix}'.")
+            return False
+    return True
+
+def migrate_legacy_cursor(task, item_counts):
+    """
+    Converts a legacy per-item last_sent_index dict into the task's cycle cursor.
 
-    Args:
-        source_host_id: ID of the source host being replicated
+    The cursor resumes at the item that is furthest behind, so no point is skipped;
+    items that were ahead resend a few points.
     """
-    # Use a database session within the job
-    db = SessionLocal()
-    try:
-        # Fetch the task from the database
-        task = db.query(ReplicationTask).filter(ReplicationTask.source_host_id == source_host_id).first()
+    last_sent_index = task.last_sent_index
+    if last_sent_index is None:
+        return
+    next_indexes = [last_sent_index.get(itemid, -1) + 1 for itemid in item_counts]
+    pending = [index for index, itemid in zip(next_indexes, item_counts) if index < item_counts[itemid]]
+    task.cycle_offset = min(pending) if pending else max(next_indexes, default=0)
+    task.cycle_item_offset = 0
+    task.last_sent_index = None
+
+def replayed_item_counts(source_host_id, history_bounds, item_mapping):
+    """Returns {itemid: point_count} of the items replayed for a task, in cursor (item ID) order."""
+    return {
+        str(itemid): history_bounds[itemid][1]
+        for itemid in sorted(history_bounds)
+        if is_replayed_item(source_host_id, item_mapping.get(str(itemid))) # Ensure source_itemid is string for lookup
+    }
+
+def prepare_task_batch(db, task, current_time, max_points):
+    """
+    Collects the next point of each mapped item of a task, up to max_points.
 
-        if not task or task.status == 'completed' or task.status == 'failed':
-            logging.warning(f"[Replay Job {source_host_id}] Task not found, completed, or failed. Removing job.")
-            # Job removal logic should ideally be handled by the scheduler management in app.py
-            # For now, we just return.
-            return
+    In tick mode, items are served in item ID order from the task's cycle cursor, one
+    point per item per round. When a task has more items than its share of the tick
+    budget, the round continues with the remaining items on the next tick, so every item
+    keeps advancing. In timed mode, every point whose original offset from the start of
+    the history has elapsed since the cycle started is sent (see collect_timed_points).
 
-        logging.info(f"[Replay Job {source_host_id}] Fetched task from DB. task.last_sent_index: {task.last_sent_index}") # Added Log
-
-        # Access task details from the database object
-        dest_host = task.dest_host_name
-        history = task.history or {} # Use empty dict if history is None
-        item_mapping = task.item_mapping or {} # Use empty dict if item_mapping is None
-        start_time = task.start_time
-        last_sent_index = task.last_sent_index or {} # Use empty dict if last_sent_index is None
-        dest_trapper_host = config.get('dest_trapper_host') # Access config from imported global
-        dest_trapper_port = config.get('dest_trapper_port') # Access config from imported global
-        cycle_offset = task.cycle_offset or 0 # Use 0 if cycle_offset is None
-        replay_duration_hours = config.get('replay_duration_hours', 24) # Get replay duration from config
-
-        if not all([dest_host, history, item_mapping, start_time, dest_trapper_host, dest_trapper_port]):
-            logging.error(f"[Replay Job {source_host_id}] Missing necessary data in task details for replay.")
-            task.status = 'failed'
-            task.message = "Missing necessary data for replay."
-            if not commit_with_retry(db):
-                logging.error(f"[Replay Job {source_host_id}] Failed to commit failed status")
-            return
+    Returns:
+        TaskBatch or None: None if the task cannot be replayed (it is marked failed).
+    """
+    source_host_id = task.source_host_id
+
+    # Move a legacy JSON history blob into the history store before replaying
+    migrate_legacy_history(db, task)
+
+    # Only seq bounds are loaded here; the points themselves are read from the history store
+    history_bounds = get_item_seq_bounds(db, source_host_id) # {itemid: (first_seq, point_count)}
+    item_mapping = task.item_mapping or {}
+    dest_trapper_host = config.get('dest_trapper_host')
+    dest_trapper_port = config.get('dest_trapper_port')
+    replay_duration_hours = config.get('replay_duration_hours', 24)
+
+    if not all([task.dest_host_name, history_bounds, item_mapping, task.start_time, dest_trapper_host, dest_trapper_port]):
+        logging.error(f"[Replay Job {source_host_id}] Missing necessary data in task details for replay.")
+        task.status = 'failed'
+        task.message = "Missing necessary data for replay."
+        return None
+
+    migrate_legacy_cursor(task, replayed_item_counts(source_host_id, history_bounds, item_mapping))
+
+    # Check if replay duration has been exceeded
+    if current_time - task.start_time >= replay_duration_hours * 3600:
+        logging.info(f"[Replay Job {source_host_id}] Replay duration of {replay_duration_hours} hours exceeded. Restarting replay and resetting start time.")
+        task.cycle_offset = 0 # Reset cursor to restart replay from the beginning
+        task.cycle_item_offset = 0
+        task.replayed_until = None
+        task.replayed_itemid = None
+        task.replayed_seq = None
+        task.cycle_started_at = None
+        task.start_time = current_time # Reset start time for the next duration calculation
+        task.progress = 0.0 # Reset progress for the new cycle
+
+    if config.get('history_rolling') and task_replay_mode(task) == 'tick' and not task.cycle_offset and not task.cycle_item_offset:
+        # Rolling history: drop points that left the replay window before a new cycle starts.
+        # Positions are relative to each item's first seq, so this must not happen mid-cycle.
+        pruned = prune_history(db, source_host_id, int(current_time) - replay_duration_hours * 3600)
+        if pruned:
+            logging.info(f"[Replay Job {source_host_id}] Pruned {pruned} history points older than the replay window.")
+            history_bounds = get_item_seq_bounds(db, source_host_id)
+
+    # Items replayed for this task, in cursor order
+    item_counts = replayed_item_counts(source_host_id, history_bounds, item_mapping)
+    batch = TaskBatch(task, item_counts)
+    if batch.mode == 'timed':
+        collect_timed_points(db, batch, item_mapping, current_time, max_points)
+        return batch
+
+    # Work out which point each item sends next, continuing the current round from the cursor
+    itemids = list(item_counts)
+    round_index = batch.cycle_offset
+    position = batch.cycle_item_offset
+    next_positions = {}
+    while position < len(itemids) and len(next_positions) < max_points:
+        source_itemid = itemids[position]
+        position += 1
+        if round_index < item_counts[source_itemid]:
+            next_positions[source_itemid] = history_bounds[source_itemid][0] + round_index
+    if position >= len(itemids):
+        # Round complete, the next tick starts the next round
+        batch.cycle_offset = round_index + 1
+        batch.cycle_item_offset = 0
+    else:
+        batch.cycle_item_offset = position
+
+    # Read those points from the compact read-ahead series (refilled from the history store as needed)
+    next_points = _read_ahead.get_points(db, task, next_positions, history_bounds, load_point_ranges)
+    new_timestamp = int(current_time) # Points are replayed with the current timestamp
+    itemids = [source_itemid for source_itemid in next_positions if source_itemid in next_points]
+    # Simulate problems before sending, for the whole packet at once
+    values = simulate_problems(task, itemids, [next_points[source_itemid][1] for source_itemid in itemids], current_time)
+    for source_itemid, value in zip(itemids, values):
+        batch.packet.append(ItemValue(task.dest_host_name, item_mapping[source_itemid], value, new_timestamp))
+
+    return batch
+
+def collect_timed_points(db, batch, item_mapping, current_time, max_points):
+    """
+    Adds the points that are due in timed mode to the batch.
+
+    A point is due once (clock - first history clock) / speed seconds have passed since
+    the cycle started, so every item replays at its original rate (times the task's speed
+    multiplier) and with its original spacing. Points are stamped with cycle start + their
+    scaled offset. If more than max_points are due, the batch stops at a clock boundary and
+    the rest follow on the next tick. A single clock with more than max_points points is
+    split: the cursor then also records the (itemid, seq) of the last point sent.
+    """
+    task = batch.task
+    source_host_id = task.source_host_id
+    speed = task_replay_speed(task)
+    batch.first_clock = task.first_history_timestamp or get_first_clock(db, source_host_id)
+    batch.last_clock = get_last_clock(db, source_host_id)
+    if batch.cycle_started_at is None or batch.replayed_until is None:
+        # New cycle: start replaying the history from its first point now
+        if config.get('history_rolling'):
+            # Rolling history is pruned and topped up, so the cycle starts at the oldest point now stored
+            task.first_history_timestamp = get_first_clock(db, source_host_id) or task.first_history_timestamp
+            batch.first_clock = task.first_history_timestamp
+        batch.cycle_started_at = current_time
+        batch.replayed_until = batch.first_clock - 1
+        batch.replayed_key = None
+
+    due_until = batch.first_clock + int((current_time - batch.cycle_started_at) * speed)
+    # Only replayed items are read, so rows of unmapped or skipped items don't use up the budget
+    rows = load_points_by_clock(db, source_host_id, batch.replayed_until, due_until, limit=max_points + 1,
+                                after_key=batch.replayed_key, itemids=batch.item_counts)
+    if len(rows) > max_points:
+        # Don't split a clock between ticks unless it is the only one; then stop after max_points
+        # points and remember the last one, so the rest of the clock follows on the next tick
+        cut_clock = rows[max_points][1]
+        kept = [row for row in rows if row[1] < cut_clock]
+        if kept:
+            rows = kept
+            batch.replayed_until = rows[-1][1]
+            batch.replayed_key = None
+        else:
+            rows = rows[:max_points]
+            batch.replayed_until = cut_clock - 1
+            batch.replayed_key = (rows[-1][0], rows[-1][3])
+    elif due_until > batch.replayed_until:
+        # Everything due was loaded, including the rest of a split clock
+        batch.replayed_until = due_until
+        batch.replayed_key = None
+
+    # Simulate problems before sending, for the whole packet at once
+    values = simulate_problems(task, [row[0] for row in rows], [row[2] for row in rows], current_time)
+    for (source_itemid, clock, _, _), value in zip(rows, values):
+        # Original spacing (compressed by the speed), shifted to now; ns keeps the order of points within a second
+        new_timestamp = batch.cycle_started_at + (clock - batch.first_clock) / speed
+        batch.packet.append(ItemValue(task.dest_host_name, item_mapping[source_itemid], value, int(new_timestamp), int((new_timestamp % 1) * 1e9)))
+
+def send_batches(batches):
+    """
+    Sends the points of all batches to the destination trapper as one stream of large packets.
 
-        current_time = time.time()
-        elapsed_seconds = current_time - start_time
-        
-        # Check if replay duration has been exceeded
-        if elapsed_seconds >= replay_duration_hours * 3600:
-            logging.info(f"[Replay Job {source_host_id}] Replay duration of {replay_duration_hours} hours exceeded. Restarting replay and resetting start time.")
-            task.last_sent_index = {} # Reset index to restart replay from the beginning
-            task.start_time = current_time # Reset start time for the next duration calculation
-            task.message = f"Replaying... (restarted after {replay_duration_hours} hours, time reset)"
-            task.progress = 0.0 # Reset progress for the new cycle
-            flag_modified(task, "last_sent_index") # Mark as modified after reset
-            # No need to flag_modified for start_time as it's a simple type
-            if not commit_with_retry(db):  # Commit the reset
-                logging.error(f"[Replay Job {source_host_id}] Failed to commit reset")
-            last_sent_index = {} # Update local variable as well
-
-        # Replay time matches elapsed time (1:1 replay speed)
-        # Calculate the current timestamp in the replay window
-        current_replay_timestamp = (task.first_history_timestamp or 0) + elapsed_seconds
-
-        packet = []
-        items_sent_this_run = 0
-        total_history_points = 0
-
-        logging.info(f"[Replay Job {source_host_id}] Starting data processing loop. Current local last_sent_index: {last_sent_index}") # Added Log
-
-        try: # Added try block around the loop
-            for source_itemid, history_points in history.items():
-                dest_key = item_mapping.get(str(source_itemid)) # Ensure source_itemid is string for lookup
-                if not dest_key:
-                    logging.debug(f"[Replay Job {source_host_id}] Skipping item ID {source_itemid}: No destination key found in mapping.")
-                    continue # Skip items without a mapping
-
-                # Get the original item name and key from the source_items_full (if available in task)
-                # This requires fetching source_items_full and storing it in the task, or passing it.
-                # For now, we'll rely on dest_key and assume it's sufficient for filtering.
-                # If dest_key itself contains '<' or starts with 'MTR', it should have been filtered earlier.
-                # However, if the mapping somehow includes such a key, we should filter here.
-                # This would require access to the original item's name/key, which is not directly in `history` or `item_mapping`.
-                # The most robust way would be to store `all_source_items` in the task.history object,
-                # or pass it to the replay_job.
-
-                # Given the current structure, the filtering should primarily happen in app.py
-                # when fetching history and modifying items. This check is a fallback.
-                if '<' in dest_key and '>' in dest_key: # Assuming dynamic interfaces might have '<>' in key too
-                    logging.info(f"[Replay Job {source_host_id}] Skipping item with key '{dest_key}' due to dynamic interface pattern '<...>' in key.")
-                    continue
-                if dest_key.startswith('MTR'):
-                    logging.info(f"[Replay Job {source_host_id}] Skipping item with key '{dest_key}' as its key starts with 'MTR'.")
-                    continue
+    The combined packet goes through the shared sender pool. Each chunk's trapper response
+    (or sending error) is attributed back to the tasks whose points were in the chunk, and
+    the tick's failures and response times are fed to the rate controller's backoff.
 
-                total_history_points += len(history_points)
-
-                # Get the index of the last sent data point for this item
-                last_index = last_sent_index.get(str(source_itemid), -1) # Use string key
-
-                # Find the next data point to send
-                next_index = last_index + 1
-                logging.debug(f"[Replay Job {source_host_id}] Item {source_itemid}: last_index={last_index}, next_index={next_index}, history_points_len={len(history_points)}") # Added Log
-                logging.info(f"[Replay Job {source_host_id}] Before update - last_sent_index[{source_itemid}]: {last_sent_index.get(str(source_itemid))}") # Added Log
-
-
-                if next_index < len(history_points):
-                    data_point = history_points[next_index]
-                    original_timestamp = data_point['clock']
-
-                    # Calculate the new timestamp for replay - USE CURRENT TIME
-                    #time_offset_from_start = original_timestamp - (task.first_history_timestamp or 0) # Original calculation removed
-                    #new_timestamp = int(start_time + time_offset_from_start + cycle_offset) # Original calculation removed
-                    new_timestamp = int(time.time()) # Use current timestamp
-                    # logging.info(f"[Replay Job {source_host_id}] Sending Item: Key='{dest_key}', Value='{data_point['value']}', Timestamp={new_timestamp} ({datetime.utcfromtimestamp(new_timestamp).strftime('%Y-%m-%d %H:%M:%S')} UTC)") # Remove detailed logging
-
-                    # Send the data point
-                    # if new_timestamp <= current_time: # <-- REMOVED Check - rely on offset
-                    # Simulate problems before sending
-                    simulated_value = simulate_random_problem(source_host_id, dest_key, data_point['value'])
-                    packet.append(ItemValue(dest_host, dest_key, simulated_value, new_timestamp))
-                    last_sent_index[str(source_itemid)] = next_index # Update the last sent index using string key
-                    logging.info(f"[Replay Job {source_host_id}] After update - last_sent_index[{source_itemid}]: {last_sent_index.get(str(source_itemid))}") # Added Log
-                    items_sent_this_run += 1
-                    # else: # <-- REMOVED
-                    #    pass # Data point is in the future relative to current replay time # <-- REMOVED
-                    # Removed duplicated lines below
-                    #else:
-                    #    pass # Data point is in the future relative to current replay time
-                else:
-                    pass # No more history points for this item
-        except Exception as loop_error: # Added exception handling for the loop
-            logging.error(f"[Replay Job {source_host_id}] Error during data processing loop: {loop_error}", exc_info=True)
-            task.status = 'failed_processing'
-            task.message = f"Error during data processing: {loop_error}"
-            if not commit_with_retry(db):
-                logging.error(f"[Replay Job {source_host_id}] Failed to commit loop error status")
-            return # Exit job on loop error
-
-
-        logging.info(f"[Replay Job {source_host_id}] Data processing loop finished. Final local last_sent_index before commit: {last_sent_index}") # Added Log
-        # Update the last_sent_index in the task object
-        task.last_sent_index = last_sent_index
-        flag_modified(task, "last_sent_index") # Mark the JSON field as modified
-        db.commit() # Commit the index update
-        logging.info(f"[Replay Job {source_host_id}] task.last_sent_index committed.") # Added Log
-
-        if packet:
-            logging.info(f"[Replay Job {source_host_id}] Preparing to send {len(packet)} data points...") # Added Log
-            try:
-                sender_config = {"server": dest_trapper_host, "port": dest_trapper_port}
-                sender = Sender(**sender_config)
-
-                #logging.info(f"[Replay Job {source_host_id}] Preparing to send {len(packet)} items:")
-                #for i, item in enumerate(packet[:5]): logging.info(f"  Item {i+1}: Host={item.host} Key={item.key} Value={item.value} Clock={item.clock}")
-
-                #logging.info(f"[Replay Job {source_host_id}] Validating packet...")
-                for item in packet:
-                    if not item.host or not item.key or item.value is None:
-                        raise ValueError(f"Invalid ItemValue - host:{item.host} key:{item.key} value:{item.value}")
-
-                # Test connection removed for brevity, assume it works if initial setup passed
-                try: # Added try block around sender.send
-                    result = sender.send(packet)
-
-                    logging.info(f"[Replay Job {source_host_id}] Sender response: Processed={result.processed}, Failed={result.failed}, Total={result.total}") # Added Log
-                    if hasattr(result, 'details'): logging.info(f"  Sender Details: {result.details}") # Added Log
-
-                    if result.failed > 0:
-                         logging.error(f"[Replay Job {source_host_id}] Failed to send {result.failed}/{result.total} data points. Details: {result.details}") # Added details to error
-                         task.message = f"Replaying... (encountered {result.failed} send failures)"
-                    else:
-                         task.message = f"Replaying... (sent {len(packet)} points)"
-
-                except Exception as send_error: # Added specific exception handling for sending
-                    logging.error(f"[Replay Job {source_host_id}] Error sending data: {send_error}", exc_info=True)
-                    task.status = 'failed_sending'
-                    task.message = f"Error sending data: {send_error}"
-                    # Consider removing job on persistent failure?
-
-            except Exception as general_send_error: # Kept the original broad exception for other potential errors
-                logging.error(f"[Replay Job {source_host_id}] General error during sending setup: {general_send_error}", exc_info=True)
-                task.status = 'failed_sending_setup'
-                task.message = f"Error during sending setup: {general_send_error}"
-                # Consider removing job on persistent failure?
-
-        # Update task status and last run time in the task object
-        task.last_run_time = current_time # Add last_run_time to the model if needed, or remove this line
-        db.commit() # Commit status/message updates
+    Returns:
+        tuple: (processed, failed) point counts for the tick
+    """
+    packet = []
+    owners = {} # id(ItemValue) -> batch owning the point
+    for batch in batches:
+        packet.extend(batch.packet)
+        for item in batch.packet:
+            owners[id(item)] = batch
+    if not packet:
+        return 0, 0
 
+    try:
+        for item in packet:
+            if not item.host or not item.key or item.value is None:
+                raise ValueError(f"Invalid ItemValue - host:{item.host} key:{item.key} value:{item.value}")
+        chunk_results = get_sender_pool().send_chunks(packet)
+    except Exception as send_error:
+        logging.error(f"[Replay Engine] Error sending {len(packet)} data points: {send_error}", exc_info=True)
+        for batch in batches:
+            batch.send_error = send_error
+        get_rate_controller().record_tick(len(packet), errors=1)
+        return 0, len(packet)
+
+    processed = failed = errors = 0
+    rejected = 0 # Values the trapper answered as failed (not counting chunks that could not be sent)
+    latency = 0.0
+    endpoint_points = {}
+    for chunk, response, endpoint, seconds in chunk_results:
+        chunk_owners = [owners[id(item)] for item in chunk]
+        latency = max(latency, seconds)
+        endpoint_points[endpoint] = endpoint_points.get(endpoint, 0) + len(chunk)
+        if isinstance(response, Exception):
+            logging.error(f"[Replay Engine] Error sending chunk of {len(chunk)} data points: {response}")
+            failed += len(chunk)
+            errors += 1
+            for batch in set(chunk_owners):
+                batch.send_error = response
+            continue
+        processed += response.processed
+        failed += response.failed
+        rejected += response.failed
+        if response.failed:
+            # Attribute the chunk's failures to its tasks, proportionally to their points
+            for batch in set(chunk_owners):
+                share = chunk_owners.count(batch) / len(chunk_owners)
+                batch.failed += max(1, round(response.failed * share))
+    logging.info(f"[Replay Engine] Sender response: Processed={processed}, Failed={failed}, Total={len(packet)}, Slowest chunk={latency:.2f}s")
+    get_rate_controller().record_tick(len(packet), rejected, errors, latency, endpoint_points)
+    return processed, failed
+
+def finalize_task_batch(batch):
+    """Updates the task's replay cursor, status, message and progress after a send."""
+    task = batch.task
+    source_host_id = task.source_host_id
+    sent = len(batch.packet)
+    record_task_points(source_host_id, sent, batch.failed, batch.send_error is not None)
+
+    if batch.send_error is not None:
+        task.status = 'failed_sending'
+        task.message = f"Error sending data: {batch.send_error}"
+    elif batch.failed > 0:
+        logging.error(f"[Replay Job {source_host_id}] Failed to send {batch.failed}/{sent} data points.")
+
+    # Points are considered consumed even if sending failed, as before.
+    # Only the cursor columns change, so the task row update stays small.
+    if batch.mode == 'timed':
+        task.replayed_until = batch.replayed_until
+        task.replayed_itemid, task.replayed_seq = batch.replayed_key or (None, None)
+        task.cycle_started_at = batch.cycle_started_at
+        all_history_sent = batch.replayed_until >= batch.last_clock
+        span = batch.last_clock - batch.first_clock
+        progress_percent = ((batch.replayed_until - batch.first_clock) / span * 100) if span > 0 else 100
+        progress_message = f"{min(progress_percent, 100):.1f}% of the history's time span"
+    else:
+        task.cycle_offset = batch.cycle_offset
+        task.cycle_item_offset = batch.cycle_item_offset
+
+        # Points sent this cycle: cycle_offset points per item, plus one for the items already served this round
+        total_processed_count = sum(min(batch.cycle_offset, count) for count in batch.item_counts.values())
+        for count in list(batch.item_counts.values())[:batch.cycle_item_offset]:
+            if batch.cycle_offset < count:
+                total_processed_count += 1
         # Check if all history points have been sent
-        # logging.info(f"[Replay Job {source_host_id}] Finished processing items for this run. Final local last_sent_index before check: {last_sent_index}") # Removed Log
-        all_history_sent = True
-        total_processed_count = 0
-        for source_itemid_str, history_points in history.items():
-             last_idx = last_sent_index.get(str(source_itemid_str), -1) # Ensure string key here too
-             total_processed_count += (last_idx + 1)
-             if last_idx < len(history_points) - 1:
-                 all_history_sent = False
-                 #break # No need to break, calculate total progress
+        all_history_sent = batch.cycle_item_offset == 0 and batch.cycle_offset >= max(batch.item_counts.values(), default=0)
 
         # Calculate total points for progress
-        total_points_to_send = sum(len(points) for points in history.values())
+        total_points_to_send = sum(batch.item_counts.values())
         progress_percent = (total_processed_count / total_points_to_send * 100) if total_points_to_send > 0 else 100
+        progress_message = f"{total_processed_count}/{total_points_to_send} total"
+
+    if batch.send_error is not None:
+        return
+
+    if all_history_sent:
+        logging.info(f"[Replay Job {source_host_id}] Cycle complete. Looping replay with current timestamps.")
+        # Reset the cursor to replay from the beginning of the history data
+        task.cycle_offset = 0
+        task.cycle_item_offset = 0
+        task.replayed_until = None
+        task.replayed_itemid = None
+        task.replayed_seq = None
+        task.cycle_started_at = None
+        task.status = 'replaying' # Keep status as replaying
+        task.message = f"Replaying... (looping with current timestamps)" # Updated message
+        task.progress = 0.0 # Reset progress for the new cycle
+    else:
+        task.status = 'replaying'
+        failures = f", {batch.failed} send failures" if batch.failed else ""
+        task.message = f"Replaying... Sent {sent} points this run{failures}. ({progress_message})"
+        task.progress = round(progress_percent, 2)
+
+def chunked(values, size=None):
+    """Splits a list into lists of at most size (default IN_CLAUSE_CHUNK_SIZE) values, for IN (...) clauses."""
+    values = list(values)
+    size = size or IN_CLAUSE_CHUNK_SIZE
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+def renew_replay_leases(db, source_host_ids, owner, lease_seconds):
+    """
+    Extends owner's replay leases on the given tasks, within the caller's transaction.
 
-        if all_history_sent:
-            logging.info(f"[Replay Job {source_host_id}] Cycle complete. Looping replay with current timestamps.")
-            # Reset last_sent_index to replay from the beginning of the history data
-            task.last_sent_index = {}
-            # DO NOT Increment the cycle offset - it's not used for timestamp calculation anymore
-            # task.cycle_offset += 7200 # <-- REMOVED THIS LINE
-            task.status = 'replaying' # Keep status as replaying
-            task.message = f"Replaying... (looping with current timestamps)" # Updated message
-            task.progress = 0.0 # Reset progress for the new cycle
-            flag_modified(task, "last_sent_index") # Mark as modified after reset
-            # flag_modified(task, "cycle_offset") # No longer needed to flag offset
-            db.commit() # Commit cycle completion updates
-        else:
-             task.status = 'replaying'
-             task.message = f"Replaying... Sent {items_sent_this_run} points this run. ({total_processed_count}/{total_points_to_send} total)"
-             task.progress = round(progress_percent, 2)
-             db.commit() # Commit progress updates
-             # logging.info(f"[Replay Job {source_host_id}] History not fully sent. Progress: {progress_percent:.2f}% ({total_processed_count}/{total_points_to_send})") # Removed Log
+    Only leases the owner still holds are extended: once another worker has claimed a
+    task (its lease had expired), the task is no longer this owner's.
 
+    Returns:
+        set: Source host IDs whose lease owner holds
+    """
+    now = time.time()
+    held = set()
+    for chunk in chunked(str(source_host_id) for source_host_id in source_host_ids):
+        db.execute(
+            update(ReplicationTask)
+            .where(ReplicationTask.source_host_id.in_(chunk), ReplicationTask.replay_owner == owner)
+            .values(replay_lease_expires_at=now + lease_seconds)
+            .execution_options(synchronize_session=False)
+        )
+        rows = db.query(ReplicationTask.source_host_id) \
+            .filter(ReplicationTask.source_host_id.in_(chunk), ReplicationTask.replay_owner == owner) \
+            .all()
+        held.update(source_host_id for source_host_id, in rows)
+    return held
+
+def fence_replay_leases(db, tasks, lease_owner, lease_seconds):
+    """
+    Discards the tick's progress of tasks whose replay lease lease_owner lost.
+
+    Called right before the tick's commit: the lease rows are updated in the same
+    transaction, so no other worker can claim a task between the check and the commit.
+    """
+    held = renew_replay_leases(db, [task.source_host_id for task in tasks], lease_owner, lease_seconds)
+    for task in tasks:
+        if task.source_host_id not in held:
+            logging.warning(f"[Replay Job {task.source_host_id}] Replay lease lost to another worker, discarding this tick's progress.")
+            db.expire(task) # Drops the task's unflushed changes
+
+def fence_scheduler_lease(db, scheduler_holder):
+    """
+    Discards the tick's progress if scheduler_holder lost the scheduler lease while the tick ran.
+
+    Pausing the scheduler doesn't stop a tick that is already running, so the web app's
+    replay engine checks the lease in the commit's transaction instead.
+
+    Returns:
+        bool: True if the tick may commit
+    """
+    if fence_lease(db, SCHEDULER_LEASE, scheduler_holder):
+        return True
+    logging.warning("[Replay Engine] Scheduler lease lost during the tick, discarding its progress.")
+    db.rollback()
+    return False
+
+def load_active_tasks(db, source_host_ids=None):
+    """
+    Loads the tasks the replay engine should serve this tick.
+
+    The list is rotated by one task per tick so no task is always served first
+    when the tick's point budget runs out.
+
+    Args:
+        db: SQLAlchemy session
+        source_host_ids: Optional list of source host IDs to restrict the tick to
+    """
+    global _tick_counter
+    query = db.query(ReplicationTask).filter(ReplicationTask.status.in_(REPLAY_ACTIVE_STATUSES))
+    if source_host_ids is None:
+        tasks = query.order_by(ReplicationTask.source_host_id).all()
+    else:
+        tasks = []
+        for chunk in chunked(str(h) for h in source_host_ids):
+            tasks.extend(query.filter(ReplicationTask.source_host_id.in_(chunk)).all())
+        tasks.sort(key=lambda task: task.source_host_id)
+    _read_ahead.retain(task.source_host_id for task in tasks) # Drop cached series of tasks this process no longer replays
+    if not tasks:
+        return tasks
+
+    _tick_counter += 1
+    offset = _tick_counter % len(tasks)
+    return tasks[offset:] + tasks[:offset]
+
+def iter_task_batches(db, tasks, current_time):
+    """
+    Yields a TaskBatch per task, sharing the tick's point budget fairly between tasks.
+
+    The budget is bounded by the rate controller (global and per-endpoint limits and
+    backoff); each task is also held to its own values/s quota if it has one.
+
+    Tasks that fail while preparing are marked failed_processing and skipped.
+    """
+    rate_controller = get_rate_controller()
+    endpoints = parse_trapper_endpoints(config.get('dest_trapper_endpoints'), config.get('dest_trapper_host'), config.get('dest_trapper_port'))
+    tick_budget = rate_controller.tick_budget(endpoints) # Tick limit, lowered by rate limits and backoff
+    task_cap = min(config.get('replay_max_points_per_task', 5000), max(1, ceil(tick_budget / max(1, len(tasks)))))
+    for task in tasks:
+        if tick_budget <= 0:
+            break
+        max_points = min(task_cap, tick_budget)
+        task_quota = rate_controller.task_budget(task.source_host_id, task.rate_limit)
+        if task_quota is not None:
+            if task_quota <= 0:
+                continue # Task used up its quota, it continues on a later tick
+            max_points = min(max_points, task_quota)
+        try:
+            batch = prepare_task_batch(db, task, current_time, max_points)
+        except Exception as prepare_error:
+            logging.error(f"[Replay Job {task.source_host_id}] Error during data processing: {prepare_error}", exc_info=True)
+            task.status = 'failed_processing'
+            task.message = f"Error during data processing: {prepare_error}"
+            continue
+        if batch is not None:
+            tick_budget -= len(batch.packet)
+            rate_controller.record_task(task.source_host_id, len(batch.packet))
+            yield batch
+
+def replay_tick(source_host_ids=None, lease_owner=None, lease_seconds=None, scheduler_holder=None):
+    """
+    Scheduled job that replays the next history points of all active tasks.
+
+    One tick gathers due points across every active task, sends them to the destination
+    trapper in large batched packets and commits the progress of all tasks in a single
+    transaction. The tick's point budget is shared fairly between tasks.
+
+    Args:
+        source_host_ids: Optional list of source host IDs to restrict the tick to
+        lease_owner: Replay worker holding the tasks' replay leases; progress of tasks
+            whose lease it lost is not committed
+        lease_seconds: Lease duration, renewed with the commit
+        scheduler_holder: Holder of the scheduler lease the tick runs under (the web app's
+            engine); progress is only committed while it still holds the lease
+    """
+    db = SessionLocal()
+    stages = StageTimer(REPLAY_TICK_STAGE_SECONDS, engine='threaded')
+    try:
+        stages.start('load_tasks')
+        tasks = load_active_tasks(db, source_host_ids)
+        if not tasks:
+            return
+
+        started = time.time()
+        stages.start('build_packets') # History reads and problem simulation
+        batches = list(iter_task_batches(db, tasks, started))
+        stages.start('send')
+        send_batches(batches)
+        stages.start('finalize')
+        for batch in batches:
+            finalize_task_batch(batch)
+
+        stages.start('commit')
+        if scheduler_holder is not None and not fence_scheduler_lease(db, scheduler_holder):
+            return
+        if lease_owner is not None:
+            fence_replay_leases(db, tasks, lease_owner, lease_seconds)
+        if not commit_with_retry(db):
+            logging.error("[Replay Engine] Failed to commit replay progress")
+            db.rollback()
+            return
+        stages.stop()
+        total_points = sum(len(b.packet) for b in batches)
+        elapsed = time.time() - started
+        REPLAY_TICK_SECONDS.observe(elapsed, engine='threaded')
+        logging.info(f"[Replay Engine] Tick complete: {total_points} points for {len(batches)} tasks in {elapsed:.2f}s{rate_limit_status()}.")
 
     except Exception as e:
-        logging.error(f"[Replay Job {source_host_id}] Unexpected error: {e}", exc_info=True)
+        logging.error(f"[Replay Engine] Unexpected error: {e}", exc_info=True)
         db.rollback() # Rollback the transaction on error
-        if task:
-            task.status = 'failed'
-            task.message = f"Job Error: {e}"
-            try:
-                db.commit() # Attempt to commit the status update after rollback
-            except Exception as commit_e:
-                logging.error(f"[Replay Job {source_host_id}] Error committing failed status after rollback: {commit_e}", exc_info=True)
-        # Job removal logic should ideally be handled by the scheduler management in app.py
-        # For now, we just log.
-        # try:
-        #     scheduler.remove_job(f"replay_{source_host_id}")
-        # except Exception as rem_e:
-        #     logging.warning(f"[Replay Job {source_host_id}] Could not remove job after error: {rem_e}")
     finally:
+        stages.stop()
         db.close() # Ensure the session is closed
+
+def replay_job(source_host_id):
+    """Replays the next history points of a single task.
+
+    Kept for replay jobs scheduled per host by earlier versions; the replay engine
+    (replay_tick) now serves all tasks from one scheduler job.
+
+    Args:
+        source_host_id: ID of the source host being replicated
+    """
+    replay_tick(source_host_ids=[source_host_id])
@@ -0,0 +1,165 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import insert, update
+from sqlalchemy.exc import IntegrityError, OperationalError
+
+from common import Lease, SessionLocal
+
+# Name of the lease held by the process that runs the APScheduler jobs
+SCHEDULER_LEASE = 'scheduler'
+# Seconds between renewal attempts after the database could not be reached
+RETRY_SECONDS = 1.0
+
+
+def fence_lease(db, name, holder):
+    """
+    Checks, within the caller's transaction, that holder still holds a lease.
+
+    The lease row is written in the same transaction, so no other process can take the
+    lease over between this check and the caller's commit.
+
+    Returns:
+        bool: True if holder holds the lease and it has not expired
+    """
+    result = db.execute(
+        update(Lease)
+        .where(Lease.name == name)
+        .where(Lease.holder == holder)
+        .where(Lease.expires_at > time.time())
+        .values(holder=holder)
+    )
+    return result.rowcount == 1
+
+
+class LeaderElector:
+    """
+    Elects one process as leader for a named lease stored in the task store database.
+
+    Every gunicorn worker runs an elector. The leader renews the lease every third of its
+    duration; if it dies or stalls, the lease expires and another worker takes over within
+    one lease period. Acquiring and renewing are single conditional UPDATEs, so two workers
+    can never both succeed for the same lease.
+
+    A renewal that fails because the database is busy does not end the leadership: the
+    leader keeps its role while the lease it last wrote is valid and retries every
+    RETRY_SECONDS. Once that lease expires it steps down at once, before another worker
+    can take over.
+    """
+
+    def __init__(self, name, lease_seconds=30, on_elected=None, on_lost=None):
+        self.name = name
+        self.lease_seconds = lease_seconds
+        self.holder = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.on_elected = on_elected
+        self.on_lost = on_lost
+        self.is_leader = False
+        self.lease_expires_at = 0.0 # Expiry of the lease this process last wrote
+        self._stop = threading.Event()
+        self._thread = None
+
+    def try_acquire(self):
+        """
+        Acquires or renews the lease.
+
+        Returns:
+            bool: True if this process holds the lease afterwards, False if another process
+            does, None if the database could not be updated (the lease is unchanged)
+        """
+        now = time.time()
+        db = SessionLocal()
+        try:
+            # Renew our own lease or take over an expired one
+            result = db.execute(
+                update(Lease)
+                .where(Lease.name == self.name)
+                .where((Lease.holder == self.holder) | (Lease.expires_at < now))
+                .values(holder=self.holder, expires_at=now + self.lease_seconds)
+            )
+            if result.rowcount == 0:
+                # Nobody has held this lease yet
+                db.execute(insert(Lease).values(name=self.name, holder=self.holder, expires_at=now + self.lease_seconds))
+            db.commit()
+            self.lease_expires_at = now + self.lease_seconds
+            return True
+        except IntegrityError:
+            # Another worker just created the lease
+            db.rollback()
+            return False
+        except OperationalError as e:
+            # The database is busy (e.g. SQLite "database is locked"); nothing was changed
+            db.rollback()
+            logging.warning(f"[Leader {self.name}] Could not update lease: {e}")
+            return None
+        finally:
+            db.close()
+
+    def release(self):
+        """Gives up the lease so another worker can take over immediately."""
+        db = SessionLocal()
+        try:
+            db.execute(update(Lease).where(Lease.name == self.name).where(Lease.holder == self.holder).values(expires_at=0))
+            db.commit()
+        except OperationalError as e:
+            db.rollback()
+            logging.warning(f"[Leader {self.name}] Could not release lease: {e}")
+        finally:
+            db.close()
+
+    def _set_leader(self, is_leader):
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        if is_leader:
+            logging.info(f"[Leader {self.name}] {self.holder} is now the leader.")
+            callback = self.on_elected
+        else:
+            logging.warning(f"[Leader {self.name}] {self.holder} lost the leadership.")
+            callback = self.on_lost
+        if callback:
+            try:
+                callback()
+            except Exception as e:
+                logging.error(f"[Leader {self.name}] Error in leadership callback: {e}", exc_info=True)
+
+    def check(self):
+        """
+        Acquires or renews the lease and updates the leadership.
+
+        Returns:
+            float: Seconds until the next check
+        """
+        held = self.try_acquire()
+        if held is None:
+            # Keep the current role while the lease we hold is still valid
+            remaining = self.lease_expires_at - time.time()
+            self._set_leader(self.is_leader and remaining > 0)
+            return min(RETRY_SECONDS, remaining) if self.is_leader else RETRY_SECONDS
+        self._set_leader(held)
+        if self.is_leader:
+            # Wake up by the expiry at the latest, so a leader that cannot renew stops in time
+            return max(0.0, min(self.lease_seconds / 3, self.lease_expires_at - time.time()))
+        return self.lease_seconds / 3
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._stop.wait(self.check())
+
+    def start(self):
+        """Starts the background thread that acquires and renews the lease."""
+        self._thread = threading.Thread(target=self._run, name=f'leader-{self.name}', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stops renewing and releases the lease if this process holds it."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        if self.is_leader:
+            self.release()
+            self.is_leader = False
+            logging.info(f"[Leader {self.name}] {self.holder} released the lease.")
@@ -0,0 +1,268 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from zabbix_utils import ZabbixAPI
+
+# Content type of the Prometheus text exposition format
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# Histogram bucket upper bounds in seconds, from a fast DB query to a long history fetch
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    """A monotonically increasing value per label combination."""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._values = {} # {label values: value}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        if amount <= 0:
+            return
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        """Returns the sum of the values whose labels match the given ones (all values if none are given)."""
+        with self._lock:
+            values = list(self._values.items())
+        return sum(value for key, value in values
+                   if all(key[self.labels.index(name)] == str(label) for name, label in labels.items()))
+
+    def render(self):
+        with self._lock:
+            values = sorted(self._values.items())
+        return [f"{self.name}{_format_labels(self.labels, key)} {_format_number(value)}" for key, value in values]
+
+
+class Histogram:
+    """Counts observations (in seconds) into cumulative buckets per label combination."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {} # {label values: [bucket counts..., sum, count]}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, '')) for name in self.labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 2)
+            if index < len(self.buckets):
+                entry[index] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def totals(self):
+        """
+        Returns:
+            dict: {label values: (sum, count)} of the observations so far
+        """
+        with self._lock:
+            return {key: (entry[-2], entry[-1]) for key, entry in self._values.items()}
+
+    @contextmanager
+    def time(self, **labels):
+        """Observes the duration of the with block."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def render(self):
+        with self._lock:
+            values = sorted((key, list(entry)) for key, entry in self._values.items())
+        lines = []
+        for key, entry in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, entry):
+                cumulative += count
+                le = 'le="%s"' % _format_number(float(bound))
+                lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}")
+            le = 'le="+Inf"'
+            lines.append(f"{self.name}_bucket{_format_labels(self.labels, key, le)} {entry[-1]}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {_format_number(float(entry[-2]))}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {entry[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    """Metrics of this process, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            return self._metrics.setdefault(metric.name, metric)
+
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = MetricsRegistry()
+
+
+class StageTimer:
+    """
+    Times the consecutive stages of a pipeline into a histogram labelled by stage.
+
+    start() ends the running stage and starts the next one, so a long function can be
+    instrumented by calling it where each step begins, next to its status update.
+    """
+
+    def __init__(self, histogram, label='stage', **labels):
+        self.histogram = histogram
+        self.label = label
+        self.labels = labels
+        self.stage = None
+        self.started = None
+
+    def start(self, stage):
+        self.stop()
+        self.stage = stage
+        self.started = time.perf_counter()
+
+    def stop(self):
+        if self.stage is not None:
+            self.histogram.observe(time.perf_counter() - self.started, **{self.label: self.stage}, **self.labels)
+            self.stage = None
+
+
+# --- Replay engine ---
+REPLAY_TICK_STAGE_SECONDS = REGISTRY.register(Histogram(
+    'replayz_replay_tick_stage_seconds', 'Duration of the stages of a replay tick.', ('engine', 'stage')))
+REPLAY_TICK_SECONDS = REGISTRY.register(Histogram(
+    'replayz_replay_tick_seconds', 'Duration of a whole replay tick.', ('engine',)))
+REPLAY_POINTS_SENT = REGISTRY.register(Counter(
+    'replayz_replay_points_sent_total', 'History points sent to the destination trapper.', ('source_host_id',)))
+REPLAY_POINTS_FAILED = REGISTRY.register(Counter(
+    'replayz_replay_points_failed_total', 'History points the destination trapper reported as failed.', ('source_host_id',)))
+REPLAY_SEND_ERRORS = REGISTRY.register(Counter(
+    'replayz_replay_send_errors_total', 'Replay batches that could not be sent.', ('source_host_id',)))
+
+# --- Replication setup ---
+REPLICATION_STEP_SECONDS = REGISTRY.register(Histogram(
+    'replayz_replication_step_seconds', 'Duration of the steps of a host replication.', ('step',)))
+REPLICATIONS = REGISTRY.register(Counter(
+    'replayz_replications_total', 'Host replications run, by result.', ('result',)))
+HISTORY_RECORDS_FETCHED = REGISTRY.register(Counter(
+    'replayz_history_records_fetched_total', 'History records fetched from source Zabbix servers.', ('mode',)))
+
+# --- Zabbix API ---
+API_REQUESTS = REGISTRY.register(Counter(
+    'replayz_zabbix_api_requests_total', 'Zabbix API requests, by method and result.', ('method', 'result')))
+API_REQUEST_SECONDS = REGISTRY.register(Histogram(
+    'replayz_zabbix_api_request_seconds', 'Zabbix API request latency.', ('method',)))
+
+
+def observe_api_call(method, seconds, ok=True):
+    """Records one Zabbix API request."""
+    API_REQUESTS.inc(method=method, result='ok' if ok else 'error')
+    API_REQUEST_SECONDS.observe(seconds, method=method)
+
+
+def record_task_points(source_host_id, sent, failed=0, send_error=False):
+    """Counts a task's points sent and failed in a replay tick."""
+    REPLAY_POINTS_SENT.inc(sent, source_host_id=source_host_id)
+    REPLAY_POINTS_FAILED.inc(failed, source_host_id=source_host_id)
+    if send_error:
+        REPLAY_SEND_ERRORS.inc(source_host_id=source_host_id)
+
+
+def instrument_zabbix_api(api_class=ZabbixAPI):
+    """Wraps api_class.send_api_request so every Zabbix API call is counted and timed (once per class)."""
+    if getattr(api_class.send_api_request, 'instrumented', False):
+        return
+    send_api_request = api_class.send_api_request
+
+    @functools.wraps(send_api_request)
+    def timed_send_api_request(self, method, params=None, need_auth=True):
+        started = time.perf_counter()
+        ok = False
+        try:
+            response = send_api_request(self, method, params, need_auth)
+            ok = True
+            return response
+        finally:
+            observe_api_call(method, time.perf_counter() - started, ok)
+
+    timed_send_api_request.instrumented = True
+    api_class.send_api_request = timed_send_api_request
+
+
+# Every process that imports the metrics counts its Zabbix API calls
+instrument_zabbix_api()
+
+
+def render_metrics():
+    """Returns this process's metrics in the Prometheus text format."""
+    return REGISTRY.render()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = render_metrics().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # Scrapes would flood the log
+
+
+def start_metrics_server(port, host='0.0.0.0'):
+    """Serves /metrics on its own port in a daemon thread (for processes without the web app)."""
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name='metrics-server', daemon=True).start()
+    logging.info(f"Serving Prometheus metrics on http://{host}:{port}/metrics")
+    return server
@@ -0,0 +1,347 @@
+import hashlib
+import json
+import logging
+import os
+import random
+import re
+import threading
+
+try:
+    import yaml # Optional, only needed for YAML scenario profiles
+except ImportError:
+    yaml = None
+
+from common import config
+
+# Fault models a scenario rule can use:
+#   spike: a new random value from the value range for every problem point
+#   step: one value from the range, held for the whole problem
+#   ramp: moves from the recorded value to a value from the range over the problem
+#   flap: alternates between a value from the range and the recorded value
+#   outage: time-windowed and shared by every matching host, see ScenarioRule
+FAULT_MODELS = ('spike', 'step', 'ramp', 'flap', 'outage')
+
+# Built-in profile, used when PROBLEM_SCENARIO is not set. Rule names double as the problem
+# kinds stored with tasks mapped before scenario profiles existed.
+DEFAULT_PROFILE = {
+    'name': 'default',
+    'rules': [
+        {'name': 'cpu_high', 'match': 'cpu.util', 'value': [85, 99]}, # High CPU utilization (> 80)
+        {'name': 'ping_down', 'match': 'icmpping', 'value': 0}, # Ping failure
+        {'name': 'ping_loss', 'match': 'icmppingloss', 'value': [25, 75]}, # High ping loss (> 20)
+        {'name': 'ping_slow', 'match': 'icmppingsec', 'value': [0.2, 1.0]}, # High ping response time (> 0.1)
+        {'name': 'temperature_high', 'match': 'sensor.temp', 'value': [55, 80]}, # High temperature (> 50)
+        {'name': 'link_down', 'match': 'ifOperStatus', 'value': 2}, # Interface link down
+        {'name': 'speed_change', 'match': 'ifSpeed', 'value': [0, 1000000000]}, # Interface speed change
+    ],
+}
+
+# Defaults of stochastic rules: chance that a point starts a problem, and how many points it lasts
+PROBLEM_PROBABILITY = 0.1
+PROBLEM_MIN_DURATION = 2
+PROBLEM_MAX_DURATION = 5
+
+
+def key_pattern_expression(pattern):
+    """Translates an item key pattern into a regex; only * and ? are wildcards, brackets are literal."""
+    return re.escape(pattern).replace('\\*', '.*').replace('\\?', '.') + '\\Z'
+
+
+def _range(value, field, rule_name):
+    """Returns (low, high) of a number or [low, high] rule field."""
+    if isinstance(value, (list, tuple)) and len(value) == 2:
+        low, high = value
+    elif isinstance(value, (int, float)) and not isinstance(value, bool):
+        low = high = value
+    else:
+        raise ValueError(f"Scenario rule '{rule_name}': {field} must be a number or a [low, high] pair, got {value!r}.")
+    if not all(isinstance(v, (int, float)) for v in (low, high)) or low > high:
+        raise ValueError(f"Scenario rule '{rule_name}': invalid {field} {value!r}.")
+    return low, high
+
+
+class ScenarioRule:
+    """
+    One fault model of a scenario profile, applied to the items whose key matches.
+
+    Keys are matched with wildcard patterns (match: "net.if.in[*]"), or with a regular
+    expression (regex: "^net\\.if\\.in\\[.*\\]$"); hosts optionally limits the rule to
+    some source host IDs. Stochastic models start a problem on a point with the rule's
+    probability and keep it for a duration drawn from [low, high] points.
+
+    The outage model doesn't use per-item state: it is active during the first
+    duration_seconds of every every_seconds (shifted by offset_seconds), for every
+    matching item of every matching host at once, which simulates a correlated outage
+    across hosts and replay workers.
+    """
+
+    def __init__(self, spec, index, seed=None):
+        self.name = str(spec.get('name') or f"rule{index + 1}")
+        self.model = spec.get('model', 'spike')
+        if self.model not in FAULT_MODELS:
+            raise ValueError(f"Scenario rule '{self.name}': unknown model '{self.model}', expected one of {', '.join(FAULT_MODELS)}.")
+
+        patterns = spec.get('match', [])
+        patterns = [patterns] if isinstance(patterns, str) else list(patterns)
+        expressions = [key_pattern_expression(pattern) for pattern in patterns]
+        if spec.get('regex'):
+            expressions.append(f"(?:{spec['regex']})\\Z")
+        if not expressions:
+            raise ValueError(f"Scenario rule '{self.name}': 'match' or 'regex' is required.")
+        self.key_pattern = re.compile('|'.join(f"(?:{expression})" for expression in expressions))
+        hosts = spec.get('hosts', '*')
+        self.hosts = None if hosts == '*' else {str(host) for host in ([hosts] if isinstance(hosts, (str, int)) else hosts)}
+
+        if 'value' not in spec:
+            raise ValueError(f"Scenario rule '{self.name}': 'value' is required.")
+        self.value = _range(spec['value'], 'value', self.name)
+        self.probability = float(spec.get('probability', PROBLEM_PROBABILITY))
+        self.duration = _range(spec.get('duration', [PROBLEM_MIN_DURATION, PROBLEM_MAX_DURATION]), 'duration', self.name)
+
+        if self.model == 'outage':
+            self.every_seconds = int(spec.get('every_seconds', 3600))
+            self.duration_seconds = int(spec.get('duration_seconds', 300))
+            if self.every_seconds <= 0 or not 0 < self.duration_seconds <= self.every_seconds:
+                raise ValueError(f"Scenario rule '{self.name}': outages need 0 < duration_seconds <= every_seconds.")
+            if 'offset_seconds' in spec:
+                self.offset_seconds = int(spec['offset_seconds'])
+            else:
+                # Derived from the seed, so every process running the profile agrees on the windows
+                digest = hashlib.md5(f"{seed}:{self.name}".encode('utf-8')).hexdigest()
+                self.offset_seconds = int(digest, 16) % self.every_seconds
+        self.seed = seed
+
+    def matches(self, source_host_id, item_key):
+        return (self.hosts is None or str(source_host_id) in self.hosts) and self.key_pattern.match(item_key) is not None
+
+    def draw_value(self, rng):
+        low, high = self.value
+        return low if low == high else rng.uniform(low, high)
+
+    def draw_duration(self, rng):
+        return rng.randint(int(self.duration[0]), int(self.duration[1]))
+
+    def problem_value(self, rng, original, remaining, elapsed, level):
+        """Returns the value to send for a point of an active problem."""
+        if self.model == 'spike':
+            return self.draw_value(rng)
+        if self.model == 'flap':
+            return level if elapsed % 2 == 0 else original
+        if self.model == 'ramp':
+            try:
+                start = float(original)
+            except (TypeError, ValueError):
+                return level
+            return start + (level - start) * (elapsed + 1) / (elapsed + remaining)
+        return level # step
+
+    def outage_window(self, now):
+        """Returns the index of the outage window active at now, or None outside of outages."""
+        shifted = int(now) - self.offset_seconds
+        if shifted % self.every_seconds < self.duration_seconds:
+            return shifted // self.every_seconds
+        return None
+
+
+class ScenarioProfile:
+    """
+    A compiled problem scenario: an ordered list of rules, the first matching rule wins.
+
+    Profiles are loaded from JSON or YAML (see load_scenario_profile). Each task's mapped
+    items are classified once against the rules and the {itemid: rule name} result is
+    stored with the task, so replaying a packet is a dict lookup per point. With a seed,
+    every task draws from its own RNG seeded with the profile seed, its source host ID and
+    a persisted packet counter, so a replay run produces the same faults every time.
+    """
+
+    def __init__(self, spec, seed=None):
+        if not isinstance(spec, dict):
+            raise ValueError("A scenario profile must be a mapping with a 'rules' list.")
+        self.name = spec.get('name', 'unnamed')
+        self.seed = seed if seed is not None else spec.get('seed')
+        self.rules = [ScenarioRule(rule, index, self.seed) for index, rule in enumerate(spec.get('rules') or [])]
+        self.rules_by_name = {rule.name: rule for rule in self.rules}
+        if len(self.rules_by_name) != len(self.rules):
+            raise ValueError(f"Scenario profile '{self.name}' has duplicate rule names.")
+        # Identifies the compiled rules; tasks classified with another profile are reclassified
+        self.digest = hashlib.md5(json.dumps(spec, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    def classify(self, source_host_id, item_mapping):
+        """Returns {source_itemid: rule name} of the mapped items a rule applies to."""
+        problem_items = {}
+        for itemid, dest_key in (item_mapping or {}).items():
+            if not dest_key:
+                continue
+            for rule in self.rules:
+                if rule.matches(source_host_id, dest_key):
+                    problem_items[str(itemid)] = rule.name
+                    break
+        return problem_items
+
+    def task_rng(self, task):
+        """Returns the RNG for the task's next packet, and advances its packet counter if seeded."""
+        if self.seed is None:
+            return random
+        packets = task.problem_packets or 0
+        task.problem_packets = packets + 1
+        return random.Random(f"{self.seed}:{task.source_host_id}:{packets}")
+
+    def simulate(self, task, itemids, values, now, rng=None):
+        """
+        Replaces the values of a packet with simulated problem values where a problem is active.
+
+        The packet is handled in one pass: points of unclassified items cost one dict lookup
+        and random numbers are only drawn for classified items. A stochastic problem lasts
+        its drawn number of points and is followed by at least one recorded point. Active
+        problems are kept in the task's problem_state, so they survive restarts and carry
+        over between replay workers.
+
+        Returns:
+            list: The values to send, in packet order
+        """
+        problem_items = task_problem_items(task, self)
+        if not problem_items:
+            return values
+        rng = rng or self.task_rng(task)
+
+        previous_state = task.problem_state or {}
+        state = dict(previous_state) # {source_itemid: [remaining points, elapsed points, level]}
+        outage_values = {} # {rule name: value of the current outage window, None outside of it}
+        simulated = list(values)
+        started = 0
+        for index, itemid in enumerate(itemids):
+            rule_name = problem_items.get(itemid)
+            if rule_name is None:
+                continue
+            rule = self.rules_by_name[rule_name]
+
+            if rule.model == 'outage':
+                if rule_name not in outage_values:
+                    window = rule.outage_window(now)
+                    # Same value on every host and worker for the whole window
+                    outage_values[rule_name] = None if window is None else rule.draw_value(random.Random(f"{self.seed}:{rule_name}:{window}"))
+                if outage_values[rule_name] is not None:
+                    simulated[index] = outage_values[rule_name]
+                continue
+
+            entry = state.get(itemid)
+            if isinstance(entry, int):
+                entry = [entry, 0, None] # Remaining points stored by earlier versions
+            if entry is not None and entry[0] <= 0:
+                del state[itemid] # Problem ended, this point is sent as recorded
+                continue
+            if entry is None:
+                if rng.random() >= rule.probability:
+                    continue
+                entry = [rule.draw_duration(rng), 0, rule.draw_value(rng)]
+                started += 1
+            remaining, elapsed, level = entry
+            if level is None:
+                level = rule.draw_value(rng)
+            simulated[index] = rule.problem_value(rng, values[index], remaining, elapsed, level)
+            state[itemid] = [remaining - 1, elapsed + 1, level]
+
+        if state != previous_state:
+            task.problem_state = state # Only rewrite the JSON column when a problem started, continued or ended
+        if started:
+            logging.debug(f"[Replay Job {task.source_host_id}] Started {started} simulated problems, {len(state)} active.")
+        return simulated
+
+
+def load_scenario_profile(path, seed=None):
+    """
+    Loads a scenario profile from a JSON or YAML (.yaml/.yml, needs PyYAML) file.
+
+    Args:
+        seed: Overrides the profile's seed if given
+
+    Raises:
+        ValueError: If the file is not a valid profile
+    """
+    with open(path, 'r', encoding='utf-8') as profile_file:
+        if path.lower().endswith(('.yaml', '.yml')):
+            if yaml is None:
+                raise ValueError(f"Scenario profile {path} is YAML, but PyYAML is not installed (pip install pyyaml).")
+            spec = yaml.safe_load(profile_file)
+        else:
+            spec = json.load(profile_file)
+    return ScenarioProfile(spec, seed)
+
+
+_profile = None
+_profile_source = None # (path, modification time, seed override) the profile was loaded from
+_profile_lock = threading.Lock()
+
+
+def get_scenario_profile():
+    """
+    Returns the active ScenarioProfile.
+
+    PROBLEM_SCENARIO names the profile file ("off" disables problem simulation, empty uses
+    the built-in profile). The file is reloaded when it changes; if it can't be loaded, the
+    previous profile stays active. PROBLEM_SEED overrides the profile's seed.
+    """
+    global _profile, _profile_source
+    path = (config.get('problem_scenario') or '').strip()
+    seed = config.get('problem_seed') or None
+    try:
+        mtime = os.path.getmtime(path) if path and path != 'off' else None
+    except OSError:
+        mtime = None
+    source = (path, mtime, seed)
+    with _profile_lock:
+        if _profile is not None and source == _profile_source:
+            return _profile
+        try:
+            if path == 'off':
+                profile = ScenarioProfile({'name': 'off', 'rules': []})
+            elif path:
+                profile = load_scenario_profile(path, seed)
+            else:
+                profile = ScenarioProfile(DEFAULT_PROFILE, seed)
+            logging.info(f"Problem scenario '{profile.name}' loaded ({len(profile.rules)} rules, seed {profile.seed}).")
+        except Exception as e:
+            logging.error(f"Could not load problem scenario {path}: {e}")
+            if _profile is None:
+                _profile = ScenarioProfile(DEFAULT_PROFILE, seed)
+            profile = _profile
+        _profile, _profile_source = profile, source
+        return _profile
+
+
+def set_task_item_mapping(task, item_mapping, profile=None):
+    """Stores a task's item mapping and classifies its items, keeping state of items still simulated."""
+    task.item_mapping = item_mapping
+    classify_task_items(task, profile or get_scenario_profile())
+
+
+def classify_task_items(task, profile):
+    """Classifies a task's mapped items against a profile and drops state of items no longer simulated."""
+    task.problem_items = profile.classify(task.source_host_id, task.item_mapping)
+    task.problem_profile = profile.digest
+    if task.problem_state:
+        task.problem_state = {itemid: entry for itemid, entry in task.problem_state.items() if itemid in task.problem_items}
+
+
+def task_problem_items(task, profile):
+    """Returns the task's {source_itemid: rule name}, reclassifying if it was classified with another profile."""
+    if task.problem_items is None or task.problem_profile != profile.digest:
+        classify_task_items(task, profile)
+    return task.problem_items
+
+
+def simulate_problems(task, itemids, values, now, rng=None):
+    """
+    Applies the active scenario profile to a packet (see ScenarioProfile.simulate).
+
+    Args:
+        task: ReplicationTask the packet belongs to
+        itemids: Source item ID of every point, in packet order
+        values: Recorded value of every point
+        now: Unix time of the replay tick (outage windows)
+        rng: Optional random.Random-like generator overriding the profile's
+
+    Returns:
+        list: The values to send, in packet order
+    """
+    return get_scenario_profile().simulate(task, itemids, values, now, rng)
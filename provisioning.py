@@ -0,0 +1,224 @@
+import logging
+from collections import namedtuple
+
+
+def bulk_create(create_method, objects, id_field, batch_size=200, label="object"):
+    """
+    Creates (or updates) Zabbix objects with the array form of a *.create (*.update) method.
+
+    Objects are sent batch_size at a time. Zabbix creates a batch in one transaction, so
+    when a batch fails nothing in it was created; the batch is then split in halves and
+    retried until the failing objects are isolated. A batch with one bad object costs
+    about 2 * log2(batch_size) extra calls instead of one call per object.
+
+    Args:
+        create_method: API method, e.g. dest_zapi.item.create or dest_zapi.usermacro.update
+        objects: List of object parameter dicts
+        id_field: ID list in the response, e.g. 'itemids'
+        batch_size: Objects per API call
+        label: Object name used in log messages
+
+    Returns:
+        list: One entry per object, in order: the created (updated) ID, or the Exception
+        that prevented the object from being created
+    """
+    results = [None] * len(objects)
+
+    def create_range(start, end):
+        batch = objects[start:end]
+        try:
+            response = create_method(batch)
+            ids = response.get(id_field) if isinstance(response, dict) else None
+            if not ids or len(ids) != len(batch):
+                raise ValueError(f"API response missing {id_field}. Response: {response}")
+            results[start:end] = ids
+        except Exception as e:
+            if len(batch) == 1:
+                results[start] = e
+                return
+            # Narrow down which object(s) broke the batch
+            middle = start + len(batch) // 2
+            logging.debug(f"Creating {len(batch)} {label}s failed ({e}), retrying in halves.")
+            create_range(start, middle)
+            create_range(middle, end)
+
+    for start in range(0, len(objects), batch_size):
+        create_range(start, min(start + batch_size, len(objects)))
+    return results
+
+
+# A trigger to provision: trigger.create params, item keys that must exist on the host
+# for the trigger to be created, and {macro: default value} the trigger relies on
+TriggerSpec = namedtuple('TriggerSpec', ['params', 'item_keys', 'macros'])
+
+# Fields of an existing trigger kept in line with its TriggerSpec
+TRIGGER_UPDATE_FIELDS = ('expression', 'priority', 'tags')
+
+
+def trigger_field_value(params, field):
+    """Returns a trigger field in a comparable form (tags as a sorted tuple, the rest as strings)."""
+    if field == 'tags':
+        return tuple(sorted((tag.get('tag', ''), tag.get('value', '')) for tag in params.get('tags') or []))
+    return str(params.get(field, ''))
+
+
+def is_already_exists_error(error):
+    """Returns True if an API error says the object already exists."""
+    message = str(error).lower()
+    return "already exists" in message or "trigger with the same name" in message
+
+
+class HostProvisioningPlan:
+    """
+    Collects the macros and triggers wanted on a destination host and applies them in bulk.
+
+    apply() reads the host's items, macros and triggers with one get call each, works out
+    what is missing or outdated (macro values; trigger expressions, priorities and tags)
+    and creates/updates everything with array-form calls, so
+    provisioning a host takes a constant number of API calls however many interfaces,
+    CPU cores or macros it has.
+    """
+
+    def __init__(self, dest_zapi, host_id, host_name=None, batch_size=200):
+        self.dest_zapi = dest_zapi
+        self.host_id = host_id
+        self.host_name = host_name or host_id
+        self.batch_size = batch_size
+        self.macros = {} # {macro: (macro params, update_existing)}
+        self.triggers = [] # [TriggerSpec]
+
+    def add_macro(self, macro, value, update_existing=True, **fields):
+        """
+        Adds a host macro.
+
+        Args:
+            update_existing: Update the value if the macro exists with a different one;
+                otherwise an existing macro is left as is
+            fields: Other usermacro fields (type, description)
+        """
+        if macro not in self.macros:
+            self.macros[macro] = (dict(fields, macro=macro, value=str(value)), update_existing)
+
+    def add_trigger(self, spec):
+        """Adds a trigger (TriggerSpec)."""
+        self.triggers.append(spec)
+
+    def add_triggers(self, specs):
+        for spec in specs:
+            self.add_trigger(spec)
+
+    def _plan_triggers(self):
+        """
+        Works out which triggers to create and which existing ones to update.
+
+        Returns:
+            tuple: (specs to create, trigger.update params of outdated triggers)
+        """
+        if not self.triggers:
+            return [], []
+        existing = {trigger['description']: trigger for trigger in self.dest_zapi.trigger.get(
+            hostids=self.host_id, output=["triggerid", "description", "expression", "priority"],
+            selectTags=["tag", "value"], expandExpression=True)}
+        existing_keys = set()
+        if any(spec.item_keys for spec in self.triggers):
+            existing_keys = {item['key_'] for item in self.dest_zapi.item.get(hostids=self.host_id, output=["key_"])}
+
+        to_create = []
+        updates = []
+        planned = set()
+        for spec in self.triggers:
+            description = spec.params['description']
+            if description in planned:
+                continue
+            current = existing.get(description)
+            if current is not None:
+                planned.add(description)
+                changed = {field: spec.params.get(field, [] if field == 'tags' else '') for field in TRIGGER_UPDATE_FIELDS
+                           if trigger_field_value(spec.params, field) != trigger_field_value(current, field)}
+                if changed:
+                    updates.append(dict(changed, triggerid=current['triggerid']))
+                    for macro, value in spec.macros.items():
+                        self.add_macro(macro, value, update_existing=False)
+                else:
+                    logging.debug(f"Trigger '{description}' already exists for host '{self.host_name}'. Skipping creation.")
+                continue
+            missing_keys = [key for key in spec.item_keys if key not in existing_keys]
+            if missing_keys:
+                logging.warning(f"Item(s) {missing_keys} not found on host '{self.host_name}' (ID: {self.host_id}). Cannot create '{description}' trigger.")
+                continue
+            planned.add(description)
+            to_create.append(spec)
+            # The trigger's macros are only needed if the trigger is created
+            for macro, value in spec.macros.items():
+                self.add_macro(macro, value)
+        return to_create, updates
+
+    def _apply_macros(self, summary):
+        if not self.macros:
+            return
+        existing = {m['macro']: m for m in self.dest_zapi.usermacro.get(hostids=self.host_id, output=["hostmacroid", "macro", "value"])}
+        creates = []
+        updates = []
+        for macro, (params, update_existing) in self.macros.items():
+            current = existing.get(macro)
+            if current is None:
+                creates.append(dict(params, hostid=self.host_id))
+            elif update_existing and current['value'] != params['value']:
+                updates.append({"hostmacroid": current['hostmacroid'], "value": params['value']})
+            else:
+                logging.debug(f"Macro '{macro}' already exists for host ID {self.host_id}. Skipping.")
+
+        for params, result in zip(creates, bulk_create(self.dest_zapi.usermacro.create, creates, 'hostmacroids', self.batch_size, label="macro")):
+            if not isinstance(result, Exception):
+                summary['macros_created'] += 1
+            elif is_already_exists_error(result):
+                logging.warning(f"Macro '{params['macro']}' already exists for host ID {self.host_id}. Skipping.")
+            else:
+                logging.error(f"Failed to create macro '{params['macro']}' for host ID {self.host_id}: {result}")
+                summary['failed'] += 1
+        for params, result in zip(updates, bulk_create(self.dest_zapi.usermacro.update, updates, 'hostmacroids', self.batch_size, label="macro")):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to update macro {params['hostmacroid']} for host ID {self.host_id}: {result}")
+                summary['failed'] += 1
+            else:
+                summary['macros_updated'] += 1
+
+    def apply(self):
+        """
+        Creates and updates the planned macros and triggers on the host.
+
+        Returns:
+            dict: Counts of macros_created, macros_updated, triggers_created, triggers_updated
+            and failed objects
+        """
+        summary = {'macros_created': 0, 'macros_updated': 0, 'triggers_created': 0, 'triggers_updated': 0, 'failed': 0}
+        try:
+            to_create, trigger_updates = self._plan_triggers()
+            # Macros first, triggers reference them
+            self._apply_macros(summary)
+        except Exception as e:
+            logging.error(f"Error planning macros and triggers for host '{self.host_name}' (ID: {self.host_id}): {e}", exc_info=True)
+            summary['failed'] += len(self.macros) + len(self.triggers)
+            return summary
+
+        params = [spec.params for spec in to_create]
+        for trigger, result in zip(params, bulk_create(self.dest_zapi.trigger.create, params, 'triggerids', self.batch_size, label="trigger")):
+            if not isinstance(result, Exception):
+                logging.info(f"Successfully created trigger '{trigger['description']}' with ID: {result}")
+                summary['triggers_created'] += 1
+            elif is_already_exists_error(result):
+                logging.warning(f"Trigger '{trigger['description']}' likely already exists (API error: {result}). Skipping.")
+            else:
+                logging.error(f"Error creating trigger '{trigger['description']}': {result}")
+                summary['failed'] += 1
+        for params, result in zip(trigger_updates, bulk_create(self.dest_zapi.trigger.update, trigger_updates, 'triggerids', self.batch_size, label="trigger")):
+            if isinstance(result, Exception):
+                logging.error(f"Failed to update trigger {params['triggerid']} for host ID {self.host_id}: {result}")
+                summary['failed'] += 1
+            else:
+                summary['triggers_updated'] += 1
+
+        logging.info(f"Provisioned host '{self.host_name}' (ID: {self.host_id}): {summary['macros_created']} macros created, "
+                     f"{summary['macros_updated']} updated, {summary['triggers_created']} triggers created, "
+                     f"{summary['triggers_updated']} updated, {summary['failed']} failed.")
+        return summary
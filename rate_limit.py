@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+
+from common import config
+
+
+class TokenBucket:
+    """
+    Token bucket limiting replayed values per second.
+
+    The rate ramps linearly from start_rate to rate over ramp_seconds, so the load on the
+    destination can be stepped up towards a target to find its ingestion ceiling. Tokens
+    accumulate up to burst_seconds worth of the current rate. A bucket shared by several
+    processes gets `share` of the rate in each of them.
+    """
+
+    def __init__(self, rate, start_rate=None, ramp_seconds=0, burst_seconds=1.0):
+        self.rate = float(rate)
+        self.start_rate = float(start_rate) if start_rate else self.rate
+        self.ramp_seconds = ramp_seconds
+        self.burst_seconds = burst_seconds
+        self.share = 1.0
+        self.started = time.monotonic()
+        self.tokens = self.start_rate * burst_seconds # The first tick may send a full interval's worth
+        self.updated = self.started
+        self._lock = threading.Lock()
+
+    def current_rate(self, now=None):
+        """Returns the allowed values per second at the given (monotonic) time."""
+        now = time.monotonic() if now is None else now
+        if self.ramp_seconds <= 0:
+            return self.rate * self.share
+        ramp = min(1.0, (now - self.started) / self.ramp_seconds)
+        return (self.start_rate + (self.rate - self.start_rate) * ramp) * self.share
+
+    def _refill(self):
+        now = time.monotonic()
+        rate = self.current_rate(now)
+        self.tokens = min(rate * self.burst_seconds, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def available(self):
+        """Returns how many values may be sent right now."""
+        with self._lock:
+            self._refill()
+            return max(0, int(self.tokens))
+
+    def consume(self, count):
+        """Takes count tokens for values that were sent (may go negative to repay a burst)."""
+        with self._lock:
+            self._refill()
+            self.tokens -= count
+
+
+class ReplayRateController:
+    """
+    Limits and paces the values the replay engine sends.
+
+    Three kinds of quota are combined, each a TokenBucket in values per second: a global
+    limit for the engine process, a limit per trapper endpoint and a limit per task. On
+    top of them, an AIMD backoff reacts to the destination: when a tick sees trapper
+    failures, sending errors or slow responses, the tick budget is cut to a fraction of
+    what was just sent; every healthy tick raises it by a fixed step until the configured
+    limits take over again.
+
+    The global and per-endpoint limits are meant for the whole deployment. Each process
+    only knows what it sends itself, so when several replay workers run, each one gets an
+    equal share of those limits (see set_engine_count). Per-task limits need no split,
+    since a task is replayed by one process at a time.
+    """
+
+    def __init__(self, settings, engine_count=1):
+        self.settings = settings
+        self.engine_count = 1
+        self.burst_seconds = max(1.0, settings['replay_interval_seconds'])
+        rate = settings['replay_rate_limit']
+        self.global_bucket = TokenBucket(rate, settings['replay_rate_ramp_start'], settings['replay_rate_ramp_seconds'], self.burst_seconds) if rate > 0 else None
+        self.endpoint_rate = settings['replay_rate_limit_per_endpoint']
+        self.endpoint_buckets = {} # {(host, port): TokenBucket}
+        self.task_rate = settings['replay_rate_limit_per_task']
+        self.task_buckets = {} # {source_host_id: TokenBucket}
+        self.backoff_cap = None # Tick budget while backing off, None when the destination keeps up
+        self.unthrottled_budget = settings['replay_max_points_per_tick'] # Last tick budget before the backoff was applied
+        self._lock = threading.Lock()
+        self.set_engine_count(engine_count)
+
+    def _endpoint_bucket(self, endpoint):
+        bucket = self.endpoint_buckets.get(endpoint)
+        if bucket is None:
+            bucket = self.endpoint_buckets[endpoint] = TokenBucket(self.endpoint_rate, burst_seconds=self.burst_seconds)
+            bucket.share = 1.0 / self.engine_count
+        return bucket
+
+    def set_engine_count(self, count):
+        """Splits the global and per-endpoint limits evenly between count replaying processes."""
+        count = max(1, int(count))
+        with self._lock:
+            if count == self.engine_count:
+                return
+            self.engine_count = count
+            for bucket in [self.global_bucket, *self.endpoint_buckets.values()]:
+                if bucket is not None:
+                    bucket.share = 1.0 / count
+
+    def tick_budget(self, endpoints=()):
+        """
+        Returns the number of points the next tick may send.
+
+        Args:
+            endpoints: Trapper endpoints the tick sends to (for per-endpoint limits)
+        """
+        budget = self.settings['replay_max_points_per_tick']
+        with self._lock:
+            if self.global_bucket is not None:
+                budget = min(budget, self.global_bucket.available())
+            if self.endpoint_rate > 0 and endpoints:
+                # Chunks are spread over the endpoints, so together they bound the tick
+                budget = min(budget, sum(self._endpoint_bucket(endpoint).available() for endpoint in endpoints))
+            self.unthrottled_budget = budget
+            if self.backoff_cap is not None:
+                budget = min(budget, self.backoff_cap)
+        return budget
+
+    def task_budget(self, source_host_id, task_rate=None):
+        """
+        Returns the number of points a task may send this tick, or None if it has no quota.
+
+        Args:
+            task_rate: The task's own values/s limit, overriding REPLAY_RATE_LIMIT_PER_TASK
+        """
+        rate = task_rate or self.task_rate
+        if not rate or rate <= 0:
+            return None
+        with self._lock:
+            bucket = self.task_buckets.get(source_host_id)
+            if bucket is None or bucket.rate != rate:
+                bucket = self.task_buckets[source_host_id] = TokenBucket(rate, burst_seconds=self.burst_seconds)
+        return bucket.available()
+
+    def record_task(self, source_host_id, count):
+        """Charges points sent for a task against its quota."""
+        bucket = self.task_buckets.get(source_host_id)
+        if bucket is not None:
+            bucket.consume(count)
+
+    def record_tick(self, sent, failed=0, errors=0, latency=0.0, endpoint_points=None):
+        """
+        Charges a tick's points against the limits and adjusts the backoff.
+
+        Args:
+            sent: Points sent this tick
+            failed: Points the trapper reported as failed
+            errors: Chunks that could not be sent at all
+            latency: Slowest trapper response of the tick in seconds
+            endpoint_points: {(host, port): points} sent to each endpoint
+        """
+        with self._lock:
+            if self.global_bucket is not None:
+                self.global_bucket.consume(sent)
+            if self.endpoint_rate > 0:
+                for endpoint, count in (endpoint_points or {}).items():
+                    self._endpoint_bucket(endpoint).consume(count)
+
+            if sent <= 0:
+                return
+            congested = (
+                errors > 0
+                or failed / sent > self.settings['replay_backoff_failed_ratio']
+                or latency > self.settings['replay_backoff_latency_seconds']
+            )
+            if congested:
+                # Multiplicative decrease from what the destination was just sent
+                new_cap = max(self.settings['replay_backoff_min_points'], int(sent * self.settings['replay_backoff_decrease']))
+                if self.backoff_cap is None or new_cap < self.backoff_cap:
+                    self.backoff_cap = new_cap
+                    logging.warning(f"[Replay Engine] Destination falling behind (failed={failed}/{sent}, errors={errors}, latency={latency:.2f}s). "
+                                    f"Backing off to {self.backoff_cap} points per tick.")
+            elif self.backoff_cap is not None:
+                # Additive increase; stop backing off once the cap no longer limits the tick
+                self.backoff_cap += self.settings['replay_backoff_increase']
+                if self.backoff_cap >= self.unthrottled_budget:
+                    self.backoff_cap = None
+                    logging.info("[Replay Engine] Destination keeps up again, backoff lifted.")
+
+    def status(self):
+        """Returns a log suffix describing the active limits ("" if none)."""
+        parts = []
+        if self.global_bucket is not None:
+            shared = f" (1/{self.engine_count} of the limit)" if self.engine_count > 1 else ""
+            parts.append(f"rate limit {self.global_bucket.current_rate():.0f} values/s{shared}")
+        if self.backoff_cap is not None:
+            parts.append(f"backoff {self.backoff_cap} points/tick")
+        return ", " + ", ".join(parts) if parts else ""
+
+
+# Settings the controller is built from; it is rebuilt (restarting ramps and backoff) when one changes
+_CONTROLLER_SETTINGS = (
+    'replay_interval_seconds',
+    'replay_max_points_per_tick',
+    'replay_rate_limit',
+    'replay_rate_ramp_start',
+    'replay_rate_ramp_seconds',
+    'replay_rate_limit_per_endpoint',
+    'replay_rate_limit_per_task',
+    'replay_backoff_failed_ratio',
+    'replay_backoff_latency_seconds',
+    'replay_backoff_decrease',
+    'replay_backoff_increase',
+    'replay_backoff_min_points',
+)
+
+_controller = None
+_controller_lock = threading.Lock()
+
+
+def get_rate_controller():
+    """
+    Returns the replay engine's ReplayRateController.
+
+    Its buckets live in this process; replay workers split the global and per-endpoint
+    limits between the live workers with set_engine_count.
+    """
+    global _controller
+    settings = {key: config.get(key) for key in _CONTROLLER_SETTINGS}
+    with _controller_lock:
+        if _controller is None or settings != _controller.settings:
+            _controller = ReplayRateController(settings, _controller.engine_count if _controller else 1)
+            if settings['replay_rate_limit'] > 0:
+                ramp = f", ramping from {settings['replay_rate_ramp_start']}/s over {settings['replay_rate_ramp_seconds']}s" \
+                    if settings['replay_rate_ramp_start'] and settings['replay_rate_ramp_seconds'] else ""
+                logging.info(f"[Replay Engine] Rate limit set to {settings['replay_rate_limit']} values/s{ramp}.")
+        return _controller
+
+
+def rate_limit_status():
+    """Returns a log suffix describing the active replay limits ("" if unlimited)."""
+    return get_rate_controller().status()
@@ -0,0 +1,245 @@
+"""
+Standalone replay worker.
+
+Runs the replay engine outside the Flask process so replay scales across cores and
+machines independently of the web UI:
+
+    python replay_worker.py --processes 4
+
+Every worker process registers itself in the replay_workers table and heartbeats. The
+live workers form a consistent-hash ring over the source host IDs, and each worker only
+replays the tasks it owns. When a worker joins or stops heartbeating, only the tasks on
+its part of the ring move. Set REPLAY_IN_WEB=false so the web app stops running the
+engine itself.
+
+Ownership is enforced per task with a lease (replay_owner/replay_lease_expires_at): a
+worker claims a task with a conditional UPDATE that only succeeds while no other worker
+holds an unexpired lease, and a tick only commits the progress of tasks whose lease the
+worker still holds. Two workers that briefly disagree about the ring can therefore never
+both replay a task.
+"""
+import argparse
+import bisect
+import hashlib
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import uuid
+
+from sqlalchemy import or_, update
+from sqlalchemy.exc import OperationalError
+
+from common import ReplayWorker, ReplicationTask, SessionLocal, config, engine
+from jobs import REPLAY_ACTIVE_STATUSES, chunked, commit_with_retry, replay_tick
+from async_replay import replay_tick_async
+from metrics import start_metrics_server
+from rate_limit import get_rate_controller
+
+# Points per worker on the hash ring; more points spread tasks more evenly
+RING_REPLICAS = 64
+
+
+def task_lease_seconds():
+    """Returns the replay lease duration (REPLAY_TASK_LEASE_SECONDS, by default worker timeout + two ticks)."""
+    lease = config.get('replay_task_lease_seconds') or 0
+    if lease > 0:
+        return lease
+    return config.get('replay_worker_timeout_seconds', 30) + 2 * config.get('replay_interval_seconds', 60)
+
+
+def _hash(key):
+    return int(hashlib.md5(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing:
+    """Consistent-hash ring mapping source host IDs to worker IDs."""
+
+    def __init__(self, worker_ids, replicas=RING_REPLICAS):
+        self.worker_ids = sorted(worker_ids)
+        points = sorted((_hash(f"{worker_id}#{i}"), worker_id) for worker_id in self.worker_ids for i in range(replicas))
+        self._hashes = [point for point, _ in points]
+        self._owners = [worker_id for _, worker_id in points]
+
+    def owner(self, key):
+        """Returns the worker ID owning key, or None if the ring is empty."""
+        if not self._owners:
+            return None
+        index = bisect.bisect(self._hashes, _hash(str(key))) % len(self._hashes)
+        return self._owners[index]
+
+
+class ReplayWorkerProcess:
+    """One replay worker: heartbeats, tracks ring membership and replays its shard each tick."""
+
+    def __init__(self):
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.stop_event = threading.Event()
+        self.ring_members = None
+
+    def heartbeat(self):
+        """Registers or refreshes this worker's row in replay_workers."""
+        db = SessionLocal()
+        try:
+            worker = db.query(ReplayWorker).filter(ReplayWorker.worker_id == self.worker_id).first()
+            now = time.time()
+            if worker is None:
+                worker = ReplayWorker(worker_id=self.worker_id, hostname=socket.gethostname(), pid=os.getpid(), started_at=now)
+                db.add(worker)
+            worker.last_heartbeat = now
+            if not commit_with_retry(db):
+                db.rollback()
+        except OperationalError as e:
+            db.rollback()
+            logging.warning(f"[Replay Worker {self.worker_id}] Heartbeat failed: {e}")
+        finally:
+            db.close()
+
+    def unregister(self):
+        """Removes this worker from the ring and releases its task leases so its shard moves right away."""
+        db = SessionLocal()
+        try:
+            db.query(ReplayWorker).filter(ReplayWorker.worker_id == self.worker_id).delete(synchronize_session=False)
+            db.query(ReplicationTask).filter(ReplicationTask.replay_owner == self.worker_id) \
+                .update({'replay_owner': None, 'replay_lease_expires_at': None}, synchronize_session=False)
+            commit_with_retry(db)
+        finally:
+            db.close()
+
+    def _heartbeat_loop(self):
+        while not self.stop_event.wait(config.get('replay_worker_heartbeat_seconds', 10)):
+            self.heartbeat()
+
+    def live_workers(self, db):
+        """Returns the IDs of workers that heartbeated within the timeout."""
+        cutoff = time.time() - config.get('replay_worker_timeout_seconds', 30)
+        rows = db.query(ReplayWorker.worker_id).filter(ReplayWorker.last_heartbeat >= cutoff).all()
+        return {worker_id for worker_id, in rows} | {self.worker_id}
+
+    def claim_tasks(self, db, shard):
+        """
+        Claims the replay leases of the shard's tasks and releases leases outside the shard.
+
+        A task is claimed only if it is unowned, already ours or its lease expired, so a
+        task stays with its previous worker until that worker releases it or stops renewing.
+
+        Args:
+            shard: Source host IDs the hash ring assigns to this worker
+
+        Returns:
+            list: Source host IDs of the shard whose lease this worker holds
+        """
+        now = time.time()
+        expires_at = now + task_lease_seconds()
+        for chunk in chunked(shard):
+            db.execute(
+                update(ReplicationTask)
+                .where(ReplicationTask.source_host_id.in_(chunk),
+                       or_(ReplicationTask.replay_owner == self.worker_id,
+                           ReplicationTask.replay_owner.is_(None),
+                           ReplicationTask.replay_lease_expires_at < now))
+                .values(replay_owner=self.worker_id, replay_lease_expires_at=expires_at)
+                .execution_options(synchronize_session=False)
+            )
+        rows = db.query(ReplicationTask.source_host_id).filter(ReplicationTask.replay_owner == self.worker_id).all()
+        held = {source_host_id for source_host_id, in rows}
+        shard_ids = set(shard)
+        released = [source_host_id for source_host_id in held if source_host_id not in shard_ids]
+        for chunk in chunked(released):
+            db.query(ReplicationTask).filter(ReplicationTask.source_host_id.in_(chunk), ReplicationTask.replay_owner == self.worker_id) \
+                .update({'replay_owner': None, 'replay_lease_expires_at': None}, synchronize_session=False)
+        if not commit_with_retry(db):
+            db.rollback()
+            return []
+        return [source_host_id for source_host_id in shard if source_host_id in held]
+
+    def owned_tasks(self):
+        """
+        Returns the source host IDs of the active tasks this worker owns.
+
+        The hash ring decides which tasks belong to this worker; a task is only returned
+        once the worker holds its replay lease (see claim_tasks).
+        """
+        db = SessionLocal()
+        try:
+            members = self.live_workers(db)
+            if members != self.ring_members:
+                logging.info(f"[Replay Worker {self.worker_id}] Ring changed: {len(members)} live worker(s). Rebalancing shard.")
+                self.ring_members = members
+            get_rate_controller().set_engine_count(len(members)) # Global and endpoint limits are shared by the ring
+            ring = HashRing(members)
+            rows = db.query(ReplicationTask.source_host_id).filter(ReplicationTask.status.in_(REPLAY_ACTIVE_STATUSES)).all()
+            shard = [source_host_id for source_host_id, in rows if ring.owner(source_host_id) == self.worker_id]
+            return self.claim_tasks(db, shard)
+        except OperationalError as e:
+            db.rollback()
+            logging.warning(f"[Replay Worker {self.worker_id}] Claiming tasks failed: {e}")
+            return []
+        finally:
+            db.close()
+
+    def run(self):
+        """Runs replay ticks for this worker's shard until stopped."""
+        logging.info(f"[Replay Worker {self.worker_id}] Starting ({config.get('replay_engine')} engine).")
+        self.heartbeat()
+        heartbeat_thread = threading.Thread(target=self._heartbeat_loop, name='replay-heartbeat', daemon=True)
+        heartbeat_thread.start()
+        tick_func = replay_tick_async if config.get('replay_engine') == 'async' else replay_tick
+        try:
+            while not self.stop_event.is_set():
+                started = time.time()
+                try:
+                    shard = self.owned_tasks()
+                    if shard:
+                        tick_func(shard, lease_owner=self.worker_id, lease_seconds=task_lease_seconds())
+                except Exception as e:
+                    logging.error(f"[Replay Worker {self.worker_id}] Error in replay tick: {e}", exc_info=True)
+                elapsed = time.time() - started
+                self.stop_event.wait(max(0, config.get('replay_interval_seconds', 60) - elapsed))
+        finally:
+            self.unregister()
+            logging.info(f"[Replay Worker {self.worker_id}] Stopped.")
+
+
+def run_worker(metrics_port=None):
+    """Entry point of one worker process; stops cleanly on SIGTERM/SIGINT."""
+    engine.dispose(close=False) # Don't reuse pooled connections inherited from the parent process
+    if metrics_port:
+        start_metrics_server(metrics_port)
+    worker = ReplayWorkerProcess()
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop_event.set())
+    signal.signal(signal.SIGINT, lambda *_: worker.stop_event.set())
+    worker.run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run standalone replay worker processes.")
+    parser.add_argument('--processes', type=int, default=1, help="Number of worker processes to start on this machine")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="Serve Prometheus metrics on /metrics; worker process i uses port + i")
+    args = parser.parse_args()
+
+    if args.processes <= 1:
+        run_worker(args.metrics_port)
+        return
+
+    processes = [multiprocessing.Process(target=run_worker, args=(args.metrics_port + i if args.metrics_port else None,), name=f'replay-worker-{i}')
+                 for i in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    def stop_all(*_):
+        for process in processes:
+            if process.is_alive():
+                process.terminate() # Sends SIGTERM, each worker finishes its tick and unregisters
+    signal.signal(signal.SIGTERM, stop_all)
+    signal.signal(signal.SIGINT, stop_all)
+    for process in processes:
+        process.join()
+
+
+if __name__ == '__main__':
+    main()
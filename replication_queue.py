@@ -0,0 +1,237 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import and_, func, or_, update
+from sqlalchemy.exc import OperationalError
+
+from common import ReplicationTask, SessionLocal
+
+# Status of a task waiting in the bulk replication queue
+QUEUED_STATUS = 'queued'
+# Statuses of a task whose setup (replication pipeline or re-linking) is running in some process
+SETUP_STATUSES = ('starting', 'fetching_source_config', 'mapping_ids', 'modifying_items', 'creating_dest_host',
+                  'comparing_items', 'fetching_history', 'storing_data', 'scheduling_replay',
+                  'relinking', 'rebuilding_mapping')
+# Claims of a queued task before it is given up on and marked failed
+MAX_SETUP_ATTEMPTS = 3
+# Setups without a lease (started by a version without setup leases) count as abandoned after this long
+UNLEASED_SETUP_TIMEOUT = 3600
+
+
+class ReplicationQueue:
+    """
+    Works through queued replication tasks on a bounded thread pool.
+
+    Queued hosts are ReplicationTask rows in the 'queued' status, so the queue survives
+    restarts and is shared by every gunicorn worker. A dispatcher thread claims the oldest
+    queued task with a conditional UPDATE (only one process can move it out of 'queued')
+    whenever a worker thread is free, and runs run_task(source_host_id) for it. Each
+    process sets up at most `workers` hosts at a time.
+
+    A process holds a lease on every task it sets up (setup_owner and
+    setup_lease_expires_at) and the dispatcher renews it while the setup runs. When a
+    process dies its leases expire, and the next dispatcher to look re-queues those
+    tasks, or marks them failed if they were not queued or have used up their attempts.
+    """
+
+    def __init__(self, run_task, workers=4, poll_seconds=5.0, lease_seconds=120.0):
+        self.run_task = run_task
+        self.workers = max(1, workers)
+        self.poll_seconds = poll_seconds
+        self.lease_seconds = lease_seconds
+        self.owner_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._executor = None
+        self._in_flight = set()
+        self._held = set() # Tasks whose setup lease this process renews
+        self._renew_at = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def claim_next(self):
+        """
+        Claims the oldest queued task for this process.
+
+        Returns:
+            str: source_host_id of the claimed task, or None if nothing is queued
+        """
+        db = SessionLocal()
+        try:
+            candidates = db.query(ReplicationTask.source_host_id) \
+                .filter(ReplicationTask.status == QUEUED_STATUS) \
+                .order_by(ReplicationTask.start_time) \
+                .limit(self.workers) \
+                .all()
+            for source_host_id, in candidates:
+                now = time.time()
+                result = db.execute(
+                    update(ReplicationTask)
+                    .where(ReplicationTask.source_host_id == source_host_id)
+                    .where(ReplicationTask.status == QUEUED_STATUS)
+                    .values(status='starting', message='Initiating replication...', start_time=now,
+                            setup_owner=self.owner_id, setup_lease_expires_at=now + self.lease_seconds,
+                            setup_attempts=func.coalesce(ReplicationTask.setup_attempts, 0) + 1)
+                )
+                db.commit()
+                if result.rowcount == 1:
+                    with self._lock:
+                        self._held.add(source_host_id)
+                    return source_host_id
+                # Another process claimed it first, try the next one
+            return None
+        except OperationalError as e:
+            db.rollback()
+            logging.warning(f"[Replication Queue] Could not claim a queued task: {e}")
+            return None
+        finally:
+            db.close()
+
+    def hold(self, task):
+        """
+        Takes the setup lease of a task set up outside the queue (e.g. by a web request).
+
+        The lease is set on the task object and saved with the caller's next commit.
+        """
+        task.setup_owner = self.owner_id
+        task.setup_lease_expires_at = time.time() + self.lease_seconds
+        with self._lock:
+            self._held.add(task.source_host_id)
+
+    def release(self, source_host_id):
+        """Stops renewing the setup lease of a task once its setup is over."""
+        with self._lock:
+            self._held.discard(source_host_id)
+
+    def renew_leases(self):
+        """Extends the setup leases this process holds. Returns the number of renewed tasks."""
+        with self._lock:
+            held = list(self._held)
+        if not held:
+            return 0
+        db = SessionLocal()
+        try:
+            result = db.execute(
+                update(ReplicationTask)
+                .where(ReplicationTask.source_host_id.in_(held))
+                .where(ReplicationTask.setup_owner == self.owner_id)
+                .values(setup_lease_expires_at=time.time() + self.lease_seconds)
+            )
+            db.commit()
+            return result.rowcount
+        except OperationalError as e:
+            db.rollback()
+            logging.warning(f"[Replication Queue] Could not renew setup leases: {e}")
+            return 0
+        finally:
+            db.close()
+
+    def recover_abandoned(self):
+        """
+        Re-queues tasks whose setup lease expired, i.e. whose process is gone.
+
+        Queued tasks go back to the queue until they have been claimed MAX_SETUP_ATTEMPTS
+        times; other tasks (single host replications, re-linking) are marked failed so
+        they can be started again.
+
+        Returns:
+            tuple: (requeued, failed) task counts
+        """
+        now = time.time()
+        abandoned = and_(
+            ReplicationTask.status.in_(SETUP_STATUSES),
+            or_(ReplicationTask.setup_lease_expires_at < now,
+                and_(ReplicationTask.setup_lease_expires_at.is_(None), ReplicationTask.start_time < now - UNLEASED_SETUP_TIMEOUT)),
+        )
+        db = SessionLocal()
+        try:
+            failed = db.execute(
+                update(ReplicationTask)
+                .where(abandoned)
+                .where(or_(ReplicationTask.batch_id.is_(None), ReplicationTask.setup_attempts >= MAX_SETUP_ATTEMPTS))
+                .values(status='failed', message='Setup was interrupted: the process running it stopped.',
+                        setup_owner=None, setup_lease_expires_at=None)
+            ).rowcount
+            requeued = db.execute(
+                update(ReplicationTask)
+                .where(abandoned)
+                .values(status=QUEUED_STATUS, message='Queued again after the process setting it up stopped.',
+                        setup_owner=None, setup_lease_expires_at=None)
+            ).rowcount
+            db.commit()
+        except OperationalError as e:
+            db.rollback()
+            logging.warning(f"[Replication Queue] Could not recover abandoned tasks: {e}")
+            return 0, 0
+        finally:
+            db.close()
+        if requeued or failed:
+            logging.warning(f"[Replication Queue] Recovered abandoned setups: {requeued} re-queued, {failed} marked failed.")
+        return requeued, failed
+
+    def maintain(self):
+        """Renews this process's setup leases and recovers abandoned tasks, at most every third of a lease."""
+        now = time.time()
+        if now < self._renew_at:
+            return
+        self._renew_at = now + self.lease_seconds / 3
+        self.renew_leases()
+        if self.recover_abandoned()[0]:
+            self._wakeup.set()
+
+    def notify(self):
+        """Wakes the dispatcher, e.g. right after hosts were queued."""
+        self._wakeup.set()
+
+    def _run(self, source_host_id):
+        try:
+            self.run_task(source_host_id)
+        except Exception as e:
+            logging.error(f"[Replication Queue] Replication of source host {source_host_id} failed: {e}", exc_info=True)
+        finally:
+            with self._lock:
+                self._in_flight.discard(source_host_id)
+                self._held.discard(source_host_id)
+            self._wakeup.set()
+
+    def _dispatch_loop(self):
+        while not self._stop.is_set():
+            self.maintain()
+            while not self._stop.is_set():
+                with self._lock:
+                    if len(self._in_flight) >= self.workers:
+                        break
+                source_host_id = self.claim_next()
+                if source_host_id is None:
+                    break
+                with self._lock:
+                    self._in_flight.add(source_host_id)
+                logging.info(f"[Replication Queue] Starting queued replication of source host {source_host_id}.")
+                self._executor.submit(self._run, source_host_id)
+            self._wakeup.wait(self.poll_seconds)
+            self._wakeup.clear()
+
+    def in_flight(self):
+        """Returns the number of tasks this process is setting up."""
+        with self._lock:
+            return len(self._in_flight)
+
+    def start(self):
+        """Starts the dispatcher thread and the worker pool."""
+        if self._thread is not None:
+            return
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='replicate')
+        self._thread = threading.Thread(target=self._dispatch_loop, name='replication-queue', daemon=True)
+        self._thread.start()
+
+    def stop(self, wait=False):
+        """Stops claiming tasks. Tasks already running finish unless the process exits."""
+        self._stop.set()
+        self._wakeup.set()
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
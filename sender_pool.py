@@ -0,0 +1,153 @@
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from zabbix_utils import Sender
+
+from common import config
+
+# Rough per-value overhead of the trapper JSON envelope ({"host":..,"key":..,"value":..,"clock":..,"ns":..})
+ITEM_JSON_OVERHEAD_BYTES = 64
+
+# Outcome of one chunk: TrapperResponse or Exception, the (host, port) that answered last and the send time
+ChunkResult = namedtuple('ChunkResult', ['chunk', 'response', 'endpoint', 'seconds'])
+
+
+def parse_trapper_endpoints(endpoints_setting, default_host, default_port):
+    """
+    Parses a comma separated "host[:port]" list of trapper endpoints.
+
+    Falls back to the single default trapper host/port when the setting is empty.
+
+    Returns:
+        list: [(host, port), ...]
+    """
+    endpoints = []
+    for entry in (endpoints_setting or "").split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        host, _, port = entry.rpartition(':') if ':' in entry else (entry, '', '')
+        endpoints.append((host, int(port) if port else int(default_port)))
+    if not endpoints and default_host:
+        endpoints.append((default_host, int(default_port)))
+    return endpoints
+
+
+def chunk_items(items, chunk_size, max_packet_bytes):
+    """
+    Splits ItemValue objects into chunks bounded by value count and estimated packet size.
+
+    Returns:
+        list: [[ItemValue, ...], ...]
+    """
+    chunks = []
+    current = []
+    current_bytes = 0
+    for item in items:
+        item_bytes = len(item.host) + len(item.key) + len(item.value) + ITEM_JSON_OVERHEAD_BYTES
+        if current and (len(current) >= chunk_size or current_bytes + item_bytes > max_packet_bytes):
+            chunks.append(current)
+            current = []
+            current_bytes = 0
+        current.append(item)
+        current_bytes += item_bytes
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+class SenderPool:
+    """
+    Long-lived trapper senders shared across replay runs.
+
+    One Sender is kept per trapper endpoint and chunks are spread round-robin across
+    endpoints, with at most max_connections sends in flight per endpoint. The trapper
+    protocol answers one request per TCP connection, so each chunk still opens its own
+    connection; the pool bounds how many are open at once and fails a chunk over to the
+    next endpoint when one is unreachable.
+    """
+
+    def __init__(self, endpoints, chunk_size=1000, max_connections=4, timeout=10, max_packet_bytes=1048576):
+        if not endpoints:
+            raise ValueError("At least one trapper endpoint is required")
+        self.endpoints = list(endpoints)
+        self.chunk_size = chunk_size
+        self.max_packet_bytes = max_packet_bytes
+        self._senders = {
+            endpoint: Sender(server=endpoint[0], port=endpoint[1], chunk_size=chunk_size, timeout=timeout)
+            for endpoint in self.endpoints
+        }
+        self._slots = {endpoint: threading.BoundedSemaphore(max_connections) for endpoint in self.endpoints}
+        self._next_endpoint = itertools.cycle(range(len(self.endpoints)))
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(
+            max_workers=len(self.endpoints) * max_connections,
+            thread_name_prefix='trapper-send'
+        )
+
+    def _send_chunk(self, chunk, first_endpoint_index):
+        """Sends one chunk, trying each endpoint once starting at first_endpoint_index."""
+        started = time.monotonic()
+        last_error = None
+        for attempt in range(len(self.endpoints)):
+            endpoint = self.endpoints[(first_endpoint_index + attempt) % len(self.endpoints)]
+            with self._slots[endpoint]:
+                try:
+                    return ChunkResult(chunk, self._senders[endpoint].send(chunk), endpoint, time.monotonic() - started)
+                except Exception as e:
+                    last_error = e
+                    logging.warning(f"Trapper send to {endpoint[0]}:{endpoint[1]} failed: {e}")
+        return ChunkResult(chunk, last_error, endpoint, time.monotonic() - started)
+
+    def send_chunks(self, items):
+        """
+        Sends items as size-bounded chunks across the endpoints.
+
+        Returns:
+            list: [ChunkResult, ...] in chunk order
+        """
+        chunks = chunk_items(items, self.chunk_size, self.max_packet_bytes)
+        futures = []
+        for chunk in chunks:
+            with self._lock:
+                endpoint_index = next(self._next_endpoint)
+            futures.append(self._executor.submit(self._send_chunk, chunk, endpoint_index))
+
+        return [future.result() for future in futures]
+
+    def close(self):
+        """Stops the pool's send threads once in-flight sends finish."""
+        self._executor.shutdown(wait=True)
+
+
+_pool = None
+_pool_settings = None
+_pool_lock = threading.Lock()
+
+
+def get_sender_pool():
+    """
+    Returns the shared SenderPool, rebuilding it if the trapper configuration changed
+    (e.g. through /api/config).
+    """
+    global _pool, _pool_settings
+    settings = (
+        tuple(parse_trapper_endpoints(config.get('dest_trapper_endpoints'), config.get('dest_trapper_host'), config.get('dest_trapper_port'))),
+        config.get('trapper_chunk_size', 1000),
+        config.get('trapper_max_connections', 4),
+        config.get('trapper_timeout', 10),
+        config.get('trapper_max_packet_bytes', 1048576),
+    )
+    with _pool_lock:
+        if _pool is None or settings != _pool_settings:
+            if _pool is not None:
+                _pool.close()
+            endpoints, chunk_size, max_connections, timeout, max_packet_bytes = settings
+            _pool = SenderPool(endpoints, chunk_size, max_connections, timeout, max_packet_bytes)
+            _pool_settings = settings
+            logging.info(f"Trapper sender pool ready for {len(endpoints)} endpoint(s), {max_connections} connection(s) each.")
+        return _pool
@@ -0,0 +1,167 @@
+import sys
+import threading
+from array import array
+
+# Storage kinds of a series' values
+KIND_FLOAT = 'float' # value type 0, numeric float
+KIND_UINT = 'uint' # value type 3, numeric unsigned
+KIND_TEXT = 'text' # value types 1, 2 and 4 (character, log, text)
+
+_TYPECODES = {KIND_FLOAT: 'd', KIND_UINT: 'Q', KIND_TEXT: 'I'}
+
+# Points read ahead per item when the replay engine refills a series from the history store
+READ_AHEAD_POINTS = 60
+
+
+def format_float(value):
+    """
+    Formats a float value the way Zabbix returns it: whole numbers without ".0"
+    ("2", "100"), anything else in Python's shortest round-trip form ("2.5").
+    """
+    if value.is_integer() and abs(value) < 1e15:
+        return str(int(value))
+    return repr(value)
+
+
+def series_kind_for_value_type(value_type):
+    """Maps a Zabbix item value_type (or history type) to a series storage kind."""
+    value_type = str(value_type)
+    if value_type == '0':
+        return KIND_FLOAT
+    if value_type == '3':
+        return KIND_UINT
+    return KIND_TEXT
+
+
+class StringTable:
+    """
+    Interns text values so repeated strings (log lines, states, versions) are stored once.
+
+    Series keep array indexes into the table instead of string objects.
+    """
+
+    def __init__(self):
+        self.strings = []
+        self._index = {}
+        self._lock = threading.Lock() # History fetch threads share one table
+
+    def intern(self, value):
+        index = self._index.get(value)
+        if index is None:
+            with self._lock:
+                index = self._index.get(value)
+                if index is None:
+                    self.strings.append(sys.intern(value))
+                    index = self._index[value] = len(self.strings) - 1
+        return index
+
+    def __getitem__(self, index):
+        return self.strings[index]
+
+
+class ReplaySeries:
+    """
+    Compact (clock, value) series of one item.
+
+    Clocks are kept in an array of 64-bit ints. Numeric values are kept in a parallel
+    array of doubles or unsigned 64-bit ints; text values as indexes into a StringTable.
+    A point costs 16 bytes instead of a dict per point.
+    """
+
+    __slots__ = ('kind', 'clocks', 'values', 'strings')
+
+    def __init__(self, kind, strings=None):
+        self.kind = kind
+        self.clocks = array('q')
+        self.values = array(_TYPECODES[kind])
+        self.strings = strings if strings is not None else (StringTable() if kind == KIND_TEXT else None)
+
+    def append(self, clock, value):
+        self.clocks.append(int(clock))
+        if self.kind == KIND_FLOAT:
+            self.values.append(float(value))
+        elif self.kind == KIND_UINT:
+            self.values.append(int(value))
+        else:
+            self.values.append(self.strings.intern(value))
+
+    def value_at(self, index):
+        """Returns the value at index as the string sent to the trapper."""
+        value = self.values[index]
+        if self.kind == KIND_TEXT:
+            return self.strings[value]
+        if self.kind == KIND_FLOAT:
+            return format_float(value)
+        return str(value)
+
+    def __len__(self):
+        return len(self.clocks)
+
+    def __getitem__(self, index):
+        return self.clocks[index], self.value_at(index)
+
+    def __iter__(self):
+        for index in range(len(self.clocks)):
+            yield self.clocks[index], self.value_at(index)
+
+
+class SeriesReadAhead:
+    """
+    Per-process cache of upcoming replay points, read from the history store in blocks.
+
+    For every (source host, item) it keeps a ReplaySeries holding the points from a base
+    seq onwards. The replay engine reads the next points from the cache and only queries
+    the store when an item runs past its block. A task's cache is dropped when its history
+    is replaced (new history generation or first history timestamp) or its seq bounds
+    change, and when the task is no longer replayed by this process (see retain).
+    """
+
+    def __init__(self, read_ahead=READ_AHEAD_POINTS):
+        self.read_ahead = read_ahead
+        self._tasks = {} # {source_host_id: (signature, {itemid: (base_seq, ReplaySeries)})}
+        self._lock = threading.Lock()
+
+    def get_points(self, db, task, positions, history_bounds, load_ranges):
+        """
+        Returns the points at the requested positions.
+
+        Args:
+            db: SQLAlchemy session
+            task: ReplicationTask the points belong to
+            positions: {itemid: seq} of the points to return
+            history_bounds: {itemid: (first_seq, point_count)} of the task's stored history
+            load_ranges: function(db, source_host_id, {itemid: (from_seq, count)}) -> {itemid: ReplaySeries}
+
+        Returns:
+            dict: {itemid: (clock, value)}
+        """
+        signature = (task.history_generation, task.first_history_timestamp, tuple(sorted(history_bounds.items())))
+        with self._lock:
+            cached = self._tasks.get(task.source_host_id)
+            if cached is None or cached[0] != signature:
+                cached = (signature, {})
+                self._tasks[task.source_host_id] = cached
+            item_series = cached[1]
+
+            refill = {}
+            for itemid, seq in positions.items():
+                entry = item_series.get(itemid)
+                if entry is None or not (entry[0] <= seq < entry[0] + len(entry[1])):
+                    refill[itemid] = (seq, self.read_ahead)
+            if refill:
+                for itemid, series in load_ranges(db, task.source_host_id, refill).items():
+                    item_series[itemid] = (refill[itemid][0], series)
+
+            points = {}
+            for itemid, seq in positions.items():
+                entry = item_series.get(itemid)
+                if entry is not None and entry[0] <= seq < entry[0] + len(entry[1]):
+                    points[itemid] = entry[1][seq - entry[0]]
+            return points
+
+    def retain(self, source_host_ids):
+        """Forgets the cached points of every task not in source_host_ids."""
+        keep = {str(source_host_id) for source_host_id in source_host_ids}
+        with self._lock:
+            for source_host_id in [key for key in self._tasks if key not in keep]:
+                del self._tasks[source_host_id]
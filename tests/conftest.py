@@ -0,0 +1,46 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The task store is created when common.py is imported, so point it at a throwaway database first
+_DB_DIR = tempfile.mkdtemp(prefix='replayz-tests-')
+os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(_DB_DIR, 'tests.sqlite')}"
+os.environ['REPLAY_IN_WEB'] = 'false'
+os.environ['HISTORY_ROLLING'] = 'false'
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def db():
+    """A task store session; every table is emptied afterwards."""
+    from common import Base, SessionLocal, engine
+    session = SessionLocal()
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
+        with engine.begin() as connection:
+            for table in reversed(Base.metadata.sorted_tables):
+                connection.execute(table.delete())
+
+
+class FakeClock:
+    """Stands in for time.time / time.monotonic so tests control the passing of time."""
+
+    def __init__(self, now=1_000_000.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
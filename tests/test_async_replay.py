@@ -0,0 +1,17 @@
+from async_replay import get_async_senders
+from common import config
+
+
+def test_senders_use_trapper_chunk_size_and_are_reused(monkeypatch):
+    monkeypatch.setitem(config, 'dest_trapper_endpoints', 'trapper-a:10051,trapper-b')
+    monkeypatch.setitem(config, 'dest_trapper_port', 10052)
+    monkeypatch.setitem(config, 'trapper_chunk_size', 1000)
+    senders = get_async_senders()
+    assert [endpoint for endpoint, _ in senders] == [('trapper-a', 10051), ('trapper-b', 10052)]
+    assert all(sender.chunk_size == 1000 for _, sender in senders)
+    assert get_async_senders() is senders
+
+    monkeypatch.setitem(config, 'trapper_chunk_size', 500)
+    rebuilt = get_async_senders()
+    assert rebuilt is not senders
+    assert all(sender.chunk_size == 500 for _, sender in rebuilt)
@@ -0,0 +1,29 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'bench'))
+
+from fake_zabbix import STANDARD_ITEMS, ApiError, FakeZabbixServer
+from problem_simulation import DEFAULT_PROFILE, ScenarioProfile
+
+
+def test_trigger_names_are_unique_per_host():
+    server = FakeZabbixServer('dest')
+    server.objects['host'] = {'1': {'hostid': '1', 'host': 'a'}, '2': {'hostid': '2', 'host': 'b'}}
+    trigger = lambda host: {'description': 'Unavailable by ICMP ping', 'expression': f"max(/{host}/icmpping,3m)=0"}
+
+    server.handle('trigger.create', [trigger('a'), trigger('b')])
+
+    with pytest.raises(ApiError):
+        server.handle('trigger.create', [trigger('a')])
+    with pytest.raises(ApiError): # Duplicate within one batch
+        server.handle('trigger.create', [dict(trigger('b'), description='Down'), dict(trigger('b'), description='Down')])
+    assert len(server.handle('trigger.get', {'hostids': '2'})) == 1
+
+
+def test_standard_items_match_every_default_problem_rule():
+    keys = [key for _, key, _ in STANDARD_ITEMS]
+    for rule in ScenarioProfile(DEFAULT_PROFILE).rules:
+        assert any(rule.matches('10001', key) for key in keys), rule.name
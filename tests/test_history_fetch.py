@@ -0,0 +1,73 @@
+import io
+import json
+
+import pytest
+
+import history_fetch
+from history_fetch import HistoryStream, iter_json_array
+
+
+def parse(body, read_size=3):
+    return list(iter_json_array(io.BytesIO(body.encode('utf-8')), read_size=read_size))
+
+
+def test_multibyte_characters_split_across_reads():
+    records = [{'itemid': '1', 'clock': '10', 'value': 'Zürich — 温度 ✓'}, {'itemid': '2', 'clock': '11', 'value': '€'}]
+    body = json.dumps({'jsonrpc': '2.0', 'result': records, 'id': '1'}, ensure_ascii=False)
+    for read_size in (1, 2, 3, 5):
+        assert parse(body, read_size) == records
+
+
+def test_brackets_and_quotes_inside_strings():
+    records = [{'itemid': '1', 'value': '] , [ "result": ['}, {'itemid': '2', 'value': 'a \\"]\\" b'}]
+    assert parse(json.dumps({'result': records})) == records
+
+
+def test_empty_result():
+    assert parse('{"jsonrpc": "2.0", "result": [], "id": "1"}') == []
+    assert parse('{"jsonrpc":"2.0","result" : [ ] }') == []
+
+
+def test_json_rpc_error_is_raised():
+    body = json.dumps({'jsonrpc': '2.0', 'error': {'code': -32602, 'message': 'Invalid params.'}, 'id': '1'})
+    with pytest.raises(RuntimeError, match='Invalid params'):
+        parse(body)
+
+
+def test_truncated_body_is_an_error():
+    with pytest.raises(ValueError):
+        parse('{"result": [{"itemid": "1"}, {"itemid": "2"}') # Cut after an element
+    with pytest.raises(ValueError):
+        parse('{"result": [{"itemid": "1"}, {"item') # Cut inside an element
+
+
+class FakeUrlopen:
+    """Records the requests sent through urllib and answers apiinfo.version and history.get."""
+
+    def __init__(self, version):
+        self.version = version
+        self.requests = []
+
+    def __call__(self, req, context=None, timeout=None):
+        body = json.loads(req.data)
+        self.requests.append((req, body, context, timeout))
+        result = self.version if body['method'] == 'apiinfo.version' else [{'itemid': '1', 'clock': '10', 'value': '1'}]
+        return io.BytesIO(json.dumps({'jsonrpc': '2.0', 'result': result, 'id': body['id']}).encode('utf-8'))
+
+
+@pytest.mark.parametrize('version, basic, token_in_body', [('6.0.20', False, True), ('7.0.5', False, False), ('7.0.5', True, True)])
+def test_stream_sends_the_configured_url_token_and_auth(monkeypatch, version, basic, token_in_body):
+    urlopen = FakeUrlopen(version)
+    monkeypatch.setattr(history_fetch.urllib.request, 'urlopen', urlopen)
+    credentials = {'http_user': 'web', 'http_password': 'secret'} if basic else {}
+    stream = HistoryStream('zabbix.example.com/', 'tok', validate_certs=False, timeout=7, **credentials)
+
+    assert list(stream.request('history.get', {'itemids': ['1']})) == [{'itemid': '1', 'clock': '10', 'value': '1'}]
+    assert list(stream.request('history.get', {'itemids': ['1']}))
+    assert [body['method'] for _, body, _, _ in urlopen.requests] == ['apiinfo.version', 'history.get', 'history.get'] # Version looked up once
+    req, body, context, timeout = urlopen.requests[-1]
+    assert req.full_url == 'http://zabbix.example.com/api_jsonrpc.php'
+    assert (body.get('auth') == 'tok') == token_in_body
+    expected = 'Basic d2ViOnNlY3JldA==' if basic else (None if token_in_body else 'Bearer tok')
+    assert req.get_header('Authorization') == expected
+    assert context.verify_mode == history_fetch.ssl.CERT_NONE and timeout == 7
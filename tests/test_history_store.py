@@ -0,0 +1,56 @@
+from common import ReplicationTask
+from history_store import (HistoryWriter, clear_history, get_first_clock, get_item_seq_bounds, get_item_watermarks,
+                           load_point_ranges, migrate_legacy_history, prune_history)
+
+
+def write(db, points, source_host_id='100'):
+    writer = HistoryWriter(db, source_host_id, batch_size=2)
+    for itemid, clock, value in points:
+        writer.append(itemid, clock, value)
+    writer.flush()
+    db.commit()
+    return writer
+
+
+def test_writer_numbers_points_per_item(db):
+    writer = write(db, [('1', 10, '1.5'), ('2', 10, '7'), ('1', 20, '2.5')])
+    assert writer.total_points == 3
+    assert writer.first_clock == 10
+    assert get_item_seq_bounds(db, '100') == {'1': (0, 2), '2': (0, 1)}
+    assert get_first_clock(db, '100') == 10
+
+
+def test_load_point_ranges_reads_each_items_range(db):
+    write(db, [('1', 10, '1.5'), ('2', 10, '7'), ('1', 20, '2.5')])
+    series = load_point_ranges(db, '100', {'1': (1, 5), '2': (0, 1)})
+    assert list(series['1']) == [(20, '2.5')]
+    assert list(series['2']) == [(10, '7')]
+
+
+def test_clear_history_only_drops_one_host(db):
+    write(db, [('1', 10, '1')])
+    write(db, [('1', 10, '1')], source_host_id='200')
+    assert clear_history(db, '100') == 1
+    assert get_item_seq_bounds(db, '100') == {}
+    assert get_item_seq_bounds(db, '200') == {'1': (0, 1)}
+
+
+def test_legacy_history_blob_is_migrated(db):
+    task = ReplicationTask(source_host_id='100', history={'1': [{'clock': 10, 'value': '1'}, {'clock': 20, 'value': '2'}]})
+    db.add(task)
+    assert migrate_legacy_history(db, task)
+    assert task.history is None
+    assert list(load_point_ranges(db, '100', {'1': (0, 2)})['1']) == [(10, '1'), (20, '2')]
+    assert not migrate_legacy_history(db, task)
+
+
+def test_watermarks_and_prune_keep_seq_numbers(db):
+    write(db, [('1', clock, str(clock)) for clock in (10, 20, 30)])
+    assert get_item_watermarks(db, '100') == {'1': (2, 30)}
+    assert prune_history(db, '100', 25) == 2
+    writer = HistoryWriter(db, '100', next_seq={'1': 3})
+    writer.append('1', 40, '40')
+    writer.flush()
+    # seq numbers are never reused, so the n-th stored point is first_seq + n
+    assert get_item_seq_bounds(db, '100') == {'1': (2, 2)}
+    assert list(load_point_ranges(db, '100', {'1': (2, 10)})['1']) == [(30, '30'), (40, '40')]
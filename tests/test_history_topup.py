@@ -0,0 +1,76 @@
+from types import SimpleNamespace
+
+import history_fetch
+from common import HistoryPoint, ReplicationTask, SessionLocal, config
+from history_fetch import fetch_history, top_up_history
+from history_store import HistoryWriter
+
+ITEMS = [{'itemid': '1', 'value_type': '0', 'key_': 'load'}, {'itemid': '2', 'value_type': '4', 'key_': 'log'}]
+
+
+def source_api(records):
+    """history.get over {history_type: [(itemid, clock, value)]}, honouring the time window."""
+    def get(**params):
+        return [{'itemid': itemid, 'clock': str(clock), 'value': value}
+                for itemid, clock, value in records[params['history']]
+                if itemid in params['itemids'] and params['time_from'] <= clock <= params['time_till']]
+    return SimpleNamespace(history=SimpleNamespace(get=get))
+
+
+def stored(db):
+    return sorted((p.itemid, p.seq, p.clock, p.value) for p in db.query(HistoryPoint).all())
+
+
+def test_top_up_dedupes_same_second_points_and_leaves_late_data_for_later(db, clock, monkeypatch):
+    monkeypatch.setattr(history_fetch.time, 'time', clock)
+    monkeypatch.setitem(config, 'history_topup_lag_seconds', 60)
+    monkeypatch.setitem(config, 'history_topup_overlap_seconds', 300)
+    clock.now = 10_000
+    writer = HistoryWriter(db, '100')
+    writer.append('1', 9000, '1', 0)
+    writer.flush()
+    records = {
+        0: [('1', 8950, '0.5'), ('1', 9000, '1'), ('1', 9000, '2')],
+        4: [('2', 8800, 'late'), ('2', 9950, 'recent')],
+    }
+
+    new_records, fetched_until = top_up_history(ITEMS, source_api(records), db, '100', fetched_until=9000)
+
+    assert (new_records, fetched_until) == (2, 9940)
+    assert stored(db) == [('1', 0, 9000, '1'), ('1', 1, 9000, '2'), ('2', 0, 8800, 'late')]
+
+    clock.advance(100)
+    new_records, fetched_until = top_up_history(ITEMS, source_api(records), db, '100', fetched_until=fetched_until)
+
+    assert (new_records, fetched_until) == (1, 10040)
+    assert stored(db)[-1] == ('2', 1, 9950, 'recent')
+    assert len(stored(db)) == 4 # The re-read second of item 1 added nothing
+
+
+def test_full_fetch_is_staged_without_holding_the_write_lock(db, clock, monkeypatch):
+    monkeypatch.setattr(history_fetch.time, 'time', clock)
+    monkeypatch.setitem(config, 'history_fetch_window_hours', 1)
+    clock.now = 20_000
+    writer = HistoryWriter(db, '100')
+    writer.append('1', 100, 'old', 0)
+    writer.flush()
+    db.commit()
+    seen = []
+
+    def get(**params):
+        other = SessionLocal()
+        try:
+            # The stored history stays readable and other writers get the lock mid-fetch
+            seen.append([p.value for p in other.query(HistoryPoint).filter(HistoryPoint.source_host_id == '100')])
+            other.add(ReplicationTask(source_host_id=f"other-{params['time_from']}", status='starting'))
+            other.commit()
+        finally:
+            other.close()
+        return [{'itemid': '1', 'clock': str(params['time_from']), 'value': str(params['time_from'])}]
+
+    total, first_clock = fetch_history(ITEMS[:1], SimpleNamespace(history=SimpleNamespace(get=get)), db, '100', time_from=10_000)
+
+    assert (total, first_clock) == (3, 10_000)
+    assert seen == [['old']] * 3
+    assert stored(db) == [('1', 0, 10_000, '10000'), ('1', 1, 13_600, '13600'), ('1', 2, 17_200, '17200')]
+    assert db.query(ReplicationTask).count() == 3
@@ -0,0 +1,82 @@
+import pytest
+from sqlalchemy.exc import OperationalError
+
+import leader
+from common import ReplicationTask
+from jobs import fence_scheduler_lease
+from leader import SCHEDULER_LEASE, LeaderElector, fence_lease
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(leader.time, 'time', clock)
+
+
+class LockedSession:
+    """A session on a database that stays locked."""
+
+    def execute(self, *args, **kwargs):
+        raise OperationalError('UPDATE leases', {}, Exception('database is locked'))
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_only_one_process_holds_the_lease(db, clock):
+    a = LeaderElector('test', lease_seconds=30)
+    b = LeaderElector('test', lease_seconds=30)
+    assert a.try_acquire() is True
+    assert b.try_acquire() is False
+    clock.advance(20)
+    assert a.try_acquire() is True # Renewed
+    clock.advance(20)
+    assert b.try_acquire() is False
+    clock.advance(11) # a stopped renewing and its lease expired
+    assert b.try_acquire() is True
+    assert a.try_acquire() is False
+
+
+def test_busy_database_does_not_end_a_valid_leadership(db, clock, monkeypatch):
+    events = []
+    elector = LeaderElector('test', lease_seconds=30, on_elected=lambda: events.append('elected'), on_lost=lambda: events.append('lost'))
+    elector.check()
+    assert elector.is_leader and events == ['elected']
+
+    monkeypatch.setattr(leader, 'SessionLocal', LockedSession)
+    clock.advance(15)
+    assert elector.check() == leader.RETRY_SECONDS
+    assert elector.is_leader and events == ['elected']
+
+    clock.advance(14.5)
+    assert elector.check() == pytest.approx(0.5) # Next check is due when the lease expires
+    clock.advance(0.5)
+    elector.check()
+    assert not elector.is_leader and events == ['elected', 'lost']
+
+
+def test_leader_checks_again_before_its_lease_expires(db, clock):
+    elector = LeaderElector('test', lease_seconds=30)
+    assert elector.check() == 10
+    assert elector.lease_expires_at == clock.now + 30
+
+
+def test_tick_of_a_deposed_leader_does_not_commit(db, clock):
+    old, new = LeaderElector(SCHEDULER_LEASE, lease_seconds=30), LeaderElector(SCHEDULER_LEASE, lease_seconds=30)
+    old.try_acquire()
+    db.add(ReplicationTask(source_host_id='100', status='replaying', cycle_offset=0))
+    db.commit()
+
+    task = db.query(ReplicationTask).one()
+    task.cycle_offset = 5
+    assert fence_scheduler_lease(db, old.holder) # Still the leader
+    db.commit()
+
+    clock.advance(31) # The tick outlived the lease and another process took over
+    assert new.try_acquire() is True
+    task.cycle_offset = 10
+    assert not fence_scheduler_lease(db, old.holder)
+    assert db.query(ReplicationTask).one().cycle_offset == 5
+    assert fence_lease(db, SCHEDULER_LEASE, new.holder)
@@ -0,0 +1,124 @@
+from types import SimpleNamespace
+
+from problem_simulation import ScenarioProfile
+
+ITEM_MAPPING = {'1': 'cpu.util', '2': 'agent.ping'}
+
+
+class FakeRng:
+    """Starts a problem whenever random() is below the rule's probability; draws the low end of every range."""
+
+    def __init__(self, roll=0.0):
+        self.roll = roll
+
+    def random(self):
+        return self.roll
+
+    def uniform(self, low, high):
+        return low
+
+    def randint(self, low, high):
+        return low
+
+
+def make_task(problem_state=None):
+    return SimpleNamespace(source_host_id='100', item_mapping=ITEM_MAPPING, problem_items=None, problem_profile=None,
+                           problem_state=problem_state, problem_packets=None)
+
+
+def profile(model='step', duration=3, **rule):
+    return ScenarioProfile({'name': 'test', 'rules': [dict({'name': 'cpu', 'match': 'cpu.util', 'model': model,
+                                                             'value': [90, 99], 'probability': 0.5, 'duration': duration}, **rule)]})
+
+
+def test_problem_state_carries_over_between_packets_and_workers():
+    scenario = profile()
+    task = make_task()
+    assert scenario.simulate(task, ['1', '2'], ['10', '1'], 0, FakeRng(0.0)) == [90, '1']
+    assert task.problem_state == {'1': [2, 1, 90]}
+
+    # Another worker picks the task up with its stored state; its RNG would never start a problem
+    resumed = make_task(dict(task.problem_state))
+    assert scenario.simulate(resumed, ['1'], ['11'], 0, FakeRng(0.99)) == [90]
+    assert scenario.simulate(resumed, ['1'], ['12'], 0, FakeRng(0.99)) == [90]
+    assert resumed.problem_state == {'1': [0, 3, 90]}
+    assert scenario.simulate(resumed, ['1'], ['13'], 0, FakeRng(0.99)) == ['13']
+    assert resumed.problem_state == {}
+
+
+def test_legacy_remaining_count_state_is_migrated():
+    task = make_task({'1': 2}) # Earlier versions stored only the remaining points
+    assert profile().simulate(task, ['1'], ['10'], 0, FakeRng(0.99)) == [90]
+    assert task.problem_state == {'1': [1, 1, 90]}
+
+
+def test_problem_is_followed_by_a_recorded_point():
+    scenario = profile(duration=2)
+    task = make_task()
+    rng = FakeRng(0.0) # Every point would start a new problem
+    sent = [scenario.simulate(task, ['1'], [str(i)], 0, rng)[0] for i in range(6)]
+    assert sent == [90, 90, '2', 90, 90, '5']
+
+
+class CountingRng(FakeRng):
+    """Like FakeRng, but every drawn value is one higher than the last, so held levels are visible."""
+
+    def __init__(self, roll=0.0):
+        super().__init__(roll)
+        self.draws = 0
+
+    def uniform(self, low, high):
+        self.draws += 1
+        return low + self.draws
+
+
+def run_packets(scenario, task, values, rng):
+    return [scenario.simulate(task, ['1'], [value], 0, rng)[0] for value in values]
+
+
+def test_step_holds_one_level_while_spike_draws_every_point():
+    assert run_packets(profile('step', duration=3), make_task(), ['10'] * 3, CountingRng()) == [91, 91, 91]
+    assert run_packets(profile('spike', duration=3), make_task(), ['10'] * 3, CountingRng()) == [92, 93, 94] # 91 is the unused level
+
+
+def test_ramp_moves_from_the_recorded_value_to_the_level():
+    assert run_packets(profile('ramp', duration=4), make_task(), ['10'] * 5, FakeRng()) == [30, 50, 70, 90, '10']
+    assert run_packets(profile('ramp', duration=2), make_task(), ['up'] * 2, FakeRng()) == [90, 90] # Text falls back to the level
+
+
+def test_flap_alternates_between_level_and_recorded_value():
+    assert run_packets(profile('flap', duration=4), make_task(), ['1', '2', '3', '4'], FakeRng()) == [90, '2', 90, '4']
+
+
+def test_outage_is_active_only_inside_its_window():
+    scenario = profile('outage', every_seconds=100, duration_seconds=10, offset_seconds=20, value=0)
+    task = make_task()
+    assert [scenario.simulate(task, ['1'], ['5'], now, FakeRng())[0] for now in (19, 20, 29, 30, 125)] == ['5', 0, 0, '5', 0]
+    assert task.problem_state is None # Outages keep no per-item state
+
+
+def test_seeded_profile_replays_the_same_faults():
+    spec = {'name': 'seeded', 'rules': [{'name': 'cpu', 'match': 'cpu.util', 'model': 'spike', 'value': [90, 99], 'probability': 0.3}]}
+
+    def run():
+        scenario, task = ScenarioProfile(spec, seed=7), make_task()
+        return [scenario.simulate(task, ['1', '2'], [str(i), '1'], 0) for i in range(50)], task.problem_packets
+
+    first, packets = run()
+    assert run() == (first, packets) == (first, 50)
+    assert any(values[0] != str(i) for i, values in enumerate(first)) # Some problems were simulated
+
+
+def test_hosts_report_the_same_outage_window():
+    spec = {'name': 'outage', 'rules': [{'name': 'down', 'match': 'cpu.util', 'model': 'outage', 'value': [0, 50],
+                                         'every_seconds': 600, 'duration_seconds': 60}]}
+    first, second = ScenarioProfile(spec, seed=3), ScenarioProfile(spec, seed=3) # E.g. two replay workers
+    rule = first.rules[0]
+    assert second.rules[0].offset_seconds == rule.offset_seconds
+    now = rule.offset_seconds + 6000 + 30
+
+    hosts = [make_task(), make_task()]
+    hosts[1].source_host_id = '200'
+    values = [scenario.simulate(task, ['1'], ['77'], now)[0] for scenario, task in zip((first, second), hosts)]
+    assert values[0] == values[1] != '77'
+    assert first.simulate(hosts[0], ['1'], ['77'], now + 60)[0] == '77' # Window is over
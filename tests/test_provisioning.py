@@ -0,0 +1,88 @@
+import math
+
+from provisioning import HostProvisioningPlan, TriggerSpec, bulk_create
+
+
+class FakeMethod:
+    def __init__(self, result=None):
+        self.result = result
+        self.calls = []
+
+    def __call__(self, *args, **kwargs):
+        self.calls.append(args[0] if args else kwargs)
+        if callable(self.result):
+            return self.result(*args, **kwargs)
+        return self.result
+
+
+class FakeObject:
+    def __init__(self, **methods):
+        for name, method in methods.items():
+            setattr(self, name, method)
+
+
+class FakeApi:
+    def __init__(self, triggers, macros=()):
+        ids = lambda field: (lambda objects: {field: [str(i) for i, _ in enumerate(objects)]})
+        self.trigger = FakeObject(get=FakeMethod(list(triggers)), create=FakeMethod(ids('triggerids')), update=FakeMethod(ids('triggerids')))
+        self.usermacro = FakeObject(get=FakeMethod(list(macros)), create=FakeMethod(ids('hostmacroids')), update=FakeMethod(ids('hostmacroids')))
+        self.item = FakeObject(get=FakeMethod([{'key_': 'icmppingloss'}]))
+
+
+def spec(description, expression, priority='2', tags=None):
+    params = {'description': description, 'expression': expression, 'priority': priority}
+    if tags is not None:
+        params['tags'] = tags
+    return TriggerSpec(params, ['icmppingloss'], {'{$ICMP_LOSS_WARN}': '20'})
+
+
+def test_outdated_triggers_are_updated_in_one_batch():
+    api = FakeApi([
+        {'triggerid': '7', 'description': 'Same', 'expression': 'last(/h/icmppingloss)>1', 'priority': '2', 'tags': []},
+        {'triggerid': '8', 'description': 'Expression', 'expression': 'last(/h/icmppingloss)>1', 'priority': '2', 'tags': []},
+        {'triggerid': '9', 'description': 'Priority and tags', 'expression': 'last(/h/icmppingloss)>1', 'priority': '2',
+         'tags': [{'tag': 'scope', 'value': 'old'}]},
+    ])
+    plan = HostProvisioningPlan(api, '10', batch_size=10)
+    plan.add_triggers([
+        spec('Same', 'last(/h/icmppingloss)>1'),
+        spec('Expression', 'last(/h/icmppingloss)>{$ICMP_LOSS_WARN}'),
+        spec('Priority and tags', 'last(/h/icmppingloss)>1', priority=4, tags=[{'tag': 'scope', 'value': 'new'}]),
+        spec('New', 'last(/h/icmppingloss)>2'),
+    ])
+
+    summary = plan.apply()
+
+    assert summary == {'macros_created': 1, 'macros_updated': 0, 'triggers_created': 1, 'triggers_updated': 2, 'failed': 0}
+    assert api.trigger.update.calls == [[
+        {'triggerid': '8', 'expression': 'last(/h/icmppingloss)>{$ICMP_LOSS_WARN}'},
+        {'triggerid': '9', 'priority': 4, 'tags': [{'tag': 'scope', 'value': 'new'}]},
+    ]]
+    assert [t['description'] for t in api.trigger.create.calls[0]] == ['New']
+    assert api.trigger.get.calls[0]['expandExpression'] is True
+
+
+def test_unchanged_triggers_cause_no_update_calls():
+    api = FakeApi([{'triggerid': '7', 'description': 'Same', 'expression': 'last(/h/icmppingloss)>1', 'priority': '2',
+                    'tags': [{'tag': 'b', 'value': '2'}, {'tag': 'a', 'value': '1'}]}])
+    plan = HostProvisioningPlan(api, '10')
+    plan.add_trigger(spec('Same', 'last(/h/icmppingloss)>1', tags=[{'tag': 'a', 'value': '1'}, {'tag': 'b', 'value': '2'}]))
+
+    assert plan.apply()['triggers_updated'] == 0
+    assert api.trigger.update.calls == []
+    assert api.trigger.create.calls == []
+
+
+def test_bulk_create_isolates_one_bad_object_in_log_calls():
+    def create(batch):
+        if any(obj['name'] == 'bad' for obj in batch):
+            raise RuntimeError('Invalid parameter "/37/key_"')
+        return {'itemids': [f"id-{obj['name']}" for obj in batch]}
+    method = FakeMethod(create)
+    objects = [{'name': 'bad' if i == 37 else str(i)} for i in range(200)]
+
+    results = bulk_create(method, objects, 'itemids', batch_size=200)
+
+    assert isinstance(results[37], RuntimeError)
+    assert [result for i, result in enumerate(results) if i != 37] == [f"id-{i}" for i in range(200) if i != 37]
+    assert len(method.calls) <= 2 * math.ceil(math.log2(200)) + 1 # Not one call per object
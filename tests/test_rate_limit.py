@@ -0,0 +1,99 @@
+import pytest
+
+import rate_limit
+from rate_limit import ReplayRateController, TokenBucket
+
+SETTINGS = {
+    'replay_interval_seconds': 1.0,
+    'replay_max_points_per_tick': 10000,
+    'replay_rate_limit': 0,
+    'replay_rate_ramp_start': 0,
+    'replay_rate_ramp_seconds': 0,
+    'replay_rate_limit_per_endpoint': 0,
+    'replay_rate_limit_per_task': 0,
+    'replay_backoff_failed_ratio': 0.01,
+    'replay_backoff_latency_seconds': 5,
+    'replay_backoff_decrease': 0.5,
+    'replay_backoff_increase': 500,
+    'replay_backoff_min_points': 100,
+}
+
+
+@pytest.fixture(autouse=True)
+def fake_monotonic(monkeypatch, clock):
+    monkeypatch.setattr(rate_limit.time, 'monotonic', clock)
+
+
+def test_token_bucket_refills_up_to_burst(clock):
+    bucket = TokenBucket(100, burst_seconds=2.0)
+    assert bucket.available() == 200
+    bucket.consume(250) # A burst may overdraw the bucket
+    assert bucket.available() == 0
+    clock.advance(1.0)
+    assert bucket.available() == 50
+    clock.advance(60)
+    assert bucket.available() == 200
+
+
+def test_token_bucket_ramps_to_target_rate(clock):
+    bucket = TokenBucket(1000, start_rate=100, ramp_seconds=10)
+    assert bucket.current_rate() == 100
+    clock.advance(5)
+    assert bucket.current_rate() == pytest.approx(550)
+    clock.advance(50)
+    assert bucket.current_rate() == 1000
+
+
+def test_backoff_cuts_budget_and_recovers_additively():
+    controller = ReplayRateController(dict(SETTINGS))
+    assert controller.tick_budget() == 10000
+    controller.record_tick(4000, failed=400) # 10% failed
+    assert controller.tick_budget() == 2000
+    controller.record_tick(2000, failed=0, latency=10) # Slow responses are congestion too
+    assert controller.tick_budget() == 1000
+    controller.record_tick(1000)
+    assert controller.tick_budget() == 1500
+    for _ in range(20):
+        controller.record_tick(1500)
+    assert controller.backoff_cap is None
+    assert controller.tick_budget() == 10000
+
+
+def test_backoff_never_drops_below_minimum():
+    controller = ReplayRateController(dict(SETTINGS))
+    controller.record_tick(50, errors=1)
+    assert controller.tick_budget() == 100
+
+
+def test_task_quota_is_charged_per_task(clock):
+    controller = ReplayRateController(dict(SETTINGS, replay_rate_limit_per_task=10))
+    assert controller.task_budget('1') == 10
+    controller.record_task('1', 10)
+    assert controller.task_budget('1') == 0
+    assert controller.task_budget('2') == 10
+    assert controller.task_budget('3', task_rate=50) == 50 # A task's own limit wins
+    clock.advance(0.5)
+    assert controller.task_budget('1') == 5
+
+
+def test_global_and_endpoint_limits_bound_the_tick():
+    controller = ReplayRateController(dict(SETTINGS, replay_rate_limit=300, replay_rate_limit_per_endpoint=100))
+    endpoints = [('a', 10051), ('b', 10051)]
+    assert controller.tick_budget(endpoints) == 200
+    controller.record_tick(150, endpoint_points={('a', 10051): 100, ('b', 10051): 50})
+    assert controller.tick_budget(endpoints) == 50
+
+
+def test_global_and_endpoint_limits_are_split_between_workers(clock):
+    controller = ReplayRateController(dict(SETTINGS, replay_rate_limit=900, replay_rate_limit_per_endpoint=600))
+    endpoint = ('trapper', 10051)
+    assert controller.tick_budget([endpoint]) == 600
+
+    controller.set_engine_count(3)
+    assert controller.tick_budget([endpoint]) == 200 # Buckets are capped at the new share
+    assert controller.task_budget('100', 50) == 50 # Per-task limits are not split
+
+    controller.record_tick(200, endpoint_points={endpoint: 200})
+    clock.advance(1.0)
+    assert controller.global_bucket.current_rate() == 300
+    assert controller.tick_budget([endpoint]) == 200
@@ -0,0 +1,106 @@
+import time
+from types import SimpleNamespace
+
+import pytest
+
+import jobs
+from common import ReplicationTask, config
+from history_store import HistoryWriter
+from jobs import replay_tick
+from series import SeriesReadAhead
+
+HOSTS = ['100', '200', '300']
+
+
+class FakeSenderPool:
+    """Records every packet and answers each as one fully processed chunk."""
+
+    def __init__(self):
+        self.sent = []
+
+    def send_chunks(self, items):
+        self.sent.append([(item.host, item.key, item.value) for item in items])
+        return [(items, SimpleNamespace(processed=len(items), failed=0), ('trapper', 10051), 0.01)]
+
+    def tick_hosts(self, tick):
+        return [host for host, _, _ in self.sent[tick]]
+
+
+@pytest.fixture
+def pool(monkeypatch):
+    pool = FakeSenderPool()
+    monkeypatch.setattr(jobs, 'get_sender_pool', lambda: pool)
+    monkeypatch.setattr(jobs, '_read_ahead', SeriesReadAhead())
+    monkeypatch.setattr(jobs, '_tick_counter', -1) # The first tick serves the tasks in ID order
+    monkeypatch.setitem(config, 'dest_trapper_host', 'trapper')
+    monkeypatch.setitem(config, 'dest_trapper_port', 10051)
+    monkeypatch.setitem(config, 'dest_trapper_endpoints', '')
+    monkeypatch.setitem(config, 'replay_mode', 'tick')
+    monkeypatch.setitem(config, 'replay_max_points_per_task', 5000)
+    return pool
+
+
+def add_task(db, source_host_id, items=4, points=5):
+    writer = HistoryWriter(db, source_host_id)
+    for item in range(items):
+        for point in range(points):
+            writer.append(str(item + 1), 1000 + point, f"{item + 1}.{point}", 4)
+    writer.flush()
+    db.add(ReplicationTask(source_host_id=source_host_id, status='replaying', dest_host_name=f"dest-{source_host_id}",
+                           start_time=time.time(), cycle_offset=0, cycle_item_offset=0,
+                           item_mapping={str(item + 1): f"key{item + 1}" for item in range(items)}))
+    db.commit()
+
+
+def cursors(db):
+    db.expire_all()
+    return {task.source_host_id: (task.cycle_offset, task.cycle_item_offset) for task in db.query(ReplicationTask).all()}
+
+
+def test_tick_budget_is_shared_between_tasks(db, pool, monkeypatch):
+    monkeypatch.setitem(config, 'replay_max_points_per_tick', 6)
+    for host in HOSTS:
+        add_task(db, host)
+
+    replay_tick()
+
+    assert sorted(pool.tick_hosts(0)) == ['dest-100'] * 2 + ['dest-200'] * 2 + ['dest-300'] * 2
+    assert cursors(db) == {host: (0, 2) for host in HOSTS}
+
+
+def test_per_task_cap_applies_below_the_tick_budget(db, pool, monkeypatch):
+    monkeypatch.setitem(config, 'replay_max_points_per_tick', 1000)
+    monkeypatch.setitem(config, 'replay_max_points_per_task', 3)
+    for host in HOSTS:
+        add_task(db, host)
+
+    replay_tick()
+
+    assert len(pool.sent[0]) == 9
+    assert cursors(db) == {host: (0, 3) for host in HOSTS}
+
+
+def test_task_served_first_rotates_when_the_budget_runs_out(db, pool, monkeypatch):
+    monkeypatch.setitem(config, 'replay_max_points_per_tick', 4) # Two points for each of the first two tasks only
+    for host in HOSTS:
+        add_task(db, host)
+
+    for _ in range(3):
+        replay_tick()
+
+    starved = [set(HOSTS) - {host.split('-')[1] for host in pool.tick_hosts(tick)} for tick in range(3)]
+    assert starved == [{'300'}, {'100'}, {'200'}]
+    assert cursors(db) == {host: (1, 0) for host in HOSTS} # Every task got four points
+
+
+def test_cursor_wraps_around_after_the_last_round(db, pool, monkeypatch):
+    monkeypatch.setitem(config, 'replay_max_points_per_tick', 3)
+    add_task(db, '100', items=2, points=2)
+
+    sent = []
+    for _ in range(3):
+        replay_tick()
+        sent.append([value for _, _, value in pool.sent[-1]])
+
+    assert sent == [['1.0', '2.0'], ['1.1', '2.1'], ['1.0', '2.0']]
+    assert cursors(db) == {'100': (1, 0)}
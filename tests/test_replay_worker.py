@@ -0,0 +1,78 @@
+import jobs
+import replay_worker
+from common import ReplicationTask
+from jobs import fence_replay_leases, load_active_tasks
+from replay_worker import HashRing, ReplayWorkerProcess
+
+
+def add_tasks(db, count, status='replaying'):
+    for i in range(count):
+        db.add(ReplicationTask(source_host_id=str(10000 + i), status=status, cycle_offset=0))
+    db.commit()
+
+
+def test_hash_ring_only_moves_the_removed_workers_keys():
+    keys = [str(10000 + i) for i in range(500)]
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b'])
+    assert HashRing(['c', 'a', 'b']).owner('10001') == before.owner('10001')
+    for key in keys:
+        if before.owner(key) != 'c':
+            assert after.owner(key) == before.owner(key)
+    assert {before.owner(key) for key in keys} == {'a', 'b', 'c'}
+    assert HashRing([]).owner('10001') is None
+
+
+def test_second_worker_cannot_claim_until_the_lease_expires(db, clock, monkeypatch):
+    monkeypatch.setattr(replay_worker.time, 'time', clock)
+    add_tasks(db, 3)
+    shard = ['10000', '10001', '10002']
+    first, second = ReplayWorkerProcess(), ReplayWorkerProcess()
+
+    assert first.claim_tasks(db, shard) == shard
+    assert second.claim_tasks(db, shard) == []
+
+    clock.advance(replay_worker.task_lease_seconds() + 1)
+    assert second.claim_tasks(db, shard) == shard
+    assert first.claim_tasks(db, shard) == []
+
+
+def test_claim_releases_tasks_that_left_the_shard(db, clock, monkeypatch):
+    monkeypatch.setattr(replay_worker.time, 'time', clock)
+    add_tasks(db, 2)
+    first, second = ReplayWorkerProcess(), ReplayWorkerProcess()
+    first.claim_tasks(db, ['10000', '10001'])
+
+    assert first.claim_tasks(db, ['10000']) == ['10000']
+    assert second.claim_tasks(db, ['10001']) == ['10001']
+
+
+def test_fencing_discards_progress_of_a_lost_task(db, clock, monkeypatch):
+    monkeypatch.setattr(replay_worker.time, 'time', clock)
+    monkeypatch.setattr(jobs.time, 'time', clock)
+    add_tasks(db, 2)
+    first, second = ReplayWorkerProcess(), ReplayWorkerProcess()
+    first.claim_tasks(db, ['10000', '10001'])
+    clock.advance(replay_worker.task_lease_seconds() + 1)
+    second.claim_tasks(db, ['10001']) # Takes over the expired lease
+
+    tasks = load_active_tasks(db, ['10000', '10001'])
+    for task in tasks:
+        task.cycle_offset = 5
+    fence_replay_leases(db, tasks, first.worker_id, 60)
+    db.commit()
+
+    offsets = {task.source_host_id: task.cycle_offset for task in db.query(ReplicationTask).all()}
+    assert offsets == {'10000': 5, '10001': 0}
+    kept = db.query(ReplicationTask).filter(ReplicationTask.source_host_id == '10000').one()
+    assert kept.replay_lease_expires_at == clock.now + 60
+
+
+def test_active_tasks_are_loaded_in_chunks(db, monkeypatch):
+    monkeypatch.setattr(jobs, 'IN_CLAUSE_CHUNK_SIZE', 3)
+    add_tasks(db, 8)
+    ids = [str(10000 + i) for i in range(8)]
+
+    tasks = load_active_tasks(db, ids)
+    assert sorted(task.source_host_id for task in tasks) == ids # Order rotates between ticks
+    assert jobs.chunked(ids) == [ids[0:3], ids[3:6], ids[6:8]]
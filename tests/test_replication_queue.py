@@ -0,0 +1,58 @@
+import replication_queue
+from common import ReplicationTask
+from replication_queue import MAX_SETUP_ATTEMPTS, QUEUED_STATUS, ReplicationQueue
+
+
+def queue_task(db, source_host_id, start_time, batch_id='batch'):
+    db.add(ReplicationTask(source_host_id=source_host_id, status=QUEUED_STATUS, start_time=start_time, batch_id=batch_id, setup_attempts=0))
+    db.commit()
+
+
+def task(db, source_host_id):
+    db.expire_all()
+    return db.query(ReplicationTask).filter(ReplicationTask.source_host_id == source_host_id).one()
+
+
+def test_abandoned_setup_is_queued_again_by_another_process(db, clock, monkeypatch):
+    monkeypatch.setattr(replication_queue.time, 'time', clock)
+    queue_task(db, '100', clock.now)
+    dead, alive = ReplicationQueue(None, lease_seconds=60), ReplicationQueue(None, lease_seconds=60)
+
+    assert dead.claim_next() == '100'
+    assert (task(db, '100').setup_owner, task(db, '100').setup_attempts) == (dead.owner_id, 1)
+    clock.advance(30)
+    assert alive.recover_abandoned() == (0, 0) # Lease still valid
+
+    clock.advance(31)
+    assert alive.recover_abandoned() == (1, 0)
+    assert (task(db, '100').status, task(db, '100').setup_owner) == (QUEUED_STATUS, None)
+    assert alive.claim_next() == '100'
+    assert task(db, '100').setup_attempts == 2
+
+
+def test_renewed_lease_is_not_recovered(db, clock, monkeypatch):
+    monkeypatch.setattr(replication_queue.time, 'time', clock)
+    queue_task(db, '100', clock.now)
+    owner, other = ReplicationQueue(None, lease_seconds=60), ReplicationQueue(None, lease_seconds=60)
+    owner.claim_next()
+
+    for _ in range(3):
+        clock.advance(40)
+        assert owner.renew_leases() == 1
+        assert other.renew_leases() == 0
+        assert other.recover_abandoned() == (0, 0)
+    assert task(db, '100').status == 'starting'
+
+
+def test_unqueued_or_exhausted_setups_are_marked_failed(db, clock, monkeypatch):
+    monkeypatch.setattr(replication_queue.time, 'time', clock)
+    db.add(ReplicationTask(source_host_id='100', status='fetching_history', start_time=clock.now, setup_lease_expires_at=clock.now + 10))
+    db.add(ReplicationTask(source_host_id='200', status='fetching_history', start_time=clock.now, setup_lease_expires_at=clock.now + 10,
+                           batch_id='batch', setup_attempts=MAX_SETUP_ATTEMPTS))
+    db.add(ReplicationTask(source_host_id='300', status='creating_dest_host', start_time=clock.now - 7200, batch_id='batch')) # No lease
+    db.add(ReplicationTask(source_host_id='400', status='replaying', start_time=clock.now, setup_lease_expires_at=clock.now))
+    db.commit()
+    clock.advance(11)
+
+    assert ReplicationQueue(None).recover_abandoned() == (1, 2)
+    assert [task(db, host).status for host in ('100', '200', '300', '400')] == ['failed', 'failed', QUEUED_STATUS, 'replaying']
@@ -0,0 +1,62 @@
+from types import SimpleNamespace
+
+from zabbix_utils import ItemValue
+
+from sender_pool import ITEM_JSON_OVERHEAD_BYTES, SenderPool, chunk_items
+
+A, B = ('trapper-a', 10051), ('trapper-b', 10051)
+
+
+class FakeSender:
+    """Stands in for a zabbix_utils Sender; fails every send if given an error."""
+
+    def __init__(self, error=None):
+        self.error = error
+        self.chunks = []
+
+    def send(self, chunk):
+        if self.error is not None:
+            raise self.error
+        self.chunks.append(chunk)
+        return SimpleNamespace(processed=len(chunk), failed=0)
+
+
+def items(count, value='1'):
+    return [ItemValue('host', f"key{i}", value) for i in range(count)]
+
+
+def pool_with(senders):
+    pool = SenderPool(list(senders), chunk_size=2)
+    pool._senders = senders
+    return pool
+
+
+def test_chunks_are_bounded_by_count_and_size():
+    assert [len(chunk) for chunk in chunk_items(items(5), chunk_size=2, max_packet_bytes=10**6)] == [2, 2, 1]
+
+    item_bytes = len('host') + len('key0') + 10 + ITEM_JSON_OVERHEAD_BYTES
+    chunks = chunk_items(items(5, 'x' * 10), chunk_size=100, max_packet_bytes=item_bytes * 2)
+    assert [len(chunk) for chunk in chunks] == [2, 2, 1]
+    assert [len(chunk) for chunk in chunk_items(items(2, 'x' * 500), chunk_size=100, max_packet_bytes=100)] == [1, 1] # Oversized values go alone
+
+
+def test_chunks_are_spread_round_robin():
+    senders = {A: FakeSender(), B: FakeSender()}
+    results = pool_with(senders).send_chunks(items(8))
+    assert [result.endpoint for result in results] == [A, B, A, B]
+    assert sum(len(chunk) for chunk in senders[A].chunks) == sum(len(chunk) for chunk in senders[B].chunks) == 4
+
+
+def test_unreachable_endpoint_fails_over_to_the_next():
+    senders = {A: FakeSender(ConnectionRefusedError('a is down')), B: FakeSender()}
+    results = pool_with(senders).send_chunks(items(8))
+    assert [result.endpoint for result in results] == [B] * 4
+    assert all(result.response.processed == 2 for result in results)
+
+
+def test_chunk_fails_when_every_endpoint_is_down():
+    senders = {A: FakeSender(ConnectionRefusedError('a is down')), B: FakeSender(TimeoutError('b timed out'))}
+    results = pool_with(senders).send_chunks(items(3))
+    assert len(results) == 2
+    assert all(isinstance(result.response, Exception) for result in results)
+    assert [len(result.chunk) for result in results] == [2, 1]
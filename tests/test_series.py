@@ -0,0 +1,109 @@
+import threading
+import time
+from types import SimpleNamespace
+
+from common import HistoryPoint
+from history_fetch import fetch_history
+from history_store import HistoryWriter, load_point_ranges
+from series import KIND_FLOAT, KIND_TEXT, ReplaySeries, SeriesReadAhead, StringTable
+
+
+def store(db, points):
+    writer = HistoryWriter(db, '100')
+    for itemid, clock, value, value_type in points:
+        writer.append(itemid, clock, value, value_type)
+    writer.flush()
+    db.commit()
+
+
+def values(series):
+    return [value for _, value in series]
+
+
+def test_text_items_are_never_converted(db):
+    store(db, [('1', 10, '007', 1), ('1', 20, '1_000', 1), ('1', 30, '1e5', 1), ('2', 10, '1', 4)])
+    series = load_point_ranges(db, '100', {'1': (0, 10), '2': (0, 10)})
+    assert values(series['1']) == ['007', '1_000', '1e5']
+    assert values(series['2']) == ['1']
+
+
+def test_legacy_rows_without_value_type_are_kept_as_text(db):
+    store(db, [('1', 10, '1', None), ('1', 20, '2.50', None)])
+    assert values(load_point_ranges(db, '100', {'1': (0, 10)})['1']) == ['1', '2.50']
+
+
+def test_float_values_keep_the_sources_text():
+    series = ReplaySeries(KIND_FLOAT)
+    for clock, value in enumerate(['2', '100', '2.5', '0.1', '-3', '1e20']):
+        series.append(clock, value)
+    assert values(series) == ['2', '100', '2.5', '0.1', '-3', '1e+20']
+
+
+def test_numeric_items_use_typed_series(db):
+    store(db, [('1', 10, '1.25', 0), ('2', 10, '18446744073709551615', 3)])
+    series = load_point_ranges(db, '100', {'1': (0, 10), '2': (0, 10)})
+    assert values(series['1']) == ['1.25']
+    assert values(series['2']) == ['18446744073709551615']
+
+
+def test_values_that_do_not_fit_their_type_fall_back_to_text(db):
+    store(db, [('1', 10, str(2 ** 64), 3), ('2', 10, 'n/a', 0)])
+    series = load_point_ranges(db, '100', {'1': (0, 10), '2': (0, 10)})
+    assert series['1'].kind == KIND_TEXT and values(series['1']) == [str(2 ** 64)]
+    assert values(series['2']) == ['n/a']
+
+
+def test_fetched_history_keeps_the_item_value_type(db):
+    clock = int(time.time()) - 100
+    history = {'1': [{'itemid': '11', 'clock': str(clock), 'value': '007'}], '3': [{'itemid': '33', 'clock': str(clock), 'value': '5'}]}
+    source_zapi = SimpleNamespace(history=SimpleNamespace(
+        get=lambda **params: history[str(params['history'])] if params['time_from'] <= clock <= params['time_till'] else []))
+    items = [{'itemid': '11', 'value_type': '1', 'key_': 'version'}, {'itemid': '33', 'value_type': '3', 'key_': 'count'}]
+    fetch_history(items, source_zapi, db, '100', time_from=clock - 60)
+    rows = {row.itemid: (row.value, row.value_type) for row in db.query(HistoryPoint).all()}
+    assert rows == {'11': ('007', 1), '33': ('5', 3)}
+    assert values(load_point_ranges(db, '100', {'11': (0, 10)})['11']) == ['007']
+
+
+def test_string_table_is_consistent_across_threads():
+    table = StringTable()
+    results = {}
+
+    def intern_all(thread_index):
+        results[thread_index] = {f"value-{n}": table.intern(f"value-{n}") for n in range(2000)}
+
+    threads = [threading.Thread(target=intern_all, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for indexes in results.values():
+        assert indexes == results[0]
+        assert all(table[index] == value for value, index in indexes.items())
+    assert len(table.strings) == 2000
+
+
+def test_read_ahead_reloads_when_history_is_replaced(db):
+    loads = []
+
+    def load_ranges(db, source_host_id, ranges):
+        loads.append(dict(ranges))
+        return {itemid: [(100, f"gen{len(loads)}")] for itemid in ranges}
+
+    read_ahead = SeriesReadAhead()
+    task = SimpleNamespace(source_host_id='100', first_history_timestamp=100, history_generation=1)
+    bounds = {'1': (0, 1)}
+    assert read_ahead.get_points(db, task, {'1': 0}, bounds, load_ranges) == {'1': (100, 'gen1')}
+    assert read_ahead.get_points(db, task, {'1': 0}, bounds, load_ranges) == {'1': (100, 'gen1')}
+    task.history_generation = 2 # Re-fetched history with the same bounds
+    assert read_ahead.get_points(db, task, {'1': 0}, bounds, load_ranges) == {'1': (100, 'gen2')}
+    assert len(loads) == 2
+
+
+def test_read_ahead_forgets_tasks_no_longer_replayed(db):
+    read_ahead = SeriesReadAhead()
+    for source_host_id in ('100', '200'):
+        task = SimpleNamespace(source_host_id=source_host_id, first_history_timestamp=1, history_generation=1)
+        read_ahead.get_points(db, task, {'1': 0}, {'1': (0, 1)}, lambda db, host, ranges: {'1': [(1, 'x')]})
+    read_ahead.retain(['200'])
+    assert list(read_ahead._tasks) == ['200']
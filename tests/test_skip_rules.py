@@ -0,0 +1,15 @@
+import pytest
+
+from common import SKIP_KEY_PREFIXES, should_skip_item
+from jobs import is_replayed_item
+
+
+@pytest.mark.parametrize('key', [f"{prefix}.hop[1]" for prefix in SKIP_KEY_PREFIXES])
+def test_skipped_prefixes_are_neither_fetched_nor_replayed(key):
+    assert should_skip_item('Hop 1', key)
+    assert not is_replayed_item('100', key)
+
+
+def test_regular_items_are_replayed():
+    assert not should_skip_item('CPU utilization', 'system.cpu.util')
+    assert is_replayed_item('100', 'system.cpu.util')
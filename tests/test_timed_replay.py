@@ -0,0 +1,79 @@
+import history_store
+from common import ReplicationTask
+from history_store import HistoryWriter, load_points_by_clock
+from jobs import TaskBatch, collect_timed_points
+
+ITEMS = ['1', '2', '3', '4', '5']
+
+
+def timed_task(db):
+    writer = HistoryWriter(db, '100')
+    for itemid in ITEMS:
+        writer.append(itemid, 100, f"{itemid}@100")
+    for itemid in ITEMS[:2]:
+        writer.append(itemid, 101, f"{itemid}@101")
+    writer.flush()
+    task = ReplicationTask(source_host_id='100', status='replaying', dest_host_name='dest', replay_mode='timed',
+                           replay_speed=1.0, first_history_timestamp=100)
+    db.add(task)
+    db.commit()
+    return task
+
+
+def run_tick(db, task, now, max_points):
+    batch = TaskBatch(task, {itemid: 2 for itemid in ITEMS})
+    collect_timed_points(db, batch, {itemid: f"key{itemid}" for itemid in ITEMS}, now, max_points)
+    task.replayed_until = batch.replayed_until
+    task.replayed_itemid, task.replayed_seq = batch.replayed_key or (None, None)
+    task.cycle_started_at = batch.cycle_started_at
+    return [(item.key, item.value) for item in batch.packet]
+
+
+def test_load_points_by_clock_resumes_after_key(db):
+    timed_task(db)
+    rows = load_points_by_clock(db, '100', 99, 101, after_key=('2', 0))
+    assert [(itemid, clock) for itemid, clock, _, _ in rows] == [('3', 100), ('4', 100), ('5', 100), ('1', 101), ('2', 101)]
+
+
+def test_split_clock_is_sent_completely_and_within_budget(db):
+    task = timed_task(db)
+    task.cycle_started_at = 1000.0
+    task.replayed_until = 99
+
+    ticks = [run_tick(db, task, 1005.0, max_points=3) for _ in range(4)]
+
+    assert [len(points) for points in ticks] == [3, 2, 2, 0]
+    sent = [value for points in ticks for _, value in points]
+    assert sorted(sent) == sorted([f"{i}@100" for i in ITEMS] + ['1@101', '2@101'])
+    assert task.replayed_until == 105 and task.replayed_itemid is None
+
+
+def test_split_clock_waits_until_the_clock_is_finished(db):
+    task = timed_task(db)
+    task.cycle_started_at = 1000.0
+    task.replayed_until = 99
+
+    assert len(run_tick(db, task, 1000.0, max_points=2)) == 2 # Only clock 100 is due
+    assert (task.replayed_until, task.replayed_itemid) == (99, '2')
+    assert [value for _, value in run_tick(db, task, 1000.0, max_points=5)] == ['3@100', '4@100', '5@100']
+    assert (task.replayed_until, task.replayed_itemid) == (100, None)
+
+
+def test_unmapped_items_do_not_use_up_the_budget(db):
+    task = timed_task(db)
+    task.cycle_started_at = 1000.0
+    task.replayed_until = 99
+    batch = TaskBatch(task, {'4': 1, '5': 1}) # Items 1-3 are unmapped
+
+    collect_timed_points(db, batch, {'4': 'key4', '5': 'key5'}, 1005.0, max_points=2)
+
+    assert [item.value for item in batch.packet] == ['4@100', '5@100']
+    assert (batch.replayed_until, batch.replayed_key) == (105, None) # No split cursor
+
+
+def test_load_points_by_clock_merges_item_chunks(db, monkeypatch):
+    monkeypatch.setattr(history_store, 'READ_BATCH_SIZE', 2)
+    timed_task(db)
+
+    rows = load_points_by_clock(db, '100', 99, 101, limit=5, itemids=['5', '1', '2', '4'])
+    assert [(itemid, clock) for itemid, clock, _, _ in rows] == [('1', 100), ('2', 100), ('4', 100), ('5', 100), ('1', 101)]
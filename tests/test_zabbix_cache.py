@@ -0,0 +1,51 @@
+from zabbix_cache import SourceConfigCache
+
+
+class FakeSourceApi:
+    """Answers the source configuration calls and counts them."""
+
+    url = 'http://source'
+
+    def __init__(self):
+        self.items = [{'itemid': '1', 'name': 'Ping', 'key_': 'icmpping'}]
+        self.calls = []
+        api = self
+
+        class Host:
+            def get(self, **params):
+                api.calls.append(('host.get', params.get('selectItems')))
+                items = str(len(api.items)) if params.get('selectItems') == 'count' else [dict(i) for i in api.items]
+                return [{'hostid': '10', 'parentTemplates': [], 'items': items, 'macros': []}]
+
+        class Item:
+            def get(self, **params):
+                api.calls.append(('item.get', None))
+                return [dict(i) for i in api.items]
+
+        self.host = Host()
+        self.item = Item()
+
+
+def test_unchanged_host_costs_one_light_call():
+    api = FakeSourceApi()
+    cache = SourceConfigCache(max_age_seconds=600)
+    first = cache.get(api, '10')
+    api.calls.clear()
+
+    second = cache.get(api, '10')
+
+    assert api.calls == [('host.get', 'count')]
+    assert second.host_items == first.host_items == api.items
+
+
+def test_added_item_refetches_configuration():
+    api = FakeSourceApi()
+    cache = SourceConfigCache(max_age_seconds=600)
+    cache.get(api, '10')
+    api.items.append({'itemid': '2', 'name': 'Loss', 'key_': 'icmppingloss'})
+    api.calls.clear()
+
+    config = cache.get(api, '10')
+
+    assert len(api.calls) == 2 and not any(call[0] == 'item.get' for call in api.calls)
+    assert [item['key_'] for item in config.host_items] == ['icmpping', 'icmppingloss']
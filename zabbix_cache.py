@@ -0,0 +1,211 @@
+import copy
+import hashlib
+import logging
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from common import config
+
+# Item fields requested with the source host and template configuration
+SOURCE_ITEM_FIELDS = ['itemid', 'name', 'key_', 'type', 'value_type', 'delay', 'history', 'trends', 'units', 'description', 'status', 'flags']
+
+# Entity kinds cached per destination: (API object, name field, ID field)
+ENTITY_KINDS = {
+    'group': ('hostgroup', 'name', 'groupid'),
+    'template': ('template', 'name', 'templateid'),
+    'host': ('host', 'host', 'hostid'),
+}
+
+
+class DestinationMetadataCache:
+    """
+    TTL cache of destination host group, template and host name -> ID maps.
+
+    Each map is one get call per destination and kind. The call is made when the map is
+    first needed or older than DEST_METADATA_CACHE_SECONDS, so concurrent (bulk)
+    replications share a single snapshot. Entities ReplayZ creates are registered in place,
+    so the snapshot stays valid without refetching.
+    """
+
+    def __init__(self, ttl_seconds=None):
+        self.ttl_seconds = ttl_seconds
+        self._maps = {} # {(dest_url, kind): (fetched_at, {name: id})}
+        self._lock = threading.Lock()
+
+    def _ttl(self):
+        return self.ttl_seconds if self.ttl_seconds is not None else config.get('dest_metadata_cache_seconds', 300)
+
+    @staticmethod
+    def _key(dest_zapi, kind):
+        return (getattr(dest_zapi, 'url', None) or id(dest_zapi), kind)
+
+    def get_map(self, dest_zapi, kind):
+        """
+        Returns the {name: id} map of a kind of destination entity ('group', 'template' or 'host').
+
+        The returned dict is shared; don't modify it, use register() instead.
+        """
+        key = self._key(dest_zapi, kind)
+        # Held while fetching, so concurrent replications wait for one snapshot instead of each fetching
+        with self._lock:
+            cached = self._maps.get(key)
+            if cached is not None and time.time() - cached[0] < self._ttl():
+                return cached[1]
+            api_object, name_field, id_field = ENTITY_KINDS[kind]
+            entities = getattr(dest_zapi, api_object).get(output=[id_field, name_field])
+            entity_map = {entity[name_field]: entity[id_field] for entity in entities}
+            self._maps[key] = (time.time(), entity_map)
+            logging.debug(f"Cached {len(entity_map)} destination {kind}s.")
+            return entity_map
+
+    def lookup(self, dest_zapi, kind, name):
+        """Returns the ID of the named destination entity, or None if it doesn't exist."""
+        return self.get_map(dest_zapi, kind).get(name)
+
+    def register(self, dest_zapi, kind, name, entity_id):
+        """Adds an entity created on the destination to the cached map (if it is cached)."""
+        with self._lock:
+            cached = self._maps.get(self._key(dest_zapi, kind))
+            if cached is not None:
+                cached[1][name] = entity_id
+
+    def invalidate(self, dest_zapi=None, kind=None):
+        """Drops cached maps, all of them or those of one destination and/or kind."""
+        with self._lock:
+            if dest_zapi is None and kind is None:
+                self._maps.clear()
+                return
+            url = self._key(dest_zapi, kind)[0] if dest_zapi is not None else None
+            for key in list(self._maps):
+                if (url is None or key[0] == url) and (kind is None or key[1] == kind):
+                    del self._maps[key]
+
+
+# Shared by every replication in this process
+dest_metadata_cache = DestinationMetadataCache()
+
+
+# Source configuration of a host:
+#   host: host.get result with groups, parentTemplates, interfaces, items and macros
+#   template_items / template_macros: items and macros of the host's templates
+#   host_items: items of the host including inherited ones (host.get selectItems)
+SourceHostConfig = namedtuple('SourceHostConfig', ['host', 'template_items', 'template_macros', 'host_items'])
+
+
+def merge_source_items(source_config):
+    """Returns a host's direct and template items, unique by item ID (direct items first)."""
+    items = {item['itemid']: item for item in source_config.host.get('items', [])}
+    for item in source_config.template_items:
+        items.setdefault(item['itemid'], item)
+    return list(items.values())
+
+
+def source_fingerprint(template_ids, item_count):
+    """Hashes a host's template IDs and item count; it changes when templates are (un)linked or items added or removed."""
+    digest = hashlib.md5(','.join(sorted(str(template_id) for template_id in template_ids)).encode('utf-8'))
+    return f"{int(item_count)}:{digest.hexdigest()}"
+
+
+class SourceConfigCache:
+    """
+    Cache of source host configuration (host, template items and macros).
+
+    Every get() validates the cached entry with one light host.get call returning only the
+    parent template IDs and the item count. If that fingerprint is unchanged, the heavy
+    host.get/template.get calls with full item and macro details are skipped. Entries older
+    than SOURCE_CONFIG_CACHE_SECONDS are refetched anyway, so edits that keep the item
+    count (renamed keys, macro and interface changes) are picked up within that time.
+    """
+
+    def __init__(self, max_age_seconds=None, max_entries=1000):
+        self.max_age_seconds = max_age_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # {(source_url, hostid): (fetched_at, fingerprint, SourceHostConfig)}
+        self._lock = threading.Lock()
+
+    def _max_age(self):
+        return self.max_age_seconds if self.max_age_seconds is not None else config.get('source_config_cache_seconds', 600)
+
+    @staticmethod
+    def _key(source_zapi, source_host_id):
+        return (getattr(source_zapi, 'url', None) or id(source_zapi), str(source_host_id))
+
+    def get(self, source_zapi, source_host_id):
+        """
+        Returns the SourceHostConfig of a source host (a copy the caller may modify).
+
+        Raises:
+            ValueError: If the source host does not exist
+        """
+        key = self._key(source_zapi, source_host_id)
+        hosts = source_zapi.host.get(hostids=source_host_id, output=['hostid'], selectParentTemplates=['templateid'], selectItems='count')
+        if not hosts:
+            self.invalidate(source_zapi, source_host_id)
+            raise ValueError(f"Source host with ID {source_host_id} not found.")
+        template_ids = [t['templateid'] for t in hosts[0].get('parentTemplates', [])]
+        item_count = hosts[0].get('items', 0)
+        fingerprint = source_fingerprint(template_ids, item_count)
+
+        with self._lock:
+            cached = self._entries.get(key)
+            if cached is not None and cached[1] == fingerprint and time.time() - cached[0] < self._max_age():
+                self._entries.move_to_end(key)
+                logging.info(f"Source configuration of host {source_host_id} unchanged ({item_count} items), using cached copy.")
+                return copy.deepcopy(cached[2])
+
+        source_config, complete = self._fetch(source_zapi, source_host_id, template_ids)
+        if not complete:
+            return source_config # Don't cache a configuration missing template data
+        with self._lock:
+            self._entries[key] = (time.time(), fingerprint, source_config)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return copy.deepcopy(source_config)
+
+    def _fetch(self, source_zapi, source_host_id, template_ids):
+        source_hosts = source_zapi.host.get(
+            hostids=source_host_id,
+            selectGroups=['groupid', 'name'],
+            selectParentTemplates=['templateid', 'name'],
+            selectInterfaces=['type', 'main', 'useip', 'ip', 'dns', 'port'],
+            selectItems=SOURCE_ITEM_FIELDS,
+            selectMacros='extend' # Fetch host macros
+        )
+        if not source_hosts:
+            raise ValueError(f"Source host with ID {source_host_id} not found.")
+
+        template_items = []
+        template_macros = []
+        complete = True
+        if template_ids:
+            logging.info(f"Fetching items and macros from {len(template_ids)} source templates...")
+            try:
+                template_data = source_zapi.template.get(
+                    templateids=template_ids,
+                    output=['templateid', 'name'],
+                    selectItems=SOURCE_ITEM_FIELDS,
+                    selectMacros='extend' # Fetch template macros
+                )
+                for template in template_data:
+                    template_items.extend(template.get('items', []))
+                    template_macros.extend(template.get('macros', []))
+                logging.info(f"Fetched {len(template_items)} items and {len(template_macros)} macros from templates.")
+            except Exception as e:
+                logging.warning(f"Could not fetch items or macros from source templates: {e}")
+                complete = False
+        host_items = source_hosts[0].get('items', [])
+        return SourceHostConfig(source_hosts[0], template_items, template_macros, host_items), complete
+
+    def invalidate(self, source_zapi=None, source_host_id=None):
+        """Drops cached configuration, all of it or that of one source host."""
+        with self._lock:
+            if source_zapi is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(self._key(source_zapi, source_host_id), None)
+
+
+# Shared by every replication, relink and mapping rebuild in this process
+source_config_cache = SourceConfigCache()